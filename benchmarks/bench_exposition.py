@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Benchmark of rendering the recorded icinga2 services in the text, OpenMetrics and protobuf exposition formats,
+the size of the bodies and the time to parse them. The text formats are parsed with the prometheus_client
+parsers and the protobuf format with a minimal decoder, so the parse times compare the formats relative to each
+other and are not the ingest cost of the Prometheus server.
+
+    python -m benchmarks.bench_exposition [--services 20000]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import timeit
+
+from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client.openmetrics.parser import text_string_to_metric_families as openmetrics_to_metric_families
+
+import icinga2_exporter.exposition as exposition
+from icinga2_exporter.monitorconnection import MonitorConfig
+from icinga2_exporter.perfdata import Perfdata
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'tests'))
+from protobufdecode import metric_families  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, 'tests', 'fixtures')
+
+
+def perfdata(services: int) -> Perfdata:
+    """
+    The metrics of the recorded services repeated to the requested number of services, each copy on its own host
+    :param services:
+    :return:
+    """
+    with open(os.path.join(FIXTURES, 'services.json'), 'rb') as fixture:
+        results = json.load(fixture)['results']
+
+    monitor = MonitorConfig({'icinga2': {'url': 'https://localhost:5665', 'user': 'user', 'passwd': 'passwd',
+                                         'metric_prefix': 'icinga2'}})
+    metrics = Perfdata(monitor, '*')
+    for index in range(services):
+        service_attrs = json.loads(json.dumps(results[index % len(results)]))
+        service_attrs['attrs']['host_name'] = f"host{index // len(results)}"
+        metrics.add_service_metrics(service_attrs)
+    return metrics
+
+
+def best_of(func, number: int = 1, repeat: int = 3) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='exposition format benchmark')
+    parser.add_argument('--services', type=int, default=20000, help='services rendered')
+    args = parser.parse_args()
+
+    metrics = perfdata(args.services)
+    parsers = {exposition.TEXT: lambda body: list(text_string_to_metric_families(body)),
+               exposition.OPENMETRICS: lambda body: list(openmetrics_to_metric_families(body)),
+               exposition.PROTOBUF: metric_families}
+
+    results = {'samples': len(metrics.perfdatadict)}
+    for exposition_format, parse in parsers.items():
+        body = metrics.prometheus_format(exposition_format)
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        results[exposition_format] = {
+            'render_seconds': best_of(lambda: metrics.prometheus_format(exposition_format)),
+            'bytes': len(data),
+            'gzip_bytes': len(gzip.compress(data, 6)),
+            'parse_seconds': best_of(lambda: parse(body)),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+Micro-benchmark of decoding recorded icinga2 responses and encoding request bodies with the json codec
+compared to the stdlib path used before, decoding the response text.
+
+    python -m benchmarks.bench_json [--services 20000]
+"""
+
+import argparse
+import json
+import os
+import timeit
+
+import icinga2_exporter.jsoncodec as jsoncodec
+from icinga2_exporter.monitorconnection import MonitorConfig
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, 'tests', 'fixtures')
+
+
+def recorded_response(services: int) -> bytes:
+    """
+    The recorded services response repeated to the requested number of services
+    :param services:
+    :return:
+    """
+    with open(os.path.join(FIXTURES, 'services.json'), 'rb') as fixture:
+        results = json.load(fixture)['results']
+    return json.dumps({'results': (results * (services // len(results) + 1))[:services]}).encode('utf-8')
+
+
+def best_of(func, number: int, repeat: int = 5) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='json codec micro-benchmark')
+    parser.add_argument('--services', type=int, default=20000, help='services in the decoded response')
+    args = parser.parse_args()
+
+    response = recorded_response(args.services)
+    body = MonitorConfig.service_query('host.example.com')
+
+    results = {
+        'backend': jsoncodec.backend(),
+        'response_bytes': len(response),
+        'decode_stdlib_text_seconds': best_of(lambda: json.loads(response.decode('utf-8')), 3),
+        'decode_codec_bytes_seconds': best_of(lambda: jsoncodec.loads(response), 3),
+        'encode_stdlib_seconds': best_of(lambda: json.dumps(body), 10000),
+        'encode_codec_seconds': best_of(lambda: jsoncodec.dumps(body), 10000),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark of the first byte latency and the peak memory of a /metrics scrape, rendering the whole body before
+responding compared to streaming the body one service at a time. The scrapes are made against the fake icinga2
+used by the tests.
+
+    python -m benchmarks.bench_streaming [--services 20000] [--streaming-decode]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from quart import Quart
+
+import icinga2_exporter.monitorconnection as monitorconnection
+import icinga2_exporter.proxy as proxy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'tests'))
+from fakeicinga import FakeIcinga2, service  # noqa: E402
+
+
+async def buffered(target: str) -> float:
+    """
+    Scrape like /metrics did before streaming, the first byte is sent when the whole body is rendered
+    :param target:
+    :return: the time to the first byte
+    """
+    start_time = time.monotonic()
+    monitor_data = await proxy.scrape(target)
+    body = monitor_data.prometheus_format()
+    first_byte = time.monotonic() - start_time
+    del body
+    return first_byte
+
+
+async def streamed(target: str) -> float:
+    """
+    Scrape like /metrics, the first byte is sent when the first service is rendered
+    :param target:
+    :return: the time to the first byte
+    """
+    start_time = time.monotonic()
+    first_byte = None
+    async for _ in await proxy.stream_scrape(target, '/metrics'):
+        if first_byte is None:
+            first_byte = time.monotonic() - start_time
+    return first_byte
+
+
+async def measure(app: Quart, scrape, target: str, repeat: int) -> dict:
+    async with app.test_request_context('/metrics'):
+        first_bytes = sorted([await scrape(target) for _ in range(repeat)])
+
+        tracemalloc.start()
+        await scrape(target)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {'first_byte_seconds': first_bytes[len(first_bytes) // 2], 'peak_memory_bytes': peak}
+
+
+async def run(args) -> dict:
+    services = [service('host.example.com', f"service{index}", 'nscp',
+                        [f"'C:\\ used %'={index % 100}%;80;90;0;100", f"'C:\\ used'={index}MB;;;0;{index * 2}"])
+                for index in range(args.services)]
+    icinga2 = FakeIcinga2(services=services)
+    url = await icinga2.start()
+    monitorconnection.MonitorConfig({'icinga2': {'url': url, 'user': 'user', 'passwd': 'passwd',
+                                                 'metric_prefix': 'icinga2',
+                                                 'enable_streaming_decode': args.streaming_decode}})
+    await monitorconnection.MonitorConfig().open_session()
+    app = Quart(__name__)
+    try:
+        return {'services': args.services,
+                'streaming_decode': args.streaming_decode,
+                'buffered': await measure(app, buffered, 'host.example.com', args.repeat),
+                'streamed': await measure(app, streamed, 'host.example.com', args.repeat)}
+    finally:
+        await monitorconnection.MonitorConfig().close_session()
+        await icinga2.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/metrics first byte and memory benchmark')
+    parser.add_argument('--services', type=int, default=20000, help='services of the scraped host')
+    parser.add_argument('--repeat', type=int, default=5, help='scrapes timed, the median is reported')
+    parser.add_argument('--streaming-decode', action='store_true', help='enable streaming decode')
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
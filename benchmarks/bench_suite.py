@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Benchmark suite run against a fake icinga2 api serving a synthetic fleet. The exporter is served by hypercorn
+and /metrics is scraped under concurrent load, reporting throughput and latency percentiles. The perfdata
+parsing, metric name formatting and rendering are also timed on their own. The results are written as json so
+runs can be compared.
+
+    python -m benchmarks.bench_suite [--hosts 200] [--services-per-host 20] [--perfdata-items 4]
+                                     [--custom-vars 5] [--concurrency 10] [--requests 500] [--output run.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import timeit
+from typing import Any, Dict, List
+
+import aiohttp
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Quart
+
+import icinga2_exporter.log as log
+import icinga2_exporter.monitorconnection as monitorconnection
+import icinga2_exporter.perfdatabatch as perfdatabatch
+import icinga2_exporter.perfdatarange as perfdatarange
+from icinga2_exporter.cache import LRUCache
+from icinga2_exporter.perfdata import Perfdata
+from icinga2_exporter.proxy import app as icinga2
+from benchmarks.fleet import generate_fleet, hostnames
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'tests'))
+from fakeicinga import FakeIcinga2  # noqa: E402
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    The percentile by nearest rank of the sorted values
+    :param values:
+    :param fraction: e.g. 0.99
+    :return:
+    """
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def load(url: str, targets: List[str], requests: int, concurrency: int) -> Dict[str, Any]:
+    """
+    Scrape /metrics for the targets in turn from concurrent clients
+    :param url: the url of the exporter
+    :param targets:
+    :param requests: total number of scrapes
+    :param concurrency: number of concurrent clients
+    :return:
+    """
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    next_request = iter(range(requests))
+
+    async def client(session: aiohttp.ClientSession):
+        nonlocal errors, response_bytes
+        for index in next_request:
+            start_time = time.monotonic()
+            async with session.get(f"{url}/metrics", params={'target': targets[index % len(targets)]},
+                                   headers={'Accept-Encoding': 'identity'}) as response:
+                body = await response.read()
+                if response.status != 200:
+                    errors += 1
+            latencies.append(time.monotonic() - start_time)
+            response_bytes += len(body)
+
+    start_time = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+    duration = time.monotonic() - start_time
+
+    latencies.sort()
+    return {'requests': requests, 'concurrency': concurrency, 'errors': errors, 'duration_seconds': duration,
+            'requests_per_second': requests / duration, 'mean_response_bytes': response_bytes / requests,
+            'latency_seconds': {'p50': percentile(latencies, 0.5), 'p90': percentile(latencies, 0.9),
+                                'p99': percentile(latencies, 0.99), 'max': latencies[-1]}}
+
+
+def best_of(func, number: int = 1, repeat: int = 5) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def micro_benchmarks(services: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Time the perfdata parsing, metric name formatting and rendering of all services of the fleet. The caches are
+    disabled so the functions themselves are timed.
+    :param services:
+    :return:
+    """
+    monitor = monitorconnection.MonitorConfig()
+    perf_strings = [perf_string for service_attrs in services
+                    for perf_string in service_attrs['attrs']['last_check_result']['performance_data']]
+
+    parsed = [(service_attrs['attrs']['check_command'], key, value) for service_attrs in services
+              for perf_string in service_attrs['attrs']['last_check_result']['performance_data']
+              for key, value in Perfdata.parse_perf_string(perf_string).items()]
+    uncached = Perfdata(monitor, '*')
+    uncached.metric_name_cache = LRUCache('benchmark', 0)
+
+    rendered = Perfdata(monitor, '*')
+    for service_attrs in services:
+        rendered.add_service_metrics(service_attrs)
+
+    def parse_perf_strings():
+        for perf_string in perf_strings:
+            Perfdata.parse_perf_string(perf_string)
+
+    def parse_ranges():
+        for perf_string in perf_strings:
+            perfdatarange.parse_perf_string(perf_string)
+
+    def parse_batch():
+        perfdatabatch.parse_perf_strings(perf_strings)
+
+    def format_names():
+        for check_command, key, value in parsed:
+            uncached.format_prometheus_metrics_name(check_command, key, value)
+
+    ranges_cache = LRUCache('benchmark_ranges', monitor.perfdata_cache_size)
+
+    def add_services(enable_perfdata_ranges: bool = False):
+        perfdata = Perfdata(monitor, '*')
+        if enable_perfdata_ranges:
+            # The perfdata cache of the monitor hold the items of the default parser
+            perfdata.enable_perfdata_ranges = True
+            perfdata.perfdata_cache = ranges_cache
+        for service_attrs in services:
+            perfdata.add_service_metrics(service_attrs)
+
+    return {
+        'parse_perf_string': {'calls': len(perf_strings), 'seconds': best_of(parse_perf_strings)},
+        'parse_perf_string_ranges': {'calls': len(perf_strings), 'seconds': best_of(parse_ranges)},
+        'parse_perf_strings': {'calls': len(perf_strings), 'seconds': best_of(parse_batch)},
+        'format_prometheus_metrics_name': {'calls': len(parsed), 'seconds': best_of(format_names)},
+        'add_service_metrics': {'calls': len(services), 'seconds': best_of(add_services)},
+        'add_service_metrics_ranges': {'calls': len(services), 'seconds': best_of(lambda: add_services(True))},
+        'prometheus_format': {'samples': len(rendered.perfdatadict),
+                              'seconds': best_of(rendered.prometheus_format)},
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    services, hosts = generate_fleet(args.hosts, args.services_per_host, args.perfdata_items, args.custom_vars)
+    fake = FakeIcinga2(services=services, hosts=hosts)
+    icinga2_url = await fake.start()
+
+    config = {'url': icinga2_url, 'user': 'user', 'passwd': 'passwd', 'metric_prefix': 'icinga2'}
+    config.update(json.loads(args.config))
+    monitorconnection.MonitorConfig({'icinga2': config})
+
+    app = Quart(__name__)
+    app.register_blueprint(icinga2, url_prefix='')
+    port = free_port()
+    hypercorn_config = Config()
+    hypercorn_config.bind = [f"127.0.0.1:{port}"]
+    hypercorn_config.accesslog = None
+    shutdown = asyncio.Event()
+    server = asyncio.ensure_future(serve(app, hypercorn_config, shutdown_trigger=shutdown.wait))
+    try:
+        # Wait for the exporter to serve
+        async with aiohttp.ClientSession() as session:
+            for _ in range(100):
+                try:
+                    async with session.get(f"http://127.0.0.1:{port}/health"):
+                        break
+                except aiohttp.ClientConnectorError:
+                    await asyncio.sleep(0.05)
+
+        end_to_end = await load(f"http://127.0.0.1:{port}", hostnames(hosts), args.requests, args.concurrency)
+    finally:
+        shutdown.set()
+        await server
+        await fake.stop()
+
+    return {
+        'python': platform.python_version(),
+        'fleet': {'hosts': args.hosts, 'services_per_host': args.services_per_host,
+                  'perfdata_items': args.perfdata_items, 'custom_vars': args.custom_vars},
+        'config': {key: value for key, value in config.items() if key not in ('url', 'user', 'passwd')},
+        'end_to_end': end_to_end,
+        'functions': micro_benchmarks(services),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='icinga2-exporter benchmark suite')
+    parser.add_argument('--hosts', type=int, default=200, help='hosts in the fleet')
+    parser.add_argument('--services-per-host', type=int, default=20, help='services of each host')
+    parser.add_argument('--perfdata-items', type=int, default=4, help='perfdata items of each service')
+    parser.add_argument('--custom-vars', type=int, default=5, help='custom vars of each host')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent scrapes')
+    parser.add_argument('--requests', type=int, default=500, help='total scrapes')
+    parser.add_argument('--config', default='{}', help='additional icinga2 configuration as json, e.g. '
+                                                       '\'{"enable_scrape_metadata": true}\'')
+    parser.add_argument('--output', help='write the results to this file, default stdout')
+    args = parser.parse_args()
+
+    # The scrapes are logged at info
+    log.logger.disabled = True
+    results = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(results + '\n')
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Synthetic icinga2 fleets for the benchmarks, the services and hosts as returned by the icinga2 api.
+"""
+
+import os
+import random
+import sys
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'tests'))
+from fakeicinga import host, service  # noqa: E402
+
+# Perfdata templates of common plugins, the index of the item is filled in
+PERFDATA_TEMPLATES = [
+    "'load{index}'={value:.2f};5;10;0",
+    "rta{index}={value:.3f}ms;100;200;0",
+    "pl{index}={value:.0f}%;20;60;0;100",
+    "'C:\\ used {index}'={value:.1f}GB;80;90;0;100",
+    "'/var/{index}'={value:.0f}MB;;;0;{value:.0f}",
+    "packets{index}={value:.0f}c",
+    "time{index}={value:.6f}s;;;0",
+    "procs{index}={value:.0f};250;400;0",
+]
+
+CHECK_COMMANDS = ['load', 'ping4', 'nscp', 'disk', 'snmp', 'http', 'procs', 'users']
+
+
+def generate_fleet(hosts: int, services_per_host: int, perfdata_items: int, custom_vars: int,
+                   seed: int = 0) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Generate the services and hosts of a fleet
+    :param hosts: number of hosts
+    :param services_per_host: number of services on each host
+    :param perfdata_items: number of perfdata items of each service
+    :param custom_vars: number of custom vars of each host
+    :param seed: seed of the random values
+    :return: the services and the hosts
+    """
+    generator = random.Random(seed)
+    services = []
+    host_objects = []
+    for host_index in range(hosts):
+        host_name = f"host{host_index:05d}.example.com"
+        host_vars = {f"var{var_index}": f"value{(host_index + var_index) % 7}" for var_index in range(custom_vars)}
+        for service_index in range(services_per_host):
+            check_command = CHECK_COMMANDS[service_index % len(CHECK_COMMANDS)]
+            performance_data = [PERFDATA_TEMPLATES[(service_index + item) % len(PERFDATA_TEMPLATES)].format(
+                index=item, value=generator.uniform(0, 1000)) for item in range(perfdata_items)]
+            services.append(service(host_name, f"service{service_index}", check_command, performance_data,
+                                    execution_end=generator.uniform(1.6e9, 1.7e9), host_vars=host_vars))
+        host_objects.append(host(host_name, [f"rta={generator.uniform(0, 10):.3f}ms;100;200;0", "pl=0%;20;60"],
+                                 host_vars=host_vars))
+    return services, host_objects
+
+
+def hostnames(hosts: List[Dict[str, Any]]) -> List[str]:
+    return [host_attrs['attrs']['name'] for host_attrs in hosts]
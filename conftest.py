@@ -0,0 +1 @@
+# Makes pytest add the project root to sys.path so the tests can import icinga2_exporter without installing it
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, Union
+
+import icinga2_exporter.exportermetrics as exportermetrics
+
+
+class LRUCache:
+    """
+    Size bounded cache that evict the least recently used entry. Hits, misses and evictions are counted on
+    the exporter metrics with the cache name as label.
+
+    If maxbytes is set the cache is also bounded by the total size of the values, where the size of a value is
+    given by its size() method.
+    """
+
+    def __init__(self, name: str, maxsize: int, maxbytes: int = 0):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        # The size of each value when cached, only kept if bounded by maxbytes
+        self.sizes: Dict[Hashable, int] = {}
+        self.hits = exportermetrics.cache_hits.labels(name)
+        self.misses = exportermetrics.cache_misses.labels(name)
+        self.evictions = exportermetrics.cache_evictions.labels(name)
+        exportermetrics.cache_entries.labels(name).set_function(lambda: len(self.entries))
+        if maxbytes:
+            exportermetrics.cache_bytes.labels(name).set_function(lambda: self.bytes)
+
+    def get(self, key: Hashable, default: Any = None, valid: Callable[[Any], bool] = None) -> Any:
+        """
+        Get the cached value and mark it as most recently used
+        :param key:
+        :param default: returned if key is not cached
+        :param valid: optional check of the cached value, if false the entry is removed and counted as a miss
+        :return:
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses.inc()
+            return default
+
+        if valid is not None and not valid(value):
+            self.remove(key)
+            self.misses.inc()
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits.inc()
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get the cached value, valid or not, without marking it as used or counting a hit or miss
+        :param key:
+        :param default: returned if key is not cached
+        :return:
+        """
+        return self.entries.get(key, default)
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Cache the value, evicting the least recently used entries if the cache is full
+        :param key:
+        :param value:
+        :return:
+        """
+        if self.maxsize <= 0:
+            return
+
+        self.remove(key)
+        self.entries[key] = value
+        if self.maxbytes:
+            self.sizes[key] = value.size()
+            self.bytes += self.sizes[key]
+
+        self.evict()
+
+    def resize(self, key: Hashable):
+        """
+        Update the size of a cached value that has grown or shrunk since it was cached, evicting the least
+        recently used entries if the cache is now full
+        :param key:
+        :return:
+        """
+        if not self.maxbytes or key not in self.entries:
+            return
+
+        size = self.entries[key].size()
+        self.bytes += size - self.sizes[key]
+        self.sizes[key] = size
+        self.evict()
+
+    def evict(self):
+        while len(self.entries) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+            evicted, _ = self.entries.popitem(last=False)
+            if self.maxbytes:
+                self.bytes -= self.sizes.pop(evicted)
+            self.evictions.inc()
+
+    def remove(self, key: Hashable):
+        value = self.entries.pop(key, None)
+        if value is not None and self.maxbytes:
+            self.bytes -= self.sizes.pop(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Not counted as a hit or miss and not marked as used
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CachedResponse:
+    """
+    A rendered /metrics response body and the time of the latest check result it was rendered from. The
+    compressed bodies are kept by content encoding once compressed.
+    """
+
+    def __init__(self, body: Union[str, bytes], last_check_time: float):
+        self.created = time.monotonic()
+        self.body = body
+        self.last_check_time = last_check_time
+        self.encoded: Dict[str, bytes] = {}
+
+    def encode(self, encoding: str, compress: Callable[[bytes], bytes]) -> bytes:
+        """
+        Get the body compressed with the content encoding, the body is compressed on first use
+        :param encoding:
+        :param compress: the compression of the encoding
+        :return:
+        """
+        body = self.encoded.get(encoding)
+        if body is None:
+            body = compress(self.body.encode('utf-8') if isinstance(self.body, str) else self.body)
+            self.encoded[encoding] = body
+        return body
+
+    def is_fresh(self, ttl: float, last_check_time: float = None) -> bool:
+        """
+        A response is fresh if younger than ttl and, if the time of the latest check result is known, no check
+        has been executed since it was rendered
+        :param ttl:
+        :param last_check_time:
+        :return:
+        """
+        if time.monotonic() - self.created > ttl:
+            return False
+        return last_check_time is None or last_check_time == self.last_check_time
+
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.encoded.values())
+
+
+class SingleFlight:
+    """
+    Make sure only one call is in flight for a key. Concurrent callers with the same key wait for and share the
+    result of the call already in flight.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]], timeout: float = None) -> Tuple[Any, bool]:
+        """
+        Call func unless a call with the same key is already in flight
+        :param key:
+        :param func: coroutine function to call
+        :param timeout: optional seconds to wait for a call already in flight, asyncio.TimeoutError is raised if
+        not done by then. The call is not cancelled and its result still shared with the other callers.
+        :return: the result and true if the result was shared with a call already in flight
+        """
+        future = self.calls.get(key)
+        if future is not None:
+            return await asyncio.wait_for(asyncio.shield(future), timeout), True
+
+        future = asyncio.ensure_future(func())
+        self.calls[key] = future
+        future.add_done_callback(lambda done: self.done(key, done))
+        # Shield so a cancelled caller does not cancel the call for the callers waiting on it
+        return await asyncio.shield(future), False
+
+    def done(self, key: Hashable, future: asyncio.Future):
+        self.calls.pop(key, None)
+        if not future.cancelled():
+            # Mark the exception as retrieved, it is raised to the callers if any is still waiting
+            future.exception()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import time
+import zlib
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+import icinga2_exporter.exportermetrics as exportermetrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+
+def encodings() -> List[str]:
+    """
+    The supported content encodings in order of preference, zstd is only supported if zstandard is installed
+    :return:
+    """
+    if zstandard is not None:
+        return [ZSTD, GZIP]
+    return [GZIP]
+
+
+def negotiate(accept_encodings) -> Optional[str]:
+    """
+    Select the content encoding of the response from the Accept-Encoding of the request
+    :param accept_encodings: the parsed Accept-Encoding header, request.accept_encodings
+    :return: the encoding or None if the response should not be compressed
+    """
+    return accept_encodings.best_match(encodings())
+
+
+class Compressor:
+    """
+    Incremental compression of a response body with a content encoding. The time spent compressing is observed
+    on the compression histogram when flushed.
+    """
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        self.seconds = 0.0
+        if encoding == ZSTD:
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            # wbits 31 is deflate with a gzip header and trailer
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        start_time = time.monotonic()
+        compressed = self.compressor.compress(data)
+        self.seconds += time.monotonic() - start_time
+        return compressed
+
+    def flush(self) -> bytes:
+        start_time = time.monotonic()
+        compressed = self.compressor.flush()
+        self.seconds += time.monotonic() - start_time
+        exportermetrics.compression_seconds.labels(self.encoding).observe(self.seconds)
+        return compressed
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """
+    Compress a whole response body
+    :param data:
+    :param encoding:
+    :param level:
+    :return:
+    """
+    compressor = Compressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_body(body: Union[str, bytes], encoding: Optional[str], level: int,
+                  min_size: int) -> Tuple[Optional[str], Union[str, bytes]]:
+    """
+    Compress a whole response body, if not smaller than min_size
+    :param body:
+    :param encoding: the encoding or None if not compressed
+    :param level:
+    :param min_size:
+    :return: the encoding used, or None if not compressed, and the body
+    """
+    if encoding is None or len(body) < min_size:
+        return None, body
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return encoding, compress(body, encoding, level)
+
+
+async def compress_stream(chunks: AsyncIterator[str], encoding: Optional[str], level: int,
+                          min_size: int) -> Tuple[Optional[str], AsyncIterator[Union[str, bytes]]]:
+    """
+    Compress a streamed response body. The chunks are read until min_size bytes are read, if the body is
+    smaller it is not compressed.
+    :param chunks:
+    :param encoding: the encoding or None if not compressed
+    :param level:
+    :param min_size:
+    :return: the encoding used, or None if not compressed, and the body
+    """
+    head = []
+    size = 0
+    if encoding is not None:
+        async for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= min_size:
+                break
+        else:
+            encoding = None
+
+    async def body() -> AsyncIterator[Union[str, bytes]]:
+        if encoding is None:
+            for chunk in head:
+                yield chunk
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        compressor = Compressor(encoding, level)
+        for chunk in head:
+            compressed = compressor.compress(chunk.encode('utf-8'))
+            if compressed:
+                yield compressed
+        async for chunk in chunks:
+            compressed = compressor.compress(chunk.encode('utf-8'))
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    return encoding, body()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+# Registry for the exporter's own metrics, served on /exporter-metrics and kept apart from the
+# target metrics served on /metrics
+registry = CollectorRegistry()
+
+upstream_connections = Gauge('icinga2_exporter_upstream_connections',
+                             'Connections in the icinga2 api connection pool by state (open, in_use, waiting)',
+                             ['state'], registry=registry)
+
+snapshot_age = Gauge('icinga2_exporter_snapshot_age_seconds',
+                     'Seconds since the snapshot was fetched from icinga2 or updated from the event stream',
+                     registry=registry)
+
+cache_hits = Counter('icinga2_exporter_cache_hits', 'Cache hits by cache', ['cache'], registry=registry)
+
+cache_misses = Counter('icinga2_exporter_cache_misses', 'Cache misses by cache', ['cache'], registry=registry)
+
+cache_evictions = Counter('icinga2_exporter_cache_evictions', 'Cache evictions by cache', ['cache'],
+                          registry=registry)
+
+cache_entries = Gauge('icinga2_exporter_cache_entries', 'Entries in cache by cache', ['cache'], registry=registry)
+
+cache_bytes = Gauge('icinga2_exporter_cache_bytes', 'Size in bytes of the cached values by cache', ['cache'],
+                    registry=registry)
+
+upstream_coalesced_requests = Counter('icinga2_exporter_upstream_coalesced_requests',
+                                      'Requests to icinga2 that were coalesced with an identical request in flight',
+                                      registry=registry)
+
+compression_seconds = Histogram('icinga2_exporter_compression_seconds',
+                                'Time spent compressing a /metrics response by content encoding', ['encoding'],
+                                buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0),
+                                registry=registry)
+
+# Buckets of the histograms of the stages of a scrape
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+upstream_request_seconds = Histogram('icinga2_exporter_upstream_request_seconds',
+                                     'Seconds of the requests to the icinga2 api by endpoint (services, hosts)',
+                                     ['endpoint'], buckets=STAGE_BUCKETS, registry=registry)
+
+json_decode_seconds = Histogram('icinga2_exporter_json_decode_seconds',
+                                'Seconds spent decoding the json of an icinga2 response', buckets=STAGE_BUCKETS,
+                                registry=registry)
+
+perfdata_parse_seconds = Histogram('icinga2_exporter_perfdata_parse_seconds',
+                                   'Seconds spent parsing the services and hosts of a scrape into samples',
+                                   buckets=STAGE_BUCKETS, registry=registry)
+
+render_seconds = Histogram('icinga2_exporter_render_seconds',
+                           'Seconds spent rendering the samples of a scrape in the exposition format',
+                           buckets=STAGE_BUCKETS, registry=registry)
+
+response_bytes = Histogram('icinga2_exporter_response_bytes', 'Size in bytes of the responses by path', ['path'],
+                           buckets=tuple(1024 * 4 ** exponent for exponent in range(10)), registry=registry)
+
+upstream_errors = Counter('icinga2_exporter_upstream_errors',
+                          'Failed requests to the icinga2 api by endpoint and type (timeout, connect, status)',
+                          ['endpoint', 'type'], registry=registry)
+
+requests = Counter('icinga2_exporter_requests', 'Requests to the exporter by path', ['path'], registry=registry)
+
+error_responses = Counter('icinga2_exporter_error_responses', 'Responses with a status other than 200 by path '
+                          'and status', ['path', 'status'], registry=registry)
+
+scrape_deadline_exceeded = Counter('icinga2_exporter_scrape_deadline_exceeded',
+                                   'Scrapes that passed the deadline of the scraper by stage (upstream, parse)',
+                                   ['stage'], registry=registry)
+
+stale_responses = Counter('icinga2_exporter_stale_responses',
+                          'Scrapes answered with a stale cached response by reason (error, deadline, timeout)',
+                          ['reason'], registry=registry)
+
+dropped_series = Counter('icinga2_exporter_dropped_series', 'Series dropped by the cardinality limits by limit '
+                         '(target, family)', ['limit'], registry=registry)
+
+upstream_concurrency_limit = Gauge('icinga2_exporter_upstream_concurrency_limit',
+                                   'The adaptive limit of concurrent requests to the icinga2 api', registry=registry)
+
+upstream_in_flight_requests = Gauge('icinga2_exporter_upstream_in_flight_requests',
+                                    'Requests to the icinga2 api in flight', registry=registry)
+
+upstream_queued_requests = Gauge('icinga2_exporter_upstream_queued_requests',
+                                 'Requests to the icinga2 api waiting for the concurrency limit', registry=registry)
+
+upstream_rejected_requests = Counter('icinga2_exporter_upstream_rejected_requests',
+                                     'Requests to the icinga2 api rejected by the concurrency limit by reason '
+                                     '(queue_full, queue_timeout)', ['reason'], registry=registry)
+
+upstream_endpoint_request_seconds = Histogram('icinga2_exporter_upstream_endpoint_request_seconds',
+                                              'Seconds of the successful requests to each icinga2 api endpoint',
+                                              ['upstream'], buckets=STAGE_BUCKETS, registry=registry)
+
+upstream_endpoint_errors = Counter('icinga2_exporter_upstream_endpoint_errors',
+                                   'Failed requests to each icinga2 api endpoint by type (timeout, connect, status)',
+                                   ['upstream', 'type'], registry=registry)
+
+upstream_endpoint_health = Gauge('icinga2_exporter_upstream_endpoint_health',
+                                 'The health of each icinga2 api endpoint, from 0 when all recent requests failed '
+                                 'to 1 when all succeeded', ['upstream'], registry=registry)
+
+upstream_retries = Counter('icinga2_exporter_upstream_retries',
+                           'Requests to the icinga2 api retried after a failure', registry=registry)
+
+upstream_hedged_requests = Counter('icinga2_exporter_upstream_hedged_requests',
+                                   'Requests to the icinga2 api hedged with a request to another endpoint, by the '
+                                   'request that answered first (primary, hedge)', ['winner'], registry=registry)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+import struct
+from typing import Any, Dict, Iterable, List, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE
+
+TEXT = 'text'
+OPENMETRICS = 'openmetrics'
+PROTOBUF = 'protobuf'
+
+PROTOBUF_CONTENT_TYPE = 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; ' \
+                        'encoding=delimited'
+
+# The formats in order of preference when accepted with the same quality
+FORMATS = [PROTOBUF, OPENMETRICS, TEXT]
+
+CONTENT_TYPES = {TEXT: CONTENT_TYPE_LATEST, OPENMETRICS: OPENMETRICS_CONTENT_TYPE, PROTOBUF: PROTOBUF_CONTENT_TYPE}
+
+# The metric types of io.prometheus.client.MetricType, and the field of the value in io.prometheus.client.Metric
+PROTOBUF_TYPES = {'counter': (0, 3), 'gauge': (1, 2), 'untyped': (3, 5)}
+
+SMALL_VARINTS = [bytes((value,)) for value in range(0x80)]
+
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def negotiate(accept: str, formats: Iterable[str]) -> str:
+    """
+    Select the exposition format from the Accept header of the request. The text format is used if none of the
+    enabled formats are accepted.
+    :param accept: the Accept header
+    :param formats: the enabled formats
+    :return:
+    """
+    qualities = {}
+    for media_range in accept.split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        params = dict(param.split('=', 1) for param in params if '=' in param)
+        try:
+            quality = float(params.get('q', 1.0))
+        except ValueError:
+            continue
+
+        if media_type == 'application/vnd.google.protobuf':
+            if params.get('proto') != 'io.prometheus.client.MetricFamily' or params.get('encoding') != 'delimited':
+                continue
+            exposition_format = PROTOBUF
+        elif media_type == 'application/openmetrics-text':
+            exposition_format = OPENMETRICS
+        elif media_type in ('text/plain', 'text/*', '*/*'):
+            exposition_format = TEXT
+        else:
+            continue
+        qualities[exposition_format] = max(quality, qualities.get(exposition_format, 0.0))
+
+    best = TEXT
+    best_quality = 0.0
+    for exposition_format in FORMATS:
+        if exposition_format != TEXT and exposition_format not in formats:
+            continue
+        if qualities.get(exposition_format, 0.0) > best_quality:
+            best = exposition_format
+            best_quality = qualities[exposition_format]
+    return best
+
+
+def content_type(exposition_format: str) -> str:
+    return CONTENT_TYPES[exposition_format]
+
+
+def render(families: Iterable[Tuple[str, str, str, List[Tuple[str, Any]]]], exposition_format: str):
+    """
+    Render the metric families in the OpenMetrics text or protobuf format
+    :param families: the name, type, help and the labels and value of the samples of each family
+    :param exposition_format:
+    :return: the body, str for OpenMetrics and bytes for protobuf
+    """
+    if exposition_format == PROTOBUF:
+        return b''.join(protobuf_families(families))
+    return ''.join(openmetrics_lines(families))
+
+
+def append(body, families: Iterable[Tuple[str, str, str, List[Tuple[str, Any]]]], exposition_format: str):
+    """
+    Append metric families to a rendered body
+    :param body: the body rendered in the exposition format
+    :param families: the name, type, help and the labels and value of the samples of each family
+    :param exposition_format:
+    :return: the body with the families
+    """
+    if exposition_format == TEXT:
+        return body + ''.join(f"{name}{{{labels}}} {value}\n" for name, _, _, samples in families
+                              for labels, value in samples)
+    if exposition_format == OPENMETRICS and body.endswith("# EOF\n"):
+        body = body[:-len("# EOF\n")]
+    return body + render(families, exposition_format)
+
+
+def openmetrics_lines(families: Iterable[Tuple[str, str, str, List[Tuple[str, Any]]]]) -> Iterable[str]:
+    """
+    Render the metric families in the OpenMetrics text format. A counter family must have the _total suffix
+    on the sample names, since the metric names are kept as is counters without the suffix are typed unknown.
+    :param families:
+    :return:
+    """
+    for name, metric_type, help_text, samples in families:
+        family = name
+        if metric_type == 'counter':
+            if name.endswith('_total'):
+                family = name[:-len('_total')]
+            else:
+                metric_type = 'unknown'
+        elif metric_type == 'untyped':
+            metric_type = 'unknown'
+
+        yield f"# TYPE {family} {metric_type}\n"
+        if help_text:
+            yield f"# HELP {family} {escape_help(help_text)}\n"
+        for labels, value in samples:
+            if not is_number(value):
+                continue
+            if labels:
+                # OpenMetrics do not allow spaces between the labels
+                labels = labels.replace('", ', '",')
+                yield f"{name}{{{labels}}} {value}\n"
+            else:
+                yield f"{name} {value}\n"
+    yield "# EOF\n"
+
+
+def protobuf_families(families: Iterable[Tuple[str, str, str, List[Tuple[str, Any]]]]) -> Iterable[bytes]:
+    """
+    Encode the metric families as length delimited io.prometheus.client.MetricFamily messages
+    :param families:
+    :return:
+    """
+    label_pairs: Dict[str, bytes] = {}
+    label_pair: Dict[Tuple[str, str], bytes] = {}
+    for name, metric_type, help_text, samples in families:
+        type_number, value_field = PROTOBUF_TYPES.get(metric_type, PROTOBUF_TYPES['untyped'])
+        # The value message of a metric is the tag and length of the value field and the tag of the double
+        value_prefix = bytes((value_field << 3 | 2, 9, 0x09))
+        metrics = []
+        for labels, value in samples:
+            if not is_number(value):
+                continue
+            # The labels are shared by the samples of a service, so each labels string is only encoded once
+            pairs = label_pairs.get(labels)
+            if pairs is None:
+                encoded = []
+                for label in LABEL_RE.findall(labels):
+                    pair = label_pair.get(label)
+                    if pair is None:
+                        pair = protobuf_field(1, protobuf_field(1, label[0].encode('utf-8')) +
+                                              protobuf_field(2, unescape(label[1]).encode('utf-8')))
+                        label_pair[label] = pair
+                    encoded.append(pair)
+                pairs = b''.join(encoded)
+                label_pairs[labels] = pairs
+            metrics.append(protobuf_field(4, pairs + value_prefix + struct.pack('<d', float(value))))
+
+        message = protobuf_field(1, name.encode('utf-8'))
+        if help_text:
+            message += protobuf_field(2, help_text.encode('utf-8'))
+        message += b'\x18' + varint(type_number) + b''.join(metrics)
+        yield varint(len(message)) + message
+
+
+def protobuf_field(number: int, data: bytes) -> bytes:
+    """
+    Encode a length delimited field
+    :param number:
+    :param data:
+    :return:
+    """
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+def varint(value: int) -> bytes:
+    if value < 0x80:
+        return SMALL_VARINTS[value]
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def is_number(value: Any) -> bool:
+    return type(value) in (int, float)
+
+
+def unescape(label_value: str) -> str:
+    return label_value.replace('\\\\', '\\')
+
+
+def escape_help(help_text: str) -> str:
+    return help_text.replace('\\', '\\\\').replace('\n', '\\n')
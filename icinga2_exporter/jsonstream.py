@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import codecs
+import json
+import re
+import time
+from typing import Any, AsyncIterator, Dict
+
+from aiohttp import StreamReader
+
+import icinga2_exporter.exportermetrics as exportermetrics
+
+RESULTS_START = re.compile(r'"results"\s*:\s*\[')
+SEPARATORS = ' \t\n\r,'
+
+
+async def iter_results(content: StreamReader, chunk_size: int = 64 * 1024) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Decode the objects in the results array of an icinga2 response one at a time as they are read from the
+    stream. Only the object being decoded and the rest of the last read chunk is kept in memory.
+    :param content: the response stream
+    :param chunk_size: bytes to read at a time
+    :return:
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    eof = False
+    # The time spent decoding, observed when the results are decoded or the iteration is stopped
+    decode_seconds = 0.0
+
+    try:
+        # Skip to the start of the results array
+        while True:
+            match = RESULTS_START.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            if eof:
+                return
+            chunk = await content.read(chunk_size)
+            eof = not chunk
+            start_time = time.monotonic()
+            # Keep the end of the buffer in case "results" is split between chunks
+            buffer = buffer[-32:] + utf8.decode(chunk, final=eof)
+            decode_seconds += time.monotonic() - start_time
+
+        position = 0
+        while True:
+            start_time = time.monotonic()
+            while position < len(buffer) and buffer[position] in SEPARATORS:
+                position += 1
+
+            if position < len(buffer):
+                if buffer[position] == ']':
+                    decode_seconds += time.monotonic() - start_time
+                    return
+                try:
+                    result, position = decoder.raw_decode(buffer, position)
+                    decode_seconds += time.monotonic() - start_time
+                    yield result
+                    continue
+                except json.JSONDecodeError:
+                    # The object is not complete, read more
+                    if eof:
+                        raise
+
+            if eof:
+                raise json.JSONDecodeError('Unterminated results array', buffer, position)
+            decode_seconds += time.monotonic() - start_time
+            chunk = await content.read(chunk_size)
+            eof = not chunk
+            start_time = time.monotonic()
+            buffer = buffer[position:] + utf8.decode(chunk, final=eof)
+            position = 0
+            decode_seconds += time.monotonic() - start_time
+    finally:
+        exportermetrics.json_decode_seconds.observe(decode_seconds)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+# Max number of custom var names whose label names are kept
+MAX_LABEL_NAMES = 10000
+
+
+class LabelPlan:
+    """
+    The labels of the host custom vars and perfnames, compiled once from the configuration. All host custom vars
+    are labels, unless limited by allowed_host_custom_vars. The label name is the lower case name of the custom var
+    unless renamed in host_custom_vars. Values that are not strings, like the complex dict structures custom vars
+    can have in icinga2, are not rendered.
+
+    The labels of a service or host are rendered as the static labels of the object, like hostname and service,
+    followed by the custom var labels as a suffix. The suffix is the same for all objects of a host, so it is
+    rendered once and reused as long as the custom vars are unchanged.
+    """
+
+    def __init__(self, custom_var_labels: Dict[str, str], perfname_to_label: Dict[str, Dict[str, str]],
+                 allowed_custom_vars: Optional[List[str]] = None):
+        # The configured label names by the lower case name of the custom var
+        self.renames = {custom_var.lower(): label_name for custom_var, label_name in custom_var_labels.items()}
+        # The lower case names of the custom vars added as labels, None if all
+        self.allowed_custom_vars = None
+        if allowed_custom_vars is not None:
+            self.allowed_custom_vars = {custom_var.lower() for custom_var in allowed_custom_vars}
+        # The label name of the perfname by check command, for the check commands in perfnametolabel
+        self.perfname_labels = {check_command: config['label_name'].lower()
+                                for check_command, config in perfname_to_label.items()}
+        # The label names by custom var name, added as the custom vars are seen
+        self.label_names: Dict[str, str] = {}
+
+    def label_name(self, custom_var: str) -> str:
+        """
+        Get the label name of a custom var
+        :param custom_var:
+        :return: the label name, or empty if the custom var is not allowed as a label
+        """
+        label_name = self.label_names.get(custom_var)
+        if label_name is None:
+            label_name = custom_var.lower()
+            if self.allowed_custom_vars is not None and label_name not in self.allowed_custom_vars:
+                label_name = ''
+            else:
+                label_name = self.renames.get(label_name, label_name)
+            if len(self.label_names) < MAX_LABEL_NAMES:
+                self.label_names[custom_var] = label_name
+        return label_name
+
+    def custom_labels(self, custom_vars: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], str]:
+        """
+        Get the labels of the host custom vars
+        :param custom_vars: the custom vars of the host
+        :return: the labels by label name and the labels rendered as a suffix of a labels string, like
+        , label1="value1", ...
+        """
+        labels = {}
+        if custom_vars:
+            for custom_var, value in custom_vars.items():
+                label_name = self.label_name(custom_var)
+                if label_name:
+                    labels[label_name] = escape_value(value)
+        suffix = ''.join([f', {label_name}="{value}"' for label_name, value in labels.items() if type(value) is str])
+        return labels, suffix
+
+
+class ObjectLabels:
+    """
+    The label renderer of a scrape. The custom var labels of the latest host are kept, so the services of a host
+    only render the static labels.
+    """
+
+    def __init__(self, plan: LabelPlan):
+        self.plan = plan
+        self.custom_vars = None
+        self.custom_labels: Tuple[Dict[str, Any], str] = ({}, '')
+
+    def labels(self, static_labels: Dict[str, Any], custom_vars: Optional[Dict[str, Any]]) -> Tuple[dict, str]:
+        """
+        Get the labels of a service or host, the custom var labels replace static labels with the same name
+        :param static_labels: the labels of the object, like hostname and service, with escaped values
+        :param custom_vars: the custom vars of the host
+        :return: the labels by label name and the rendered labels string
+        """
+        if custom_vars is not self.custom_vars and custom_vars != self.custom_vars:
+            self.custom_vars = custom_vars
+            self.custom_labels = self.plan.custom_labels(custom_vars)
+        custom_labels, suffix = self.custom_labels
+
+        labels = dict(static_labels)
+        labels.update(custom_labels)
+        if not custom_labels.keys().isdisjoint(static_labels):
+            return labels, labels_string(labels)
+
+        prefix = labels_string(static_labels)
+        if prefix:
+            return labels, prefix + suffix
+        return labels, suffix[2:]
+
+
+def labels_string(labels: Dict[str, Any]) -> str:
+    """
+    Create a comma separated string of
+    labels1=value1, ....
+    Only labels with string values are rendered
+    :param labels:
+    :return:
+    """
+    return ', '.join([f'{label_name}="{value}"' for label_name, value in labels.items() if type(value) is str])
+
+
+def escape_value(value: Any) -> Any:
+    # Quote backslash if it's a str
+    if isinstance(value, str) and '\\' in value:
+        value = value.replace('\\', '\\\\')
+
+    return value
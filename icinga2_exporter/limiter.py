@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import collections
+import contextlib
+import time
+from typing import AsyncIterator, Deque
+
+import icinga2_exporter.exportermetrics as exportermetrics
+
+
+class LimitExceeded(Exception):
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+class AdaptiveLimiter:
+    """
+    Limit the number of concurrent requests with a limit adapted by AIMD, additive increase and multiplicative
+    decrease. The limit increase by one per limit requests completed in time while the limit is reached, and
+    decrease by the backoff factor when a request times out or is slower than the latency threshold.
+
+    Requests over the limit wait in a bounded queue, first in first out. A request is rejected with LimitExceeded
+    if the queue is full or it has waited longer than the queue timeout.
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int, queue_size: int, queue_timeout: float,
+                 latency_threshold: float, backoff: float = 0.9):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.latency_threshold = latency_threshold
+        self.backoff = backoff
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = collections.deque()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, latency_threshold: float = None) -> AsyncIterator[None]:
+        """
+        Hold one of the concurrent requests while the block runs. A block that raise asyncio.TimeoutError
+        decrease the limit, like a block slower than the latency threshold.
+        :param latency_threshold: the latency threshold of the request, defaults to the latency threshold
+        :return:
+        """
+        await self.acquire()
+        start_time = time.monotonic()
+        try:
+            yield
+        except asyncio.TimeoutError:
+            self.release(overloaded=True)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.release(time.monotonic() - start_time, latency_threshold=latency_threshold)
+
+    async def acquire(self):
+        if not self.waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return
+
+        if len(self.waiters) >= self.queue_size:
+            exportermetrics.upstream_rejected_requests.labels('queue_full').inc()
+            raise LimitExceeded('queue_full')
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as err:
+            if waiter.done() and not waiter.cancelled():
+                # The request was handed a slot as the wait ended
+                if isinstance(err, asyncio.TimeoutError):
+                    return
+                self.release()
+                raise
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            if isinstance(err, asyncio.TimeoutError):
+                exportermetrics.upstream_rejected_requests.labels('queue_timeout').inc()
+                raise LimitExceeded('queue_timeout')
+            raise
+
+    def release(self, latency: float = None, overloaded: bool = False, latency_threshold: float = None):
+        """
+        Release a slot and adapt the limit
+        :param latency: the time the slot was held, None if the request failed
+        :param overloaded: True if the request timed out
+        :param latency_threshold: the latency threshold of the request, defaults to the latency threshold
+        :return:
+        """
+        if latency_threshold is None:
+            latency_threshold = self.latency_threshold
+        if overloaded or (latency is not None and latency > latency_threshold):
+            self.limit = max(float(self.min_limit), self.limit * self.backoff)
+        elif latency is not None and (self.waiters or self.in_flight >= int(self.limit)):
+            # Only increase when the limit is reached, an idle limiter would otherwise grow without bound
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+        self.in_flight -= 1
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class Unlimited:
+    """
+    A limiter without limit, used when the concurrency limit is not enabled
+    """
+
+    @contextlib.asynccontextmanager
+    async def slot(self, latency_threshold: float = None) -> AsyncIterator[None]:
+        yield
@@ -19,23 +19,43 @@
 
 """
 import asyncio
-import json
+import ssl
 import time
-from typing import Dict, Any
+from typing import Dict, Any, AsyncIterator, List, Tuple
+from urllib.parse import urlsplit
 
 import aiohttp
 from aiohttp import ClientConnectorError
 
 import icinga2_exporter.log as log
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.jsoncodec as jsoncodec
+import icinga2_exporter.jsonstream as jsonstream
+import icinga2_exporter.perfdatabatch as perfdatabatch
+from icinga2_exporter.cache import LRUCache, SingleFlight
+from icinga2_exporter.labelplan import LabelPlan
+from icinga2_exporter.limiter import AdaptiveLimiter, LimitExceeded, Unlimited
+from icinga2_exporter.snapshot import Snapshot
+from icinga2_exporter.upstream import Endpoint, Endpoints, UpstreamStatusError, backoff
 
 
 class ScrapeExecption(Exception):
+    # The status of the response to the failed scrape
+    status = 500
+
     def __init__(self, message: str, err: Exception, url: str = None):
         self.message = message
         self.err = err
         self.url = url
 
 
+class ScrapeRejected(ScrapeExecption):
+    """
+    The request to icinga2 was rejected by the concurrency limit, icinga2 is overloaded
+    """
+    status = 503
+
+
 class Singleton(type):
     """
     Provide singleton pattern to MonitorConfig. A new instance is only created if:
@@ -54,6 +74,16 @@ class Singleton(type):
 class MonitorConfig(object, metaclass=Singleton):
     config_entry = 'icinga2'
 
+    # Only the attributes used by Perfdata are requested. The service vars are not used, the host vars are joined
+    # since all host custom vars become labels
+    SERVICE_ATTRS = ["__name", "display_name", "check_command", "last_check_result", "host_name",
+                     "downtime_depth", "acknowledgement", "max_check_attempts", "last_reachable", "state",
+                     "state_type"]
+
+    HOST_ATTRS = ["__name", "name", "address", "check_command", "last_check_result", "vars",
+                  "downtime_depth", "acknowledgement", "max_check_attempts", "last_reachable", "state",
+                  "state_type"]
+
     def __init__(self, config=None):
         """
         The constructor takes on single argument that is a config dict
@@ -72,6 +102,57 @@ class MonitorConfig(object, metaclass=Singleton):
         self.perfname_to_label = []
         self.host_check_service_name = 'alive'
         self.enable_scrape_thresholds = False
+        self.enable_perfdata_ranges = False
+        self.max_connections_per_host = 10
+        self.keepalive_timeout = 60
+        self.dns_cache_ttl = 300
+        self.ssl_context = False
+        self.session = None
+        self.upstream_requests = SingleFlight()
+        self.enable_bulk_scrape = False
+        self.bulk_refresh_interval = 30
+        self.bulk_timeout = 60
+        self.snapshot = None
+        # The events received while the snapshot is fetched, replayed on the new snapshot
+        self.snapshot_events = None
+        self.snapshot_task = None
+        self.enable_event_stream = False
+        self.event_stream_queue = 'icinga2-exporter'
+        self.event_stream_reconnect_interval = 5
+        self.event_stream_resync_interval = 300
+        self.event_stream_idle_timeout = 300
+        self.enable_streaming_decode = False
+        self.enable_batch_filter = False
+        self.metric_name_cache_size = 10000
+        self.perfdata_cache_size = 50000
+        self.response_cache_ttl = 0
+        self.response_cache_size = 10000
+        self.response_cache_max_bytes = 64 * 1024 * 1024
+        self.stale_response_ttl = 0
+        self.stale_response_timeout = 0
+        self.stale_response_cache_size = 10000
+        self.stale_response_cache_max_bytes = 64 * 1024 * 1024
+        self.enable_compression = True
+        self.compression_min_size = 1024
+        self.compression_level = 6
+        self.zstd_compression_level = 3
+        self.exposition_formats = ['text']
+        self.max_series_per_target = 0
+        self.max_series_per_family = 0
+        self.allowed_host_custom_vars = None
+        self.enable_concurrency_limit = False
+        self.concurrency_limit = 10
+        self.min_concurrency_limit = 1
+        self.max_concurrency_limit = 100
+        self.concurrency_queue_size = 100
+        self.concurrency_queue_timeout = 1.0
+        self.concurrency_latency_threshold = None
+        self.urls = []
+        self.retry_backoff = 0.1
+        self.retry_backoff_max = 1.0
+        self.enable_hedging = False
+        self.hedge_quantile = 0.95
+        self.scrape_timeout_offset = 0.5
 
         if config:
             self.user = config[MonitorConfig.config_entry]['user']
@@ -85,6 +166,8 @@ class MonitorConfig(object, metaclass=Singleton):
                 self.perfname_to_label = config[MonitorConfig.config_entry]['perfnametolabel']
             if 'timeout' in config[MonitorConfig.config_entry]:
                 self.timeout = int(config[MonitorConfig.config_entry]['timeout'])
+            if 'retries' in config[MonitorConfig.config_entry]:
+                self.retries = int(config[MonitorConfig.config_entry]['retries'])
             if 'verify' in config[MonitorConfig.config_entry]:
                 self.verify = bool(config[MonitorConfig.config_entry]['verify'])
             if 'enable_scrape_metadata' in config[MonitorConfig.config_entry]:
@@ -93,16 +176,162 @@ class MonitorConfig(object, metaclass=Singleton):
                 self.host_check_service_name = config[MonitorConfig.config_entry]['host_check_service_name']
             if 'enable_scrape_thresholds' in config[MonitorConfig.config_entry]:
                 self.enable_scrape_thresholds = bool(config[MonitorConfig.config_entry]['enable_scrape_thresholds'])
+            if 'enable_perfdata_ranges' in config[MonitorConfig.config_entry]:
+                self.enable_perfdata_ranges = bool(config[MonitorConfig.config_entry]['enable_perfdata_ranges'])
+            if 'max_connections_per_host' in config[MonitorConfig.config_entry]:
+                self.max_connections_per_host = int(config[MonitorConfig.config_entry]['max_connections_per_host'])
+            if 'keepalive_timeout' in config[MonitorConfig.config_entry]:
+                self.keepalive_timeout = int(config[MonitorConfig.config_entry]['keepalive_timeout'])
+            if 'dns_cache_ttl' in config[MonitorConfig.config_entry]:
+                self.dns_cache_ttl = int(config[MonitorConfig.config_entry]['dns_cache_ttl'])
+            if 'enable_bulk_scrape' in config[MonitorConfig.config_entry]:
+                self.enable_bulk_scrape = bool(config[MonitorConfig.config_entry]['enable_bulk_scrape'])
+            if 'bulk_refresh_interval' in config[MonitorConfig.config_entry]:
+                self.bulk_refresh_interval = int(config[MonitorConfig.config_entry]['bulk_refresh_interval'])
+            if 'bulk_timeout' in config[MonitorConfig.config_entry]:
+                self.bulk_timeout = int(config[MonitorConfig.config_entry]['bulk_timeout'])
+            if 'enable_event_stream' in config[MonitorConfig.config_entry]:
+                self.enable_event_stream = bool(config[MonitorConfig.config_entry]['enable_event_stream'])
+            if 'event_stream_queue' in config[MonitorConfig.config_entry]:
+                self.event_stream_queue = config[MonitorConfig.config_entry]['event_stream_queue']
+            if 'event_stream_reconnect_interval' in config[MonitorConfig.config_entry]:
+                self.event_stream_reconnect_interval = \
+                    int(config[MonitorConfig.config_entry]['event_stream_reconnect_interval'])
+            if 'event_stream_resync_interval' in config[MonitorConfig.config_entry]:
+                self.event_stream_resync_interval = \
+                    float(config[MonitorConfig.config_entry]['event_stream_resync_interval'])
+            if 'event_stream_idle_timeout' in config[MonitorConfig.config_entry]:
+                self.event_stream_idle_timeout = float(config[MonitorConfig.config_entry]['event_stream_idle_timeout'])
+            if 'enable_streaming_decode' in config[MonitorConfig.config_entry]:
+                self.enable_streaming_decode = bool(config[MonitorConfig.config_entry]['enable_streaming_decode'])
+            if 'enable_batch_filter' in config[MonitorConfig.config_entry]:
+                self.enable_batch_filter = bool(config[MonitorConfig.config_entry]['enable_batch_filter'])
+            if 'metric_name_cache_size' in config[MonitorConfig.config_entry]:
+                self.metric_name_cache_size = int(config[MonitorConfig.config_entry]['metric_name_cache_size'])
+            if 'perfdata_cache_size' in config[MonitorConfig.config_entry]:
+                self.perfdata_cache_size = int(config[MonitorConfig.config_entry]['perfdata_cache_size'])
+            if 'response_cache_ttl' in config[MonitorConfig.config_entry]:
+                self.response_cache_ttl = float(config[MonitorConfig.config_entry]['response_cache_ttl'])
+            if 'response_cache_size' in config[MonitorConfig.config_entry]:
+                self.response_cache_size = int(config[MonitorConfig.config_entry]['response_cache_size'])
+            if 'response_cache_max_bytes' in config[MonitorConfig.config_entry]:
+                self.response_cache_max_bytes = int(config[MonitorConfig.config_entry]['response_cache_max_bytes'])
+            if 'stale_response_ttl' in config[MonitorConfig.config_entry]:
+                self.stale_response_ttl = float(config[MonitorConfig.config_entry]['stale_response_ttl'])
+            if 'stale_response_timeout' in config[MonitorConfig.config_entry]:
+                self.stale_response_timeout = float(config[MonitorConfig.config_entry]['stale_response_timeout'])
+            if 'stale_response_cache_size' in config[MonitorConfig.config_entry]:
+                self.stale_response_cache_size = int(config[MonitorConfig.config_entry]['stale_response_cache_size'])
+            if 'stale_response_cache_max_bytes' in config[MonitorConfig.config_entry]:
+                self.stale_response_cache_max_bytes = int(
+                    config[MonitorConfig.config_entry]['stale_response_cache_max_bytes'])
+            if 'enable_compression' in config[MonitorConfig.config_entry]:
+                self.enable_compression = bool(config[MonitorConfig.config_entry]['enable_compression'])
+            if 'compression_min_size' in config[MonitorConfig.config_entry]:
+                self.compression_min_size = int(config[MonitorConfig.config_entry]['compression_min_size'])
+            if 'compression_level' in config[MonitorConfig.config_entry]:
+                self.compression_level = int(config[MonitorConfig.config_entry]['compression_level'])
+            if 'zstd_compression_level' in config[MonitorConfig.config_entry]:
+                self.zstd_compression_level = int(config[MonitorConfig.config_entry]['zstd_compression_level'])
+            if 'exposition_formats' in config[MonitorConfig.config_entry]:
+                self.exposition_formats = config[MonitorConfig.config_entry]['exposition_formats']
+            if 'max_series_per_target' in config[MonitorConfig.config_entry]:
+                self.max_series_per_target = int(config[MonitorConfig.config_entry]['max_series_per_target'])
+            if 'max_series_per_family' in config[MonitorConfig.config_entry]:
+                self.max_series_per_family = int(config[MonitorConfig.config_entry]['max_series_per_family'])
+            if 'allowed_host_custom_vars' in config[MonitorConfig.config_entry]:
+                self.allowed_host_custom_vars = config[MonitorConfig.config_entry]['allowed_host_custom_vars']
+            if 'enable_concurrency_limit' in config[MonitorConfig.config_entry]:
+                self.enable_concurrency_limit = bool(config[MonitorConfig.config_entry]['enable_concurrency_limit'])
+            if 'concurrency_limit' in config[MonitorConfig.config_entry]:
+                self.concurrency_limit = int(config[MonitorConfig.config_entry]['concurrency_limit'])
+            if 'min_concurrency_limit' in config[MonitorConfig.config_entry]:
+                self.min_concurrency_limit = int(config[MonitorConfig.config_entry]['min_concurrency_limit'])
+            if 'max_concurrency_limit' in config[MonitorConfig.config_entry]:
+                self.max_concurrency_limit = int(config[MonitorConfig.config_entry]['max_concurrency_limit'])
+            if 'concurrency_queue_size' in config[MonitorConfig.config_entry]:
+                self.concurrency_queue_size = int(config[MonitorConfig.config_entry]['concurrency_queue_size'])
+            if 'concurrency_queue_timeout' in config[MonitorConfig.config_entry]:
+                self.concurrency_queue_timeout = float(config[MonitorConfig.config_entry]['concurrency_queue_timeout'])
+            if 'concurrency_latency_threshold' in config[MonitorConfig.config_entry]:
+                self.concurrency_latency_threshold = float(
+                    config[MonitorConfig.config_entry]['concurrency_latency_threshold'])
+            if 'urls' in config[MonitorConfig.config_entry]:
+                self.urls = config[MonitorConfig.config_entry]['urls']
+            if 'retry_backoff' in config[MonitorConfig.config_entry]:
+                self.retry_backoff = float(config[MonitorConfig.config_entry]['retry_backoff'])
+            if 'retry_backoff_max' in config[MonitorConfig.config_entry]:
+                self.retry_backoff_max = float(config[MonitorConfig.config_entry]['retry_backoff_max'])
+            if 'enable_hedging' in config[MonitorConfig.config_entry]:
+                self.enable_hedging = bool(config[MonitorConfig.config_entry]['enable_hedging'])
+            if 'hedge_quantile' in config[MonitorConfig.config_entry]:
+                self.hedge_quantile = float(config[MonitorConfig.config_entry]['hedge_quantile'])
+            if 'scrape_timeout_offset' in config[MonitorConfig.config_entry]:
+                self.scrape_timeout_offset = float(config[MonitorConfig.config_entry]['scrape_timeout_offset'])
+
+            # Build the ssl context once so it is shared by all connections to icinga2
+            if self.verify:
+                self.ssl_context = ssl.create_default_context()
 
             self.url_query_service_perfdata = self.host + '/v1/objects/services'
             self.url_query_host_metadata = self.host + '/v1/objects/hosts/{hostname}'
+            self.url_query_hosts = self.host + '/v1/objects/hosts'
+            self.url_events = self.host + '/v1/events'
+
+        # The label names of the host custom vars, compiled with the perfname labels into the label plan
+        self.custom_var_labels = {}
+        for label in self.labels:
+            for custom_var, value in label.items():
+                for prom_label in value.values():
+                    self.custom_var_labels[custom_var] = prom_label
+        self.label_plan = LabelPlan(self.custom_var_labels, self.perfname_to_label or {},
+                                    self.allowed_host_custom_vars)
+
+        # The concurrency limit of the requests to icinga2, by default a request slower than half the timeout
+        # decrease the limit
+        self.upstream_limiter = Unlimited()
+        if self.enable_concurrency_limit:
+            if self.concurrency_latency_threshold is None:
+                self.concurrency_latency_threshold = self.timeout / 2
+            self.upstream_limiter = AdaptiveLimiter(self.concurrency_limit, self.min_concurrency_limit,
+                                                    self.max_concurrency_limit, self.concurrency_queue_size,
+                                                    self.concurrency_queue_timeout, self.concurrency_latency_threshold)
+            limiter = self.upstream_limiter
+            exportermetrics.upstream_concurrency_limit.set_function(lambda: int(limiter.limit))
+            exportermetrics.upstream_in_flight_requests.set_function(lambda: limiter.in_flight)
+            exportermetrics.upstream_queued_requests.set_function(lambda: len(limiter.waiters))
+
+        # The url is the primary endpoint, the queries are rebased on the endpoint selected for each request
+        self.endpoints = Endpoints([self.host] + [url for url in self.urls if url != self.host])
+
+        self.metric_name_cache = LRUCache('metric_name', self.metric_name_cache_size)
+        self.perfdata_cache = LRUCache('perfdata', self.perfdata_cache_size)
+        # The range-aware parser return the items as tuples, so they are not cached with the parsed dicts
+        self.perfdata_range_cache = LRUCache('perfdata_range', self.perfdata_cache_size)
+        self.response_cache = LRUCache('response', self.response_cache_size, self.response_cache_max_bytes)
+        # The last good response of each target, only kept if stale responses are enabled
+        self.stale_response_cache = LRUCache('stale_response',
+                                             self.stale_response_cache_size if self.stale_response_ttl > 0 else 0,
+                                             self.stale_response_cache_max_bytes)
 
     def get_enable_scrape_thresholds(self):
         return self.enable_scrape_thresholds
 
+    def get_enable_perfdata_ranges(self):
+        return self.enable_perfdata_ranges
+
     def get_enable_scrape_metadata(self):
         return self.enable_scrape_metadata
 
+    def get_enable_bulk_scrape(self):
+        return self.enable_bulk_scrape
+
+    def get_enable_event_stream(self):
+        return self.enable_event_stream
+
+    def get_enable_batch_filter(self):
+        return self.enable_batch_filter
+
     def get_user(self):
         return self.user
 
@@ -128,71 +357,678 @@ class MonitorConfig(object, metaclass=Singleton):
         return self.host_check_service_name
 
     def get_labels(self):
-        labeldict = {}
+        return self.custom_var_labels
 
-        for label in self.labels:
-            for custom_var, value in label.items():
-                for key, prom_label in value.items():
-                    labeldict.update({custom_var: prom_label})
-        return labeldict
+    def get_label_plan(self) -> LabelPlan:
+        return self.label_plan
+
+    def get_max_series_per_target(self) -> int:
+        return self.max_series_per_target
+
+    def get_max_series_per_family(self) -> int:
+        return self.max_series_per_family
 
     def get_perfname_to_label(self):
         return self.perfname_to_label
 
-    async def async_get_service_data(self, hostname) -> Dict[str, Any]:
+    def get_metric_name_cache(self):
+        return self.metric_name_cache
+
+    def get_perfdata_cache(self):
+        return self.perfdata_cache
+
+    def get_perfdata_range_cache(self):
+        return self.perfdata_range_cache
+
+    def get_response_cache(self):
+        return self.response_cache
+
+    def get_response_cache_ttl(self):
+        return self.response_cache_ttl
+
+    def get_stale_response_cache(self):
+        return self.stale_response_cache
+
+    def get_stale_response_ttl(self):
+        return self.stale_response_ttl
+
+    def get_stale_response_timeout(self):
+        return self.stale_response_timeout
+
+    def get_enable_compression(self):
+        return self.enable_compression
+
+    def get_compression_min_size(self):
+        return self.compression_min_size
+
+    def get_compression_level(self, encoding):
+        if encoding == 'zstd':
+            return self.zstd_compression_level
+        return self.compression_level
+
+    def get_exposition_formats(self):
+        return self.exposition_formats
+
+    def get_scrape_timeout_offset(self):
+        return self.scrape_timeout_offset
+
+    def get_last_check_time(self, hostname):
+        """
+        Get the time of the latest check result of the hostname if known without a request to icinga2
+        :param hostname:
+        :return: the time or None if not known
+        """
+        if self.snapshot is not None:
+            return self.snapshot.last_check_time(hostname)
+        return None
+
+    async def async_get_service_data(self, hostname, deadline: float = None) -> Dict[str, Any]:
         """
         Get the meta and performance data for all services on a hostname
         :param hostname:
+        :param deadline: optional time.monotonic() the request must be done by
         :return:
         """
-        body = {"joins": ["host.vars"],
-                "attrs": ["__name", "display_name", "check_command", "last_check_result", "vars", "host_name",
-                          "downtime_depth", "acknowledgement", "max_check_attempts", "last_reachable", "state",
-                          "state_type"],
-                "filter": 'match(\"{}\",service.host_name)'.format(hostname)}
+        if self.snapshot is not None:
+            return self.snapshot.get_service_data(hostname)
 
-        data_json = await self.async_post(self.url_query_service_perfdata, body)
+        data_json = await self.async_post(self.url_query_service_perfdata, self.service_query(hostname),
+                                          deadline=deadline)
 
         if not data_json:
             log.warn('Received no perfdata from Icinga2')
 
         return data_json
 
-    async def async_get_host_data(self, hostname) -> Dict[str, Any]:
+    async def async_iter_service_data(self, hostname, deadline: float = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Get the meta and performance data for all services on a hostname, one service at a time. If streaming
+        decode is enabled each service is decoded from the response as it is received.
+        :param hostname:
+        :param deadline: optional time.monotonic() the request must be done by
+        :return:
+        """
+        if self.snapshot is not None or not self.enable_streaming_decode:
+            data_json = await self.async_get_service_data(hostname, deadline)
+            for service_attrs in data_json.get('results', []):
+                yield service_attrs
+            return
+
+        services = self.async_post_stream(self.url_query_service_perfdata, self.service_query(hostname),
+                                          deadline=deadline)
+        try:
+            async for service_attrs in services:
+                yield service_attrs
+        finally:
+            # Close the response now if the caller stops early, like when the scrape deadline is passed
+            await services.aclose()
+
+    @staticmethod
+    def service_query(hostname) -> Dict[str, Any]:
+        """
+        Build the body of the services query for a hostname
+        :param hostname:
+        :return:
+        """
+        if Snapshot.is_pattern(hostname):
+            # match() is a glob evaluated for every service, only used when the hostname is a pattern
+            host_filter = 'match(target,service.host_name)'
+        else:
+            host_filter = 'service.host_name==target'
+
+        return {"joins": ["host.vars"],
+                "attrs": MonitorConfig.SERVICE_ATTRS,
+                "filter": host_filter,
+                "filter_vars": {"target": hostname}}
+
+    async def async_get_host_data(self, hostname, deadline: float = None) -> Dict[str, Any]:
         """
         Get the host data including the meta and performance data
         :param hostname:
+        :param deadline: optional time.monotonic() the request must be done by
         :return:
         """
+        if self.snapshot is not None:
+            return self.snapshot.get_host_data(hostname)
 
-        data_json = await self.async_post(self.url_query_host_metadata.format(hostname=hostname))
+        data_json = await self.async_post(self.url_query_host_metadata.format(hostname=hostname),
+                                          {"attrs": MonitorConfig.HOST_ATTRS}, deadline=deadline)
 
         if not data_json:
             log.warn('Received no metadata from Icinga2')
 
         return data_json
 
-    async def async_post(self, url, body = None) -> Dict[str, Any]:
+    async def async_get_batch_data(self, targets: List[str] = None, hostgroup: str = None,
+                                   filter_expression: str = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Get the services, and the hosts if metadata is enabled, of many hosts in one request each. The hosts are
+        selected by a list of host names, a hostgroup or an icinga2 filter expression.
+        :param targets:
+        :param hostgroup:
+        :param filter_expression:
+        :return: the services and the hosts
+        """
+        if self.snapshot is not None and targets:
+            services = [service_attrs for target in targets
+                        for service_attrs in self.snapshot.get_service_data(target)['results']]
+            hosts = [host_attrs for target in targets for host_attrs in self.snapshot.get_host_data(target)['results']]
+            return {'results': services}, {'results': hosts}
+
+        service_body, host_body = MonitorConfig.batch_query(targets, hostgroup, filter_expression)
+
+        services_json = await self.async_post(self.url_query_service_perfdata, service_body,
+                                              timeout=self.bulk_timeout)
+        if not services_json:
+            log.warn('Received no perfdata from Icinga2')
+
+        hosts_json = {}
+        if self.enable_scrape_metadata:
+            hosts_json = await self.async_post(self.url_query_hosts, host_body, timeout=self.bulk_timeout)
+
+        return services_json, hosts_json
+
+    @staticmethod
+    def batch_query(targets: List[str] = None, hostgroup: str = None,
+                    filter_expression: str = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Build the body of the services and the hosts query of a batch
+        :param targets:
+        :param hostgroup:
+        :param filter_expression: used as is for both queries, so it must only use host attributes
+        :return:
+        """
+        if targets:
+            service_filter, host_filter = 'service.host_name in targets', 'host.name in targets'
+            filter_vars = {'targets': targets}
+        elif hostgroup:
+            service_filter, host_filter = 'hostgroup in host.groups', 'hostgroup in host.groups'
+            filter_vars = {'hostgroup': hostgroup}
+        else:
+            service_filter, host_filter = filter_expression, filter_expression
+            filter_vars = {}
+
+        service_body = {"joins": ["host.vars"], "attrs": MonitorConfig.SERVICE_ATTRS, "filter": service_filter}
+        host_body = {"attrs": MonitorConfig.HOST_ATTRS, "filter": host_filter}
+        if filter_vars:
+            service_body['filter_vars'] = filter_vars
+            host_body['filter_vars'] = filter_vars
+        return service_body, host_body
+
+    def create_session(self) -> aiohttp.ClientSession:
+        """
+        Create a client session with a keep-alive connection pool towards icinga2
+        :return:
+        """
+        connector = aiohttp.TCPConnector(limit_per_host=self.max_connections_per_host,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=self.dns_cache_ttl,
+                                         ssl=self.ssl_context)
+        return aiohttp.ClientSession(connector=connector,
+                                     auth=aiohttp.BasicAuth(self.user, self.passwd),
+                                     headers={'Content-Type': 'application/json',
+                                              'X-HTTP-Method-Override': 'GET'})
+
+    async def open_session(self):
+        """
+        Open the shared session used for all requests to icinga2, called when the app start serving
+        :return:
+        """
+        if self.session is None or self.session.closed:
+            self.session = self.create_session()
+
+            for state in ('open', 'in_use', 'waiting'):
+                exportermetrics.upstream_connections.labels(state).set_function(
+                    lambda state=state: self.get_pool_statistics()[state])
+
+    async def close_session(self):
+        """
+        Close the shared session, called when the app stop serving
+        :return:
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def get_pool_statistics(self) -> Dict[str, int]:
+        """
+        Get the number of connections in the pool that are open, in use by a request and the number of
+        requests waiting for a free connection
+        :return:
+        """
+        stats = {'open': 0, 'in_use': 0, 'waiting': 0}
+        if self.session is None or self.session.closed:
+            return stats
+
+        connector = self.session.connector
+        idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        stats['in_use'] = len(getattr(connector, '_acquired', ()))
+        stats['open'] = idle + stats['in_use']
+        stats['waiting'] = sum(len(waiters) for waiters in getattr(connector, '_waiters', {}).values())
+        return stats
 
+    async def refresh_snapshot(self):
+        """
+        Fetch all services, and hosts if metadata is enabled, in bulk requests and replace the snapshot. The
+        events received from the event stream while fetching are applied to the new snapshot too, unless older
+        than the fetched check results.
+        :return:
+        """
+        start_time = time.monotonic()
+        self.snapshot_events = []
         try:
-            async with aiohttp.ClientSession() as session:
+            services_json = await self.async_post(self.url_query_service_perfdata,
+                                                  {"joins": ["host.vars"], "attrs": MonitorConfig.SERVICE_ATTRS},
+                                                  timeout=self.bulk_timeout)
+            hosts_json = {}
+            if self.enable_scrape_metadata:
+                hosts_json = await self.async_post(self.url_query_hosts, {"attrs": MonitorConfig.HOST_ATTRS},
+                                                   timeout=self.bulk_timeout)
+
+            if not services_json:
+                log.warn('Received no perfdata from Icinga2, keeping current snapshot')
+                return
+
+            snapshot = Snapshot(services_json, hosts_json)
+            for event in self.snapshot_events:
+                snapshot.apply_event(event)
+        finally:
+            self.snapshot_events = None
+
+        self.snapshot = snapshot
+        # Parse the new perfdata of the snapshot in one batch, instead of one at a time when the targets are
+        # scraped. The range-aware parser has no batch version.
+        parsed = 0
+        if not self.enable_perfdata_ranges:
+            parsed = perfdatabatch.cache_perf_strings(self.perfdata_cache,
+                                                      perfdatabatch.perf_strings(services_json.get('results', [])))
+        log.info("snapshot", {'hosts': len(self.snapshot.services), 'parsed_perfdata': parsed,
+                              'refresh_time': time.monotonic() - start_time})
+
+    async def run_snapshot_refresh(self):
+        """
+        Refresh the snapshot every bulk_refresh_interval seconds until cancelled
+        :return:
+        """
+        while True:
+            try:
+                await self.refresh_snapshot()
+            except ScrapeExecption as err:
+                log.warn(f"{err.message}", {'remote_url': err.url, 'err': err.err})
+            await asyncio.sleep(self.bulk_refresh_interval)
+
+    async def run_event_stream(self):
+        """
+        Keep the snapshot up to date from the icinga2 event stream until cancelled. The snapshot is seeded with
+        the bulk requests after the stream is opened, so no event is lost, and seeded again every time the stream
+        is reconnected after a failure, or has been idle longer than the idle timeout.
+        :return:
+        """
+        while True:
+            try:
+                await self.consume_event_stream()
+                log.warn('Event stream closed by Icinga2')
+            except ScrapeExecption as err:
+                log.warn(f"{err.message}", {'remote_url': err.url, 'err': err.err})
+            except aiohttp.ServerTimeoutError as err:
+                log.warn("Event stream idle, reconnecting", {'remote_url': self.url_events, 'err': err})
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                log.warn("Event stream failed", {'remote_url': self.url_events, 'err': err})
+            await asyncio.sleep(self.event_stream_reconnect_interval)
+
+    async def consume_event_stream(self):
+        """
+        Open the event stream, seed the snapshot and apply the events as they arrive. The snapshot is fetched
+        again every resync interval while connected, to add the services and hosts created since seeded.
+        :return:
+        """
+        body = {"types": ["CheckResult", "StateChange"], "queue": self.event_stream_queue}
+        await self.open_session()
+
+        # Events are newline delimited json, a line can be larger than the default buffer for long plugin output
+        async with self.session.post(self.url_events, data=jsoncodec.dumps(body),
+                                     timeout=aiohttp.ClientTimeout(total=None, connect=self.timeout,
+                                                                   sock_read=self.event_stream_idle_timeout),
+                                     read_bufsize=2 ** 20) as response:
+            if response.status != 200:
+                log.warn(f"{response.reason} status {response.status}", {'remote_url': self.url_events})
+                return
+
+            await self.refresh_snapshot()
+            log.info("Event stream connected", {'remote_url': self.url_events})
+            resync_task = asyncio.get_event_loop().create_task(self.run_snapshot_resync())
+            try:
+                async for line in response.content:
+                    if line.strip() and self.snapshot is not None:
+                        event = jsoncodec.loads(line)
+                        self.snapshot.apply_event(event)
+                        if self.snapshot_events is not None:
+                            # A resync is fetching the snapshot that will replace this one
+                            self.snapshot_events.append(event)
+            finally:
+                resync_task.cancel()
+
+    async def run_snapshot_resync(self):
+        """
+        Fetch the snapshot every event stream resync interval until cancelled
+        :return:
+        """
+        while True:
+            await asyncio.sleep(self.event_stream_resync_interval)
+            try:
+                await self.refresh_snapshot()
+            except ScrapeExecption as err:
+                log.warn(f"{err.message}", {'remote_url': err.url, 'err': err.err})
+
+    def start_snapshot_refresh(self):
+        """
+        Start the background task keeping the snapshot up to date, from the event stream if enabled else by bulk
+        requests, called when the app start serving
+        :return:
+        """
+        if self.snapshot_task is None:
+            if self.enable_event_stream:
+                self.snapshot_task = asyncio.get_event_loop().create_task(self.run_event_stream())
+            else:
+                self.snapshot_task = asyncio.get_event_loop().create_task(self.run_snapshot_refresh())
+            exportermetrics.snapshot_age.set_function(
+                lambda: self.snapshot.age() if self.snapshot is not None else float('nan'))
+
+    async def stop_snapshot_refresh(self):
+        """
+        Stop the background task refreshing the snapshot, called when the app stop serving
+        :return:
+        """
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            try:
+                await self.snapshot_task
+            except asyncio.CancelledError:
+                pass
+            self.snapshot_task = None
+
+    async def async_post(self, url, body=None, timeout=None, deadline: float = None) -> Dict[str, Any]:
+        """
+        Post the query to icinga2. Concurrent requests with the same url and body are coalesced into one request
+        to icinga2 and the response is shared, so it must not be modified. A request joining one in flight waits no
+        longer than its own timeout, but fails with the request in flight, e.g. if cut short by the deadline of the
+        request that started it.
+        :param url:
+        :param body:
+        :param timeout: defaults to the configured timeout
+        :param deadline: optional time.monotonic() the request, with retries, must be done by, if before the timeout
+        :return:
+        """
+        # The latency threshold of the concurrency limit is scaled to the timeout of the request, so the slow bulk
+        # requests do not decrease the limit
+        latency_threshold = self.concurrency_latency_threshold
+        if latency_threshold is not None and timeout is not None:
+            latency_threshold = latency_threshold * timeout / self.timeout
+        timeout = self.deadline_timeout(timeout, deadline)
+
+        data = jsoncodec.dumps(body)
+        try:
+            data_json, coalesced = await self.upstream_requests.do(
+                (url, data), lambda: self._async_post_request(url, data, timeout, latency_threshold), timeout)
+        except asyncio.TimeoutError as err:
+            # Only a request joining one in flight, the request to icinga2 raise ScrapeExecption on timeout
+            raise ScrapeExecption(message=f"Timeout after {timeout} sec waiting for the same request in flight",
+                                  err=err, url=self.host)
+        if coalesced:
+            exportermetrics.upstream_coalesced_requests.inc()
+        return data_json
+
+    def deadline_timeout(self, timeout: float = None, deadline: float = None) -> float:
+        """
+        Get the timeout of a request, the timeout or the configured timeout shortened to the deadline
+        :param timeout:
+        :param deadline:
+        :return:
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if deadline is None:
+            return timeout
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ScrapeExecption(message="Scrape deadline exceeded", err=asyncio.TimeoutError(), url=self.host)
+        return min(timeout, remaining)
+
+    async def _async_post_request(self, url, data, timeout, latency_threshold: float = None) -> Dict[str, Any]:
+        try:
+            return await self._async_post_retry(url, data, timeout, latency_threshold)
+        except LimitExceeded as err:
+            raise ScrapeRejected(message=f"Concurrency limit exceeded, {err.reason}", err=err, url=self.host)
+
+    async def _async_post_retry(self, url, data, timeout: float, latency_threshold: float = None) -> Dict[str, Any]:
+        """
+        Post to the endpoints until a request succeeds, retrying a timeout, a connection error or a server error
+        on another endpoint after a jittered backoff. Each attempt gets a share of the timeout, so a slow endpoint
+        does not use it all before the request fails over to another endpoint. The retries stop when the retries
+        are used up or the backoff would pass the timeout.
+        :param url:
+        :param data:
+        :param timeout: the timeout of all attempts
+        :param latency_threshold: the latency threshold of the concurrency limit for each attempt
+        :return:
+        """
+        deadline = time.monotonic() + timeout
+        tried = []
+        attempt = 0
+        while True:
+            endpoint = self.endpoints.select(tried)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                exportermetrics.upstream_errors.labels(self.endpoint(url), 'timeout').inc()
+                raise ScrapeExecption(message=f"Timeout after {timeout} sec", err=asyncio.TimeoutError(),
+                                      url=endpoint.url)
+
+            # The attempts left that can fail over to an endpoint not tried yet share the remaining time
+            untried = len([other for other in self.endpoints.endpoints if other not in tried])
+            shares = max(1, min(self.retries - attempt + 1, untried))
+            try:
+                return await self._async_post_hedged(endpoint, url, data, time.monotonic() + remaining / shares,
+                                                     tried, latency_threshold)
+            except (asyncio.TimeoutError, ClientConnectorError, UpstreamStatusError) as err:
+                delay = backoff(attempt, self.retry_backoff, self.retry_backoff_max)
+                if attempt >= self.retries or time.monotonic() + delay >= deadline:
+                    return self.upstream_error(url, endpoint, err, timeout)
+            exportermetrics.upstream_retries.inc()
+            tried.append(endpoint)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def upstream_error(self, url, endpoint: Endpoint, err: Exception, timeout: float) -> Dict[str, Any]:
+        """
+        Count the error of the last attempt of a request and raise it as a ScrapeExecption, a server error is
+        answered as an empty response
+        :param url:
+        :param endpoint: the endpoint of the last attempt
+        :param err:
+        :param timeout: the timeout of all attempts
+        :return:
+        """
+        if isinstance(err, UpstreamStatusError):
+            exportermetrics.upstream_errors.labels(self.endpoint(url), 'status').inc()
+            log.warn(f"{err.reason} status {err.status}", {'remote_url': endpoint.url})
+            return {}
+        if isinstance(err, asyncio.TimeoutError):
+            exportermetrics.upstream_errors.labels(self.endpoint(url), 'timeout').inc()
+            raise ScrapeExecption(message=f"Timeout after {timeout} sec", err=err, url=endpoint.url)
+        exportermetrics.upstream_errors.labels(self.endpoint(url), 'connect').inc()
+        raise ScrapeExecption(message="Connection error", err=err, url=endpoint.url)
+
+    async def _async_post_hedged(self, endpoint: Endpoint, url, data, deadline: float, tried: List[Endpoint],
+                                 latency_threshold: float = None) -> Dict[str, Any]:
+        """
+        Post to the endpoint, and when hedging is enabled post the same request to another endpoint if no response
+        is received within the hedge quantile of the endpoint latency. The first successful response is used and
+        the other request is cancelled. No hedge is sent if the deadline is before the hedge delay has passed.
+        :param endpoint:
+        :param url:
+        :param data:
+        :param deadline: the time.monotonic() the attempt must be done by
+        :param tried: the endpoints that already failed, not used for the hedge
+        :param latency_threshold:
+        :return:
+        """
+        hedge_delay = endpoint.latency_quantile(self.hedge_quantile) if self.enable_hedging else None
+        if hedge_delay is None or len(self.endpoints) < 2 or deadline - time.monotonic() <= hedge_delay:
+            return await self._async_post_endpoint(endpoint, url, data, deadline, latency_threshold)
+
+        primary = asyncio.ensure_future(self._async_post_endpoint(endpoint, url, data, deadline, latency_threshold))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+            hedge_endpoint = self.endpoints.select(tried + [endpoint])
+            if done or hedge_endpoint is endpoint or time.monotonic() >= deadline:
+                return await primary
+
+            hedge = asyncio.ensure_future(self._async_post_endpoint(hedge_endpoint, url, data, deadline,
+                                                                    latency_threshold))
+            pending.add(hedge)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        exportermetrics.upstream_hedged_requests.labels(
+                            'primary' if task is primary else 'hedge').inc()
+                        return task.result()
+                if not pending:
+                    # Both failed, raise the error of the primary
+                    return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _async_post_endpoint(self, endpoint: Endpoint, url, data, deadline: float,
+                                   latency_threshold: float = None) -> Dict[str, Any]:
+        """
+        Post to the endpoint and update its health. Each attempt holds a slot of the concurrency limit while the
+        request is made, so the latency of the limit is that of the request, without the backoff of retries.
+        :param endpoint:
+        :param url: the url of the primary endpoint
+        :param data:
+        :param deadline: the time.monotonic() the request must be done by
+        :param latency_threshold: the latency threshold of the concurrency limit
+        :return:
+        """
+        async with self.upstream_limiter.slot(latency_threshold):
+            start_time = time.monotonic()
+            timeout = deadline - start_time
+            if timeout <= 0:
+                # A timeout of 0 is no timeout for aiohttp
+                exportermetrics.upstream_errors.labels(self.endpoint(url), 'timeout').inc()
+                raise ScrapeExecption(message="Deadline exceeded", err=asyncio.TimeoutError(), url=endpoint.url)
+
+            try:
+                if self.session is None or self.session.closed:
+                    # Not running in the app, e.g. from a script, use a short lived session
+                    async with self.create_session() as session:
+                        data_json = await self._async_post(session, self.endpoints.url(url, endpoint), data,
+                                                           timeout)
+                else:
+                    data_json = await self._async_post(self.session, self.endpoints.url(url, endpoint), data,
+                                                       timeout)
+            except asyncio.TimeoutError:
+                endpoint.fail('timeout')
+                raise
+            except ClientConnectorError:
+                endpoint.fail('connect')
+                raise
+            except UpstreamStatusError:
+                endpoint.fail('status')
+                raise
+
+            endpoint.observe(time.monotonic() - start_time)
+            return data_json
+
+    async def async_post_stream(self, url, body=None, timeout=None,
+                                deadline: float = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Post the query to icinga2 and decode the objects in the results one at a time while the response is
+        received. The requests are not coalesced, and not retried or hedged since the objects are yielded before
+        the response is complete. If the deadline is passed after the first object is yielded the objects received
+        are kept and the iteration ends, as the response of the scrape is already being sent.
+        :param url:
+        :param body:
+        :param timeout: defaults to the configured timeout
+        :param deadline: optional time.monotonic() the response must be received by, if before the timeout
+        :return:
+        """
+        timeout = self.deadline_timeout(timeout, deadline)
+
+        await self.open_session()
+        endpoint = self.endpoints.select()
+        yielded = False
+        try:
+            # The slot is held until the whole response is decoded
+            async with self.upstream_limiter.slot():
                 start_time = time.monotonic()
-                async with session.post(url, auth=aiohttp.BasicAuth(self.user, self.passwd),
-                                        verify_ssl=self.verify,
-                                        timeout=self.timeout,
-                                        headers={'Content-Type': 'application/json',
-                                                 'X-HTTP-Method-Override': 'GET'},
-                                        data=json.dumps(body)) as response:
-                    re = await response.text()
-                    log.debug(f"request", {'method': 'post', 'url': url, 'status': response.status,
-                                           'response_time': time.monotonic() - start_time})
+                async with self.session.post(self.endpoints.url(url, endpoint), timeout=timeout,
+                                             data=jsoncodec.dumps(body)) as response:
+                    # The body is received while decoded, so only the time to the response headers is observed
+                    response_time = time.monotonic() - start_time
+                    exportermetrics.upstream_request_seconds.labels(self.endpoint(url)).observe(response_time)
+                    log.debug("request", {'method': 'post', 'url': url, 'status': response.status,
+                                          'response_time': response_time})
                     if response.status != 200 and response.status != 201:
+                        exportermetrics.upstream_errors.labels(self.endpoint(url), 'status').inc()
+                        endpoint.fail('status')
                         log.warn(f"{response.reason} status {response.status}")
-                        return {}
+                        return
 
-                    return json.loads(re)
+                    endpoint.observe(response_time)
+                    async for result in jsonstream.iter_results(response.content):
+                        yielded = True
+                        yield result
 
+        except LimitExceeded as err:
+            raise ScrapeRejected(message=f"Concurrency limit exceeded, {err.reason}", err=err, url=self.host)
         except asyncio.TimeoutError as err:
-            raise ScrapeExecption(message=f"Timeout after {self.timeout} sec", err=err, url=self.host)
+            exportermetrics.upstream_errors.labels(self.endpoint(url), 'timeout').inc()
+            endpoint.fail('timeout')
+            # Only the scrape deadline ends the response early, a timeout before it is a failed request
+            if yielded and deadline is not None and time.monotonic() >= deadline:
+                log.warn("Scrape deadline exceeded while receiving the response, the services not received are "
+                         "left out", {'remote_url': endpoint.url})
+                return
+            raise ScrapeExecption(message=f"Timeout after {timeout} sec", err=err, url=endpoint.url)
         except ClientConnectorError as err:
-            raise ScrapeExecption(message="Connection error", err=err, url=self.host)
+            exportermetrics.upstream_errors.labels(self.endpoint(url), 'connect').inc()
+            endpoint.fail('connect')
+            raise ScrapeExecption(message="Connection error", err=err, url=endpoint.url)
+
+    async def _async_post(self, session: aiohttp.ClientSession, url, data, timeout) -> Dict[str, Any]:
+        start_time = time.monotonic()
+        async with session.post(url, timeout=timeout, data=data) as response:
+            re = await response.read()
+            response_time = time.monotonic() - start_time
+            exportermetrics.upstream_request_seconds.labels(self.endpoint(url)).observe(response_time)
+            log.debug(f"request", {'method': 'post', 'url': url, 'status': response.status,
+                                   'response_time': response_time})
+            if response.status >= 500:
+                raise UpstreamStatusError(response.status, response.reason)
+            if response.status != 200 and response.status != 201:
+                exportermetrics.upstream_errors.labels(self.endpoint(url), 'status').inc()
+                log.warn(f"{response.reason} status {response.status}")
+                return {}
+
+            start_time = time.monotonic()
+            data_json = jsoncodec.loads(re)
+            exportermetrics.json_decode_seconds.observe(time.monotonic() - start_time)
+            return data_json
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """
+        Get the icinga2 api endpoint of the url, like services for /v1/objects/services and events for /v1/events
+        :param url:
+        :return:
+        """
+        path = urlsplit(url).path.strip('/').split('/')
+        if len(path) > 2 and path[1] == 'objects':
+            return path[2]
+        return path[-1]
@@ -20,242 +20,499 @@
 """
 
 import re
+import sys
+import time
+import warnings
+from collections.abc import Mapping
 
 import urllib3
-from typing import Dict
+from typing import Dict, Any, AsyncIterator, Iterator, List, Tuple
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.exposition as exposition
+import icinga2_exporter.labelplan as labelplan
 import icinga2_exporter.log as log
+import icinga2_exporter.perfdatabatch as perfdatabatch
+import icinga2_exporter.perfdatarange as perfdatarange
 import icinga2_exporter.monitorconnection as Monitor
 
 # Disable InsecureRequestWarning
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+class MetricSamples(Mapping):
+    """
+    Compact store of the samples of a scrape. The metric names are interned and the labels are kept as
+    rendered label strings that are shared by all samples of a service. The full sample key
+    metrics_name{label1="value1", ...} is only built when rendered.
+
+    Adding a sample that already exists replace the value but keep the position, so it can be used as the
+    dict of sample keys to values it replaces.
+
+    The samples can be rendered in parts with flush, which release the samples rendered.
+
+    The type and help of each metric family are kept when described, for the exposition formats with metadata.
+
+    The number of series can be limited in total and per metric family, a new series over a limit is dropped and
+    counted in dropped_series by limit.
+    """
+
+    def __init__(self, max_series: int = 0, max_family_series: int = 0):
+        self.index: Dict[Tuple[str, str], int] = {}
+        self.names = []
+        self.labels = []
+        self.values = []
+        # The keys of the flushed samples
+        self.flushed = set()
+        # The type and help of the metric families by name
+        self.families: Dict[str, Tuple[str, str]] = {}
+        # The limits of the number of series, 0 is unlimited
+        self.max_series = max_series
+        self.max_family_series = max_family_series
+        # The number of series, flushed included, in total and by metric family if limited
+        self.series = 0
+        self.family_series: Dict[str, int] = {}
+        self.dropped_series = {'target': 0, 'family': 0}
+
+    def add(self, name: str, labels: str, value: Any, limited: bool = True):
+        """
+        Add a sample, or set the value of the sample if already added
+        :param name:
+        :param labels: the rendered labels
+        :param value:
+        :param limited: False for the exporter's own samples, that are not counted against the limits
+        :return:
+        """
+        key = (name, labels)
+        if self.flushed and key in self.flushed:
+            # Already rendered, a sample can not be rendered twice
+            return
+        position = self.index.get(key)
+        if position is None:
+            if limited and (self.max_series or self.max_family_series):
+                if not self.admit(name):
+                    return
+            self.index[key] = len(self.values)
+            self.names.append(sys.intern(name))
+            self.labels.append(labels)
+            self.values.append(value)
+        else:
+            self.values[position] = value
+
+    def admit(self, name: str) -> bool:
+        """
+        Count a new series of a metric family, unless over the limits
+        :param name:
+        :return: False if the series is dropped
+        """
+        if self.max_series and self.series >= self.max_series:
+            self.dropped_series['target'] += 1
+            return False
+        family_series = self.family_series.get(name, 0)
+        if self.max_family_series and family_series >= self.max_family_series:
+            self.dropped_series['family'] += 1
+            return False
+        self.series += 1
+        self.family_series[name] = family_series + 1
+        return True
+
+    def describe(self, name: str, metric_type: str, help_text: str, limited: bool = True):
+        """
+        Set the type and help of a metric family, unless already described. With limits, only families with
+        series are described, so the families are limited too.
+        :param name:
+        :param metric_type: counter, gauge or untyped
+        :param help_text:
+        :param limited: False for the exporter's own metric families, that are always described
+        :return:
+        """
+        if name not in self.families and \
+                (not limited or not (self.max_series or self.max_family_series) or name in self.family_series):
+            self.families[name] = (metric_type, help_text)
+
+    def grouped(self) -> Iterator[Tuple[str, str, str, List[Tuple[str, Any]]]]:
+        """
+        Get the samples grouped by metric family, in the order the families were first added
+        :return: the name, type and help of each family and the labels and value of its samples
+        """
+        samples_by_name: Dict[str, List[Tuple[str, Any]]] = {}
+        for name, labels, value in zip(self.names, self.labels, self.values):
+            samples_by_name.setdefault(name, []).append((labels, value))
+
+        for name, samples in samples_by_name.items():
+            metric_type, help_text = self.families.get(name, ('untyped', ''))
+            yield name, metric_type, help_text, samples
+
+    def lines(self) -> Iterator[str]:
+        """
+        Render each sample as a line in the prometheus exposition format
+        :return:
+        """
+        for name, labels, value in zip(self.names, self.labels, self.values):
+            yield f"{name}{{{labels}}} {value}\n"
+
+    def flush(self) -> str:
+        """
+        Render the samples added since the last flush and release them. The keys are kept so a sample added
+        again after it has been flushed is dropped, as the first value is already rendered.
+        :return:
+        """
+        body = ''.join(self.lines())
+        self.flushed.update(self.index)
+        self.index = {}
+        self.names = []
+        self.labels = []
+        self.values = []
+        return body
+
+    def __getitem__(self, key: str) -> str:
+        name, _, labels = key.partition('{')
+        return str(self.values[self.index[(name, labels[:-1])]])
+
+    def __iter__(self) -> Iterator[str]:
+        for name, labels in zip(self.names, self.labels):
+            yield f"{name}{{{labels}}}"
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
 class Perfdata:
-    TOKENIZER_RE = (
-            r"([^\s]+|'[^']+')=([-.\d]+)(c|s|ms|us|B|KB|MB|GB|TB|%)?" +
-            r"(?:;([-.\d]+))?(?:;([-.\d]+))?(?:;([-.\d]+))?(?:;([-.\d]+))?")
+    TOKENIZER_RE = perfdatabatch.TOKENIZER_RE
 
     VALID_METRIC_CHARS_RE = '[a-zA-Z0-9:_]'  # https://prometheus.io/docs/instrumenting/writing_exporters/#naming
+    INVALID_METRIC_CHARS = re.compile('[^a-zA-Z0-9:_]')
 
-    def __init__(self, monitor: Monitor, query_hostname: str):
+    METADATA_ATTRS = ["downtime_depth", "acknowledgement", "max_check_attempts", "last_reachable", "state",
+                      "state_type"]
+
+    def __init__(self, monitor: Monitor, query_hostname: str, deadline: float = None):
         # Get Monitor configuration and build URL
         self.monitor = monitor
         self.query_hostname = query_hostname
+        # The time.monotonic() the scrape must be done by, the services not parsed by then are left out
+        self.deadline = deadline
+        self.deadline_exceeded = False
         self.prefix = monitor.get_prefix()
-        self.configured_labels = monitor.get_labels()
         self.perfname_to_label = monitor.get_perfname_to_label()
-        self.perfdatadict = {}
+        self.label_plan = monitor.get_label_plan()
+        self.object_labels = labelplan.ObjectLabels(self.label_plan)
+        self.perfdatadict = MetricSamples(monitor.get_max_series_per_target(), monitor.get_max_series_per_family())
+        # The time of the latest check result
+        self.last_check_time = 0.0
         self.enable_scrape_thresholds = monitor.get_enable_scrape_thresholds()
-
-    def add_perfdata(self, key: str, labels: Dict[str, str], value: float):
+        self.enable_perfdata_ranges = monitor.get_enable_perfdata_ranges()
+        self.metric_name_cache = monitor.get_metric_name_cache()
+        self.perfdata_cache = monitor.get_perfdata_cache()
+        self.perfdata_range_cache = monitor.get_perfdata_range_cache()
+        # The time spent parsing the services and hosts and rendering the samples
+        self.parse_seconds = 0.0
+        self.render_seconds = 0.0
+
+    def add_perfdata(self, key: str, labels: Dict[str, str], value: float, help_text: str = ''):
         labels_str = ""
         sep = ''
         for k, v in labels.items():
             labels_str = f"{labels_str}{sep}{k}=\"{v}\""
             sep = ', '
-        metric = {f"{self.prefix}{key}{{{labels_str}}}": str(value)}
-        self.perfdatadict.update(metric)
+        # The exporter's own samples, like the scrape duration, are not dropped by the series limits
+        self.perfdatadict.add(f"{self.prefix}{key}", labels_str, value, limited=False)
+        self.perfdatadict.describe(f"{self.prefix}{key}", 'gauge', help_text, limited=False)
 
-    async def get_service_metrics(self) -> dict:
+    async def get_service_metrics(self) -> Mapping:
         """
         Collect icinga2 data and parse it into prometheus metrics
         :return:
         """
 
-        data_json = await self.monitor.async_get_service_data(self.query_hostname)
-
-        if 'results' in data_json:
-            for service_attrs in data_json['results']:
-                if 'attrs' in service_attrs and 'last_check_result' in service_attrs['attrs'] and \
-                        service_attrs['attrs']['last_check_result'] is not None and \
-                        'performance_data' in service_attrs['attrs']['last_check_result'] and \
-                        service_attrs['attrs']['last_check_result']['performance_data'] is not None:
-                    check_command = service_attrs['attrs']['check_command']
-                    service = service_attrs['attrs']['display_name']
-                    # Get default labels
-                    labels = {'hostname': service_attrs['attrs']['host_name'],
-                              'service': Perfdata.valid_prometheus_label_values(service_attrs['attrs']['display_name'])}
-
-                    # For all host custom vars add as label
-                    labels.update(Perfdata.get_host_custom_vars(service_attrs))
-
-                    # Export Metadata
-                    for entry in ["downtime_depth", "acknowledgement", "max_check_attempts", "last_reachable", "state",
-                                  "state_type"]:
-
-                        metadata_value = self.normalize_metadata_value(service_attrs['attrs'].get(entry))
-
-                        prometheus_key = self.format_prometheus_metrics_name("{}_{}".format(check_command, "metadata"),
-                                                                             entry, {})
-                        prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels, prometheus_key)
-
-                        self.perfdatadict.update({prometheus_key_with_labels: str(metadata_value)})
-
-                    # Export Perfdata
-                    for perf_string in service_attrs['attrs']['last_check_result']['performance_data']:
-                        perf = Perfdata.parse_perfdata(perf_string)
-
-                        # For each perfdata metrics
-                        for perf_data_key, perf_data_value in perf.items():
+        async for service_attrs in self.monitor.async_iter_service_data(self.query_hostname, self.deadline):
+            if self.past_deadline():
+                break
+            self.add_service_metrics(service_attrs)
+        # A streamed response ends early at the deadline
+        self.past_deadline()
 
-                            if 'value' in perf_data_value:
-                                prometheus_key = self.format_prometheus_metrics_name(check_command, perf_data_key,
-                                                                                     perf_data_value)
-
-                                # Add more labels based on perfname
-                                if check_command in self.perfname_to_label:
-                                    labels.update(
-                                        Perfdata.add_labels_by_items(
-                                            self.perfname_to_label[check_command]['label_name'],
-                                            perf_data_key))
-
-                                prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels,
-                                                                                                     prometheus_key)
-
-                                self.perfdatadict.update({prometheus_key_with_labels: str(perf_data_value['value'])})
-
-                            # Export threshold values from perfdata if enabled
-                            if self.enable_scrape_thresholds:
-
-                                if 'crit' in perf_data_value:
-                                    threshold_value = perf_data_value.get('crit')
-
-                                    prometheus_key = self.format_prometheus_metrics_name(
-                                        check_command, perf_data_key,perf_data_value) + '_threshold_critical'
-
-                                    # Add more labels based on perfname
-                                    if check_command in self.perfname_to_label:
-                                        labels.update(
-                                            Perfdata.add_labels_by_items(
-                                                self.perfname_to_label[check_command]['label_name'],
-                                                perf_data_key))
-
-                                    prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels,
-                                                                                                         prometheus_key)
-
-                                    self.perfdatadict.update({prometheus_key_with_labels: str(threshold_value)})
-
-                                if 'warn' in perf_data_value:
-                                    threshold_value = perf_data_value.get('warn')
-
-                                    prometheus_key = self.format_prometheus_metrics_name(
-                                        check_command, perf_data_key, perf_data_value) + '_threshold_warning'
-
-                                    # Add more labels based on perfname
-                                    if check_command in self.perfname_to_label:
-                                        labels.update(
-                                            Perfdata.add_labels_by_items(
-                                                self.perfname_to_label[check_command]['label_name'],
-                                                perf_data_key))
+        return self.perfdatadict
 
-                                    prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels,
-                                                                                                         prometheus_key)
+    async def iter_service_metrics(self) -> AsyncIterator[str]:
+        """
+        Collect icinga2 data like get_service_metrics, but yield the metrics of each service rendered in the
+        prometheus format as soon as the service is parsed. Any other metrics added, like host metrics added
+        concurrently, are rendered with the next service.
+        :return:
+        """
 
-                                    self.perfdatadict.update({prometheus_key_with_labels: str(threshold_value)})
+        async for service_attrs in self.monitor.async_iter_service_data(self.query_hostname, self.deadline):
+            if self.past_deadline():
+                break
+            self.add_service_metrics(service_attrs)
+            chunk = self.flush()
+            if chunk:
+                yield chunk
+        # A streamed response ends early at the deadline
+        self.past_deadline()
+
+    def past_deadline(self) -> bool:
+        """
+        Check if the deadline is passed, the first time it is the scrape is counted as partial
+        :return:
+        """
+        if self.deadline is None or time.monotonic() < self.deadline:
+            return False
 
-        return self.perfdatadict
+        if not self.deadline_exceeded:
+            self.deadline_exceeded = True
+            exportermetrics.scrape_deadline_exceeded.labels('parse').inc()
+            log.warn("Scrape deadline exceeded, the services not parsed are left out",
+                     {'target': self.query_hostname})
+        return True
 
-    async def get_host_metrics(self) -> dict:
+    def add_service_metrics(self, service_attrs: dict):
+        """
+        Add the metadata and perfdata metrics of a service object
+        :param service_attrs:
+        :return:
+        """
+        start_time = time.monotonic()
+        self.update_last_check_time(service_attrs)
+        if 'attrs' in service_attrs and 'last_check_result' in service_attrs['attrs'] and \
+                service_attrs['attrs']['last_check_result'] is not None and \
+                'performance_data' in service_attrs['attrs']['last_check_result'] and \
+                service_attrs['attrs']['last_check_result']['performance_data'] is not None:
+            check_command = service_attrs['attrs']['check_command']
+            # Get default labels, and all host custom vars as labels
+            labels, labels_str = self.object_labels.labels(
+                {'hostname': service_attrs['attrs']['host_name'],
+                 'service': Perfdata.valid_prometheus_label_values(service_attrs['attrs']['display_name'])},
+                Perfdata.get_host_custom_vars_raw(service_attrs))
+
+            # Export Metadata
+            for entry in Perfdata.METADATA_ATTRS:
+                metadata_value = self.normalize_metadata_value(service_attrs['attrs'].get(entry))
+
+                prometheus_key = self.format_prometheus_metrics_name("{}_{}".format(check_command, "metadata"),
+                                                                     entry, {})
+                self.perfdatadict.add(prometheus_key, labels_str, metadata_value)
+                self.perfdatadict.describe(prometheus_key, 'gauge', f"The {entry} of the service")
+
+            # Export Perfdata
+            self.add_perfdata_metrics(check_command,
+                                      service_attrs['attrs']['last_check_result']['performance_data'],
+                                      labels, labels_str)
+        self.parse_seconds += time.monotonic() - start_time
+
+    async def get_host_metrics(self) -> Mapping:
         """
         Collect icinga2 metadata and parse it into prometheus metrics
         :return:
         """
-        data_json = await self.monitor.async_get_host_data(self.query_hostname)
+        data_json = await self.monitor.async_get_host_data(self.query_hostname, self.deadline)
 
         if 'results' in data_json:
             for host_attrs in data_json['results']:
-                if 'attrs' in host_attrs and '__name' in host_attrs['attrs']:
-
-                    labels = {'hostname': host_attrs['attrs']['name'],
-                              'address': host_attrs['attrs']['address']}
-
-                    # For all host custom vars add as label
-                    labels.update(Perfdata.get_host_meta_custom_vars(host_attrs))
-
-                    # TODO generate calculate missing fields
-                    # <prefix>.metadata.current_attempt
-                    # <prefix>.metadata.execution_time
-                    # <prefix>.metadata.latency
-
-                    attrs_keys = ["downtime_depth", "acknowledgement", "max_check_attempts", "last_reachable", "state",
-                                  "state_type"]
-
-                    for attr_key in attrs_keys:
-                        metadata_value = self.normalize_metadata_value(host_attrs['attrs'].get(attr_key))
-
-                        prometheus_key = self.format_prometheus_metrics_name("host_metadata", attr_key,
-                                                                             {})
-
-                        prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels,
-                                                                                             prometheus_key)
-
-                        self.perfdatadict.update({prometheus_key_with_labels: str(metadata_value)})
-
-                    # Set a default service tag for host check
-                    labels.update({'service': self.monitor.get_host_check_service_name()})
-                    check_command = host_attrs['attrs']['check_command']
-                    for perf_string in host_attrs['attrs']['last_check_result']['performance_data']:
-                        perf = Perfdata.parse_perfdata(perf_string)
-
-                        # For each perfdata metrics
-                        for perf_data_key, perf_data_value in perf.items():
-
-                            if 'value' in perf_data_value:
-                                prometheus_key = self.format_prometheus_metrics_name(check_command, perf_data_key,
-                                                                                     perf_data_value)
-
-                                # Add more labels based on perfname
-                                if check_command in self.perfname_to_label:
-                                    labels.update(
-                                        Perfdata.add_labels_by_items(
-                                            self.perfname_to_label[check_command]['label_name'],
-                                            perf_data_key))
-
-                                prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels,
-                                                                                                     prometheus_key)
-
-                                self.perfdatadict.update({prometheus_key_with_labels: str(perf_data_value['value'])})
-
-                            # Export threshold values from perfdata if enabled
-                            if self.enable_scrape_thresholds:
+                self.add_host_metrics(host_attrs)
 
-                                if 'crit' in perf_data_value:
-                                    threshold_value = perf_data_value.get('crit')
-
-                                    prometheus_key = self.format_prometheus_metrics_name(
-                                        check_command, perf_data_key,perf_data_value) + '_threshold_critical'
-
-                                    # Add more labels based on perfname
-                                    if check_command in self.perfname_to_label:
-                                        labels.update(
-                                            Perfdata.add_labels_by_items(
-                                                self.perfname_to_label[check_command]['label_name'],
-                                                perf_data_key))
-
-                                    prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels,
-                                                                                                         prometheus_key)
-
-                                    self.perfdatadict.update({prometheus_key_with_labels: str(threshold_value)})
+        return self.perfdatadict
 
-                                if 'warn' in perf_data_value:
-                                    threshold_value = perf_data_value.get('warn')
+    def add_host_metrics(self, host_attrs: dict):
+        """
+        Add the metadata and perfdata metrics of a host object
+        :param host_attrs:
+        :return:
+        """
+        start_time = time.monotonic()
+        self.update_last_check_time(host_attrs)
+        if 'attrs' in host_attrs and '__name' in host_attrs['attrs']:
+
+            # For all host custom vars add as label
+            labels, labels_str = self.object_labels.labels({'hostname': host_attrs['attrs']['name'],
+                                                            'address': host_attrs['attrs']['address']},
+                                                           Perfdata.get_host_meta_custom_vars_raw(host_attrs))
+
+            # TODO generate calculate missing fields
+            # <prefix>.metadata.current_attempt
+            # <prefix>.metadata.execution_time
+            # <prefix>.metadata.latency
+
+            for attr_key in Perfdata.METADATA_ATTRS:
+                metadata_value = self.normalize_metadata_value(host_attrs['attrs'].get(attr_key))
+
+                prometheus_key = self.format_prometheus_metrics_name("host_metadata", attr_key,
+                                                                     {})
+                self.perfdatadict.add(prometheus_key, labels_str, metadata_value)
+                self.perfdatadict.describe(prometheus_key, 'gauge', f"The {attr_key} of the host")
+
+            # Set a default service tag for host check
+            labels.update({'service': self.monitor.get_host_check_service_name()})
+            labels_str = Perfdata.labels_string(labels)
+            check_command = host_attrs['attrs']['check_command']
+            self.add_perfdata_metrics(check_command, host_attrs['attrs']['last_check_result']['performance_data'],
+                                      labels, labels_str)
+        self.parse_seconds += time.monotonic() - start_time
+
+    def update_last_check_time(self, object_attrs: dict):
+        if 'attrs' in object_attrs and object_attrs['attrs'].get('last_check_result') is not None:
+            self.last_check_time = max(self.last_check_time,
+                                       object_attrs['attrs']['last_check_result'].get('execution_end') or 0.0)
+
+    def add_perfdata_metrics(self, check_command: str, performance_data: list, labels: dict, labels_str: str):
+        """
+        Add the metrics, and thresholds if enabled, for all perfdata of a check result
+        :param check_command:
+        :param performance_data:
+        :param labels: the labels of the service
+        :param labels_str: the labels of the service rendered by labels_string
+        :return:
+        """
+        if self.enable_perfdata_ranges:
+            self.add_perfdata_range_metrics(check_command, performance_data, labels, labels_str)
+            return
+
+        for perf_string in performance_data:
+            perf = self.parse_perfdata_cached(perf_string)
+
+            # For each perfdata metrics
+            for perf_data_key, perf_data_value in perf.items():
+                prometheus_key = self.format_prometheus_metrics_name(check_command, perf_data_key,
+                                                                     perf_data_value)
+
+                # Add more labels based on perfname
+                item_labels_str = self.item_labels_string(check_command, perf_data_key, labels, labels_str)
+
+                if 'value' in perf_data_value:
+                    self.perfdatadict.add(prometheus_key, item_labels_str, perf_data_value['value'])
+                    self.perfdatadict.describe(prometheus_key, perf_data_value.get('type', 'gauge'),
+                                               f"Performance data of check command {check_command}")
+
+                # Export threshold values from perfdata if enabled
+                if self.enable_scrape_thresholds:
+
+                    if 'crit' in perf_data_value:
+                        self.perfdatadict.add(prometheus_key + '_threshold_critical', item_labels_str,
+                                              perf_data_value.get('crit'))
+                        self.perfdatadict.describe(prometheus_key + '_threshold_critical', 'gauge',
+                                                   f"Critical threshold of check command {check_command}")
+
+                    if 'warn' in perf_data_value:
+                        self.perfdatadict.add(prometheus_key + '_threshold_warning', item_labels_str,
+                                              perf_data_value.get('warn'))
+                        self.perfdatadict.describe(prometheus_key + '_threshold_warning', 'gauge',
+                                                   f"Warning threshold of check command {check_command}")
+
+    def add_perfdata_range_metrics(self, check_command: str, performance_data: list, labels: dict,
+                                   labels_str: str):
+        """
+        Add the metrics of all perfdata of a check result like add_perfdata_metrics, parsed by the range-aware
+        parser. The min and max are added, and the lower and upper bound of the threshold ranges if thresholds
+        are enabled.
+        :param check_command:
+        :param performance_data:
+        :param labels: the labels of the service
+        :param labels_str: the labels of the service rendered by labels_string
+        :return:
+        """
+        help_text = f"Performance data of check command {check_command}"
+        min_help_text = f"Min of the performance data of check command {check_command}"
+        max_help_text = f"Max of the performance data of check command {check_command}"
+        for perf_string in performance_data:
+            for key, value, unit, metric_type, warn, crit, minimum, maximum in self.parse_perfdata_ranges_cached(
+                    perf_string):
+                prometheus_key = self.metrics_name(check_command, key, unit)
+                item_labels_str = self.item_labels_string(check_command, key, labels, labels_str)
+
+                self.perfdatadict.add(prometheus_key, item_labels_str, value)
+                self.perfdatadict.describe(prometheus_key, metric_type, help_text)
+                if minimum is not None:
+                    min_key = prometheus_key + '_min'
+                    self.perfdatadict.add(min_key, item_labels_str, minimum)
+                    self.perfdatadict.describe(min_key, 'gauge', min_help_text)
+                if maximum is not None:
+                    max_key = prometheus_key + '_max'
+                    self.perfdatadict.add(max_key, item_labels_str, maximum)
+                    self.perfdatadict.describe(max_key, 'gauge', max_help_text)
+
+                if self.enable_scrape_thresholds:
+                    if warn is not None:
+                        self.add_threshold_range(prometheus_key + '_threshold_warning', item_labels_str, warn,
+                                                 f"Warning threshold of check command {check_command}")
+                    if crit is not None:
+                        self.add_threshold_range(prometheus_key + '_threshold_critical', item_labels_str, crit,
+                                                 f"Critical threshold of check command {check_command}")
+
+    def add_threshold_range(self, name: str, labels_str: str, threshold: tuple, help_text: str):
+        """
+        Add the bounds of a threshold range as <name>_lower and <name>_upper, an infinite bound is not added. If
+        the alert is inside the range, <name>_inside is added as 1.
+        :param name:
+        :param labels_str:
+        :param threshold: the range as parsed by perfdatarange.parse_range
+        :param help_text:
+        :return:
+        """
+        lower, upper, inside = threshold
+        if lower is not None:
+            self.perfdatadict.add(name + '_lower', labels_str, lower)
+            self.perfdatadict.describe(name + '_lower', 'gauge', f"{help_text}, lower bound")
+        if upper is not None:
+            self.perfdatadict.add(name + '_upper', labels_str, upper)
+            self.perfdatadict.describe(name + '_upper', 'gauge', f"{help_text}, upper bound")
+        if inside:
+            self.perfdatadict.add(name + '_inside', labels_str, 1.0)
+            self.perfdatadict.describe(name + '_inside', 'gauge', f"{help_text}, alert inside the range")
+
+    def item_labels_string(self, check_command: str, perf_data_key: str, labels: dict, labels_str: str) -> str:
+        """
+        Get the labels string for a perfdata item. If the check command is configured in perfnametolabel the
+        perfname is added as a label to the labels of the service
+        :param check_command:
+        :param perf_data_key:
+        :param labels:
+        :param labels_str:
+        :return:
+        """
+        label_name = self.label_plan.perfname_labels.get(check_command)
+        if label_name is None:
+            return labels_str
 
-                                    prometheus_key = self.format_prometheus_metrics_name(
-                                        check_command, perf_data_key, perf_data_value) + '_threshold_warning'
+        if label_name in labels:
+            # The perfname replace the value of an existing label
+            return Perfdata.labels_string(dict(labels, **{label_name: perf_data_key}))
 
-                                    # Add more labels based on perfname
-                                    if check_command in self.perfname_to_label:
-                                        labels.update(
-                                            Perfdata.add_labels_by_items(
-                                                self.perfname_to_label[check_command]['label_name'],
-                                                perf_data_key))
+        if labels_str:
+            return labels_str + ', ' + label_name + '="' + perf_data_key + '"'
+        return label_name + '="' + perf_data_key + '"'
 
-                                    prometheus_key_with_labels = Perfdata.concat_metrics_name_and_labels(labels,
-                                                                                                         prometheus_key)
+    def parse_perfdata_cached(self, perfdata):
+        """
+        Parse the icinga2 perfdata like parse_perfdata, but perfdata strings are cached on the raw string so
+        unchanged check results are not parsed again. The returned dict is shared and must not be modified.
+        :param perfdata:
+        :return:
+        """
+        if type(perfdata) is not str:
+            return Perfdata.parse_perfdata(perfdata)
 
-                                    self.perfdatadict.update({prometheus_key_with_labels: str(threshold_value)})
+        perf = self.perfdata_cache.get(perfdata)
+        if perf is None:
+            perf = Perfdata.parse_perf_string(perfdata)
+            self.perfdata_cache.put(perfdata, perf)
+        return perf
 
-        return self.perfdatadict
+    def parse_perfdata_ranges_cached(self, perfdata) -> List[tuple]:
+        """
+        Parse the icinga2 perfdata with the range-aware parser, cached like parse_perfdata_cached but in a cache
+        of its own. Perfdata in dict format have no thresholds, min or max.
+        :param perfdata:
+        :return: the items as parsed by perfdatarange.parse_perf_string
+        """
+        if type(perfdata) is not str:
+            return [(key, value['value'], value['unit'], 'gauge', None, None, None, None)
+                    for key, value in Perfdata.parse_perfdata(perfdata).items()]
+
+        perf = self.perfdata_range_cache.get(perfdata)
+        if perf is None:
+            perf = perfdatarange.parse_perf_string(perfdata)
+            self.perfdata_range_cache.put(perfdata, perf)
+        return perf
 
     def format_prometheus_metrics_name(self, check_command, key, value):
         """
@@ -269,16 +526,34 @@ class Perfdata:
         icinga2_<check_command>
         And than the perfname will be used as a label value
 
+        The names are cached on check command, perfname and unit.
+
         :param check_command:
         :param key:
         :param value:
         :return:
         """
-        if 'unit' in value and value['unit']:
+        return self.metrics_name(check_command, key, value.get('unit') or '')
+
+    def metrics_name(self, check_command: str, key: str, unit: str) -> str:
+        """
+        Format the prometheus metrics name like format_prometheus_metrics_name, of a perfdata item with the
+        normalized unit
+        :param check_command:
+        :param key:
+        :param unit: the normalized unit, or empty
+        :return:
+        """
+        cache_key = (check_command, key, unit)
+        prometheus_key = self.metric_name_cache.get(cache_key)
+        if prometheus_key is not None:
+            return prometheus_key
+
+        if unit:
             if check_command in self.perfname_to_label:
-                prometheus_key = self.prefix + check_command + '_' + value['unit']
+                prometheus_key = self.prefix + check_command + '_' + unit
             else:
-                prometheus_key = self.prefix + check_command + '_' + key.lower() + '_' + value['unit']
+                prometheus_key = self.prefix + check_command + '_' + key.lower() + '_' + unit
         else:
             if check_command in self.perfname_to_label:
                 prometheus_key = self.prefix + check_command
@@ -286,18 +561,57 @@ class Perfdata:
                 prometheus_key = self.prefix + check_command + '_' + key.lower()
 
         prometheus_key = Perfdata.rem_illegal_chars(prometheus_key)
+        self.metric_name_cache.put(cache_key, prometheus_key)
 
         return prometheus_key
 
-    def prometheus_format(self) -> str:
+    def prometheus_format(self, exposition_format: str = exposition.TEXT):
+        """
+        Build prometheus exporter response body. The text format is the samples in the order added, without
+        metadata. The OpenMetrics and protobuf formats are grouped by metric family with type and help.
+        :param exposition_format: text, openmetrics or protobuf
+        :return: the body, bytes for protobuf
+        """
+        start_time = time.monotonic()
+        if exposition_format == exposition.TEXT:
+            body = ''.join(self.perfdatadict.lines())
+        else:
+            body = exposition.render(self.perfdatadict.grouped(), exposition_format)
+        self.render_seconds += time.monotonic() - start_time
+        return body
+
+    def flush(self) -> str:
         """
-        Build prometheus exporter response body
+        Render the samples added since the last flush in the prometheus text format and release them
         :return:
         """
-        metrics = ''
-        for key, value in self.perfdatadict.items():
-            metrics += key + ' ' + value + '\n'
-        return metrics
+        start_time = time.monotonic()
+        body = self.perfdatadict.flush()
+        self.render_seconds += time.monotonic() - start_time
+        return body
+
+    def observe(self):
+        """
+        Observe the time spent parsing and rendering on the exporter metrics, called when the scrape is rendered
+        :return:
+        """
+        exportermetrics.perfdata_parse_seconds.observe(self.parse_seconds)
+        exportermetrics.render_seconds.observe(self.render_seconds)
+        self.count_dropped_series()
+
+    def count_dropped_series(self):
+        """
+        Count the series dropped by the cardinality limits on the exporter metrics
+        :return:
+        """
+        dropped_series = self.perfdatadict.dropped_series
+        if dropped_series['target'] or dropped_series['family']:
+            log.warn("series dropped by the cardinality limits", {'target': self.query_hostname,
+                                                                  'dropped_series': dict(dropped_series)})
+            for limit, dropped in dropped_series.items():
+                if dropped:
+                    exportermetrics.dropped_series.labels(limit).inc(dropped)
+                    dropped_series[limit] = 0
 
     @staticmethod
     def normalize_metadata_value(value):
@@ -311,18 +625,28 @@ class Perfdata:
     @staticmethod
     def get_host_custom_vars(service_attrs: dict) -> dict:
         """
-        Get all host variables
+        Get all host variables as labels, the names lower case and the values escaped.
+        Deprecated, the labels are rendered by the label plan from get_host_custom_vars_raw
+        :param service_attrs:
+        :return:
+        """
+        warnings.warn("Perfdata.get_host_custom_vars is deprecated, use get_host_custom_vars_raw",
+                      DeprecationWarning, stacklevel=2)
+        return Perfdata.custom_vars_labels(Perfdata.get_host_custom_vars_raw(service_attrs))
+
+    @staticmethod
+    def get_host_custom_vars_raw(service_attrs: dict) -> dict:
+        """
+        Get all host variables of a service as returned by icinga2
         :param service_attrs:
         :return:
         """
-        labels = {}
         if 'joins' in service_attrs \
                 and 'host' in service_attrs['joins'] \
                 and 'vars' in service_attrs['joins']['host'] \
                 and service_attrs['joins']['host']['vars'] is not None:
-            for custom_vars_key, custom_vars_value in service_attrs['joins']['host']['vars'].items():
-                labels[custom_vars_key.lower()] = Perfdata.valid_prometheus_label_values(custom_vars_value)
-        return labels
+            return service_attrs['joins']['host']['vars']
+        return {}
 
     @staticmethod
     def parse_perfdata(perfdata):
@@ -360,6 +684,8 @@ class Perfdata:
             try:
                 norm_value, norm_unit = Perfdata.normalize_to_unit(float(value), uom)
                 metrics[key] = {'value': norm_value, 'unit': norm_unit}
+                if uom == 'c':
+                    metrics[key]['type'] = 'counter'
 
                 # Parse critical and warning thresholds if they exist
                 if crit:
@@ -393,26 +719,8 @@ class Perfdata:
         byte-based units. Sadly, the Nagios-Plugins specification doesn't
         disambiguate base-1000 (KB) and base-1024 (KiB).
         """
-        if unit == '%':
-            return value / 100, 'ratio'
-        if unit == 's':
-            return value, 'seconds'
-        if unit == 'ms':
-            return value / 1000.0, 'seconds'
-        if unit == 'us':
-            return value / 1000000.0, 'seconds'
-        if unit == 'B':
-            return value, 'bytes'
-        if unit == 'KB':
-            return value * 1024, 'bytes'
-        if unit == 'MB':
-            return value * 1024 * 1024, 'bytes'
-        if unit == 'GB':
-            return value * 1024 * 1024 * 1024, 'bytes'
-        if unit == 'TB':
-            return value * 1024 * 1024 * 1024 * 1024, 'bytes'
-
-        return value, ''
+        factor, divisor, norm_unit = perfdatabatch.UNITS.get(unit, perfdatabatch.NO_UNIT)
+        return value * factor / divisor, norm_unit
 
     @staticmethod
     def concat_metrics_name_and_labels(labels: dict, prometheus_key: str) -> str:
@@ -437,46 +745,50 @@ class Perfdata:
         :param labels:
         :return:
         """
-        labelstring = ''
-        sep = ''
-        for label_key, label_value in labels.items():
-            # Can only add custom vars that are simple strings. In incinga these can be complex dict structures
-            # if type(label_value) is str or type(label_value) is int:
-            if type(label_value) is str:
-                labelstring += sep + label_key + '="' + label_value + '"'
-                sep = ', '
-        return labelstring
+        return labelplan.labels_string(labels)
 
     @staticmethod
     def rem_illegal_chars(prometheus_key):
         # Replace illegal characters in metric name
-        regexp = re.compile(Perfdata.VALID_METRIC_CHARS_RE)
-        result = ''
-        for elem in prometheus_key:
-            if regexp.match(elem):
-                result += elem
-            else:
-                result += '_'
-        return result
+        return Perfdata.INVALID_METRIC_CHARS.sub('_', prometheus_key)
 
     @staticmethod
     def add_labels_by_items(label: str, key: str) -> dict:
+        """
+        Deprecated, the perfname labels are added by the label plan
+        """
+        warnings.warn("Perfdata.add_labels_by_items is deprecated", DeprecationWarning, stacklevel=2)
         item_label = {label.lower(): key}
         return item_label
 
     @staticmethod
-    def get_host_meta_custom_vars(host_attrs):
-        labels = {}
+    def get_host_meta_custom_vars(host_attrs) -> dict:
+        """
+        Get all host variables as labels, the names lower case and the values escaped.
+        Deprecated, the labels are rendered by the label plan from get_host_meta_custom_vars_raw
+        :param host_attrs:
+        :return:
+        """
+        warnings.warn("Perfdata.get_host_meta_custom_vars is deprecated, use get_host_meta_custom_vars_raw",
+                      DeprecationWarning, stacklevel=2)
+        return Perfdata.custom_vars_labels(Perfdata.get_host_meta_custom_vars_raw(host_attrs))
+
+    @staticmethod
+    def get_host_meta_custom_vars_raw(host_attrs) -> dict:
+        """
+        Get all host variables of a host as returned by icinga2
+        :param host_attrs:
+        :return:
+        """
         if type(host_attrs['attrs']['vars']) == dict:
-            for custom_vars_key, custom_vars_value in host_attrs['attrs']['vars'].items():
-                labels[custom_vars_key.lower()] = Perfdata.valid_prometheus_label_values(custom_vars_value)
+            return host_attrs['attrs']['vars']
+        return {}
 
-        return labels
+    @staticmethod
+    def custom_vars_labels(custom_vars: dict) -> dict:
+        return {custom_vars_key.lower(): Perfdata.valid_prometheus_label_values(custom_vars_value)
+                for custom_vars_key, custom_vars_value in custom_vars.items()}
 
     @staticmethod
     def valid_prometheus_label_values(value: str) -> str:
-        # Quote backslash if it's a str
-        if isinstance(value, str) and '\\' in value:
-            value = value.replace('\\', '\\\\')
-
-        return value
+        return labelplan.escape_value(value)
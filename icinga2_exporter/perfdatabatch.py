@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import icinga2_exporter.log as log
+from icinga2_exporter.cache import LRUCache
+
+TOKENIZER_RE = (
+        r"([^\s]+|'[^']+')=([-.\d]+)(c|s|ms|us|B|KB|MB|GB|TB|%)?" +
+        r"(?:;([-.\d]+))?(?:;([-.\d]+))?(?:;([-.\d]+))?(?:;([-.\d]+))?")
+
+TOKENIZER = re.compile(TOKENIZER_RE)
+
+# Ends the tokens of a perfdata string in a batch
+SEPARATOR_TOKEN = (None, '0', '', '', '', '', '')
+
+# The normalized unit of each perfdata unit and the factor and divisor the value is scaled with. Seconds are
+# base-1000 and bytes base-1024. The factors and divisors give the same floats as the scaling in
+# Perfdata.normalize_to_unit did.
+UNITS = {
+    '%': (1, 100, 'ratio'),
+    's': (1, 1, 'seconds'),
+    'ms': (1, 1000.0, 'seconds'),
+    'us': (1, 1000000.0, 'seconds'),
+    'B': (1, 1, 'bytes'),
+    'KB': (1024, 1, 'bytes'),
+    'MB': (1024 * 1024, 1, 'bytes'),
+    'GB': (1024 * 1024 * 1024, 1, 'bytes'),
+    'TB': (1024 * 1024 * 1024 * 1024, 1, 'bytes'),
+}
+
+NO_UNIT = (1, 1, '')
+
+
+class PerfdataColumns:
+    """
+    The perfdata items of many perfdata strings in columns, one row per item. The rows of the perfdata string
+    at index i are starts[i] to starts[i + 1]. The thresholds and type of a row are None if not set.
+    """
+
+    def __init__(self):
+        self.starts = [0]
+        self.keys: List[str] = []
+        self.values: List[float] = []
+        self.units: List[str] = []
+        self.types: List[Optional[str]] = []
+        self.crit: List[Optional[float]] = []
+        self.warn: List[Optional[float]] = []
+
+    def __len__(self) -> int:
+        return len(self.starts) - 1
+
+    def perfdata(self, index: int) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the perfdata of a string as parsed by Perfdata.parse_perf_string
+        :param index:
+        :return:
+        """
+        metrics = {}
+        for row in range(self.starts[index], self.starts[index + 1]):
+            item = {'value': self.values[row], 'unit': self.units[row]}
+            if self.types[row] is not None:
+                item['type'] = self.types[row]
+            if self.crit[row] is not None:
+                item['crit'] = self.crit[row]
+            if self.warn[row] is not None:
+                item['warn'] = self.warn[row]
+            metrics[self.keys[row]] = item
+        return metrics
+
+
+def tokenize(perf_strings: Sequence[str]) -> List[tuple]:
+    """
+    Tokenize the perfdata strings
+    :param perf_strings:
+    :return: the tokens of all strings, the tokens of each string followed by a SEPARATOR_TOKEN
+    """
+    tokens = []
+    findall = TOKENIZER.findall
+    for perf_string in perf_strings:
+        tokens.extend(findall(perf_string))
+        tokens.append(SEPARATOR_TOKEN)
+    return tokens
+
+
+def parse_perf_strings(perf_strings: Sequence[str]) -> PerfdataColumns:
+    """
+    Parse many perfdata strings, e.g. all of an icinga2 response, in one batch. The values of all items are
+    converted in one pass, and the result is the same as parsing each string with Perfdata.parse_perf_string.
+    :param perf_strings:
+    :return:
+    """
+    tokens = tokenize(perf_strings)
+
+    value_strings = [token[1] for token in tokens]
+    try:
+        values = list(map(float, value_strings))
+    except ValueError:
+        values = [to_float(value) for value in value_strings]
+
+    columns = PerfdataColumns()
+    for (key, value, uom, warn, crit, _, _), number in zip(tokens, values):
+        if key is None:
+            columns.starts.append(len(columns.keys))
+            continue
+        if number is None:
+            log.warn("Couldn't convert value '{value}' to float".format(value=value))
+            continue
+
+        factor, divisor, unit = UNITS.get(uom, NO_UNIT)
+        crit_value = None
+        warn_value = None
+        try:
+            if crit:
+                crit_value = float(crit) * factor / divisor
+            if warn:
+                warn_value = float(warn) * factor / divisor
+        except ValueError:
+            log.warn("Couldn't convert value '{value}' to float".format(value=value))
+
+        columns.keys.append(key)
+        columns.values.append(number * factor / divisor)
+        columns.units.append(unit)
+        columns.types.append('counter' if uom == 'c' else None)
+        columns.crit.append(crit_value)
+        columns.warn.append(warn_value)
+    return columns
+
+
+def cache_perf_strings(cache: LRUCache, perf_strings: Iterable[Any]) -> int:
+    """
+    Parse the perfdata strings that are not cached in one batch and cache them, so they are not parsed one at a
+    time when rendered. Perfdata that are not strings are skipped, and at most as many strings as the cache can
+    hold are parsed.
+    :param cache: the perfdata cache
+    :param perf_strings:
+    :return: the number of strings parsed
+    """
+    if cache.maxsize <= 0:
+        return 0
+
+    uncached = []
+    for perf_string in dict.fromkeys(perf_string for perf_string in perf_strings
+                                     if type(perf_string) is str and perf_string not in cache):
+        uncached.append(perf_string)
+        if len(uncached) == cache.maxsize:
+            break
+
+    columns = parse_perf_strings(uncached)
+    for index, perf_string in enumerate(uncached):
+        cache.put(perf_string, columns.perfdata(index))
+    return len(uncached)
+
+
+def perf_strings(objects: Iterable[Dict[str, Any]]) -> Iterator[Any]:
+    """
+    Get the perfdata of the last check result of service or host objects
+    :param objects:
+    :return:
+    """
+    for object_attrs in objects:
+        last_check_result = object_attrs.get('attrs', {}).get('last_check_result')
+        if last_check_result is not None and last_check_result.get('performance_data') is not None:
+            yield from last_check_result['performance_data']
+
+
+def to_float(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        return None
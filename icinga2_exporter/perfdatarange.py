@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import functools
+import re
+from typing import List, Optional, Tuple
+
+import icinga2_exporter.log as log
+import icinga2_exporter.perfdatabatch as perfdatabatch
+
+# Like TOKENIZER_RE, but the thresholds are Nagios ranges like 10:20, ~:5 and @1:3, and any of the thresholds, min
+# and max can be empty
+RANGE_TOKENIZER = re.compile(
+    r"([^\s]+|'[^']+')=([-.\d]+)(c|s|ms|us|B|KB|MB|GB|TB|%)?" +
+    r"(?:;([-.\d~@:]*))?(?:;([-.\d~@:]*))?(?:;([-.\d]*))?(?:;([-.\d]*))?")
+
+
+def parse_perf_string(s: str) -> List[tuple]:
+    """
+    Parse icinga2 perfdata in classic string format, with the min, max and threshold ranges.
+    Return a tuple per item as
+    (key, value, unit, type, warn, crit, min, max)
+    <class 'tuple'>: ('time', 0.00196, 'seconds', 'gauge', (0.0, 1.0, False), None, 0.0, 10.0)
+    The thresholds are parsed by parse_range, and None like min and max if not set.
+    :param s:
+    :return:
+    """
+    items = []
+    for key, value, uom, warn, crit, minimum, maximum in RANGE_TOKENIZER.findall(s):
+        factor, divisor, unit = perfdatabatch.UNITS.get(uom, perfdatabatch.NO_UNIT)
+        number = perfdatabatch.to_float(value)
+        if number is None:
+            log.warn("Couldn't convert value '{value}' to float".format(value=value))
+            continue
+
+        minimum = perfdatabatch.to_float(minimum) if minimum else None
+        maximum = perfdatabatch.to_float(maximum) if maximum else None
+        items.append((key, number * factor / divisor, unit, 'counter' if uom == 'c' else 'gauge',
+                      parse_range(warn, uom) if warn else None,
+                      parse_range(crit, uom) if crit else None,
+                      minimum * factor / divisor if minimum is not None else None,
+                      maximum * factor / divisor if maximum is not None else None))
+    return items
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_range(threshold: str, uom: str = '') -> Optional[Tuple[Optional[float], Optional[float], bool]]:
+    """
+    Parse a Nagios threshold range, [@]start:end, normalized to the unit of the value. A range without start is
+    from 0, a start of ~ is negative infinity and a range without end is to infinity. The thresholds are
+    repeated in most check results, so the parsed ranges are cached and shared.
+    :param threshold: the range, e.g. 10, 10:, ~:10, 10:20 or @10:20
+    :param uom: the unit of the perfdata value
+    :return: the lower and upper bound, None if infinite, and True if the alert is inside the range instead of
+    outside, or None if the range is not valid
+    """
+    inside = threshold.startswith('@')
+    if inside:
+        threshold = threshold[1:]
+
+    start, sep, end = threshold.partition(':')
+    if not sep:
+        start, end = '0', start
+    lower = None if start == '~' else perfdatabatch.to_float(start or '0')
+    upper = perfdatabatch.to_float(end) if end else None
+    if not threshold or (lower is None and start != '~') or (upper is None and end) or \
+            (lower is not None and upper is not None and lower > upper):
+        log.warn("Couldn't parse threshold range '{threshold}'".format(threshold=threshold))
+        return None
+
+    factor, divisor, _ = perfdatabatch.UNITS.get(uom, perfdatabatch.NO_UNIT)
+    return (lower * factor / divisor if lower is not None else None,
+            upper * factor / divisor if upper is not None else None,
+            inside)
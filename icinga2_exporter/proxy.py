@@ -20,16 +20,46 @@
 """
 import asyncio
 import time
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
 
-from prometheus_client import (CONTENT_TYPE_LATEST, Counter)
-from quart import request, Response, jsonify, Blueprint
+from prometheus_client import (CONTENT_TYPE_LATEST, generate_latest)
+from quart import request, Response, Blueprint
 
 import icinga2_exporter.log as log
+import icinga2_exporter.compression as compression
+import icinga2_exporter.exposition as exposition
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.jsoncodec as jsoncodec
 import icinga2_exporter.monitorconnection as monitorconnection
+import icinga2_exporter.perfdatabatch as perfdatabatch
+from icinga2_exporter.cache import CachedResponse, SingleFlight
 from icinga2_exporter.perfdata import Perfdata
 
 app = Blueprint('icinga2', __name__)
-total_requests = Counter('requests', 'Total requests to monitor-exporter endpoint')
+
+# Scrapes in flight by target, used when the response cache is enabled
+scrapes = SingleFlight()
+
+SCRAPE_DURATION_HELP = 'Seconds to fetch and parse the data of the target from icinga2'
+
+DATA_AGE_HELP = 'Seconds since the stale response of the target was scraped from icinga2'
+
+# The scrape timeout sent by Prometheus with every scrape
+SCRAPE_TIMEOUT_HEADER = 'X-Prometheus-Scrape-Timeout-Seconds'
+
+
+@app.before_app_serving
+async def open_connections():
+    await monitorconnection.MonitorConfig().open_session()
+    if monitorconnection.MonitorConfig().get_enable_bulk_scrape() or \
+            monitorconnection.MonitorConfig().get_enable_event_stream():
+        monitorconnection.MonitorConfig().start_snapshot_refresh()
+
+
+@app.after_app_serving
+async def close_connections():
+    await monitorconnection.MonitorConfig().stop_snapshot_refresh()
+    await monitorconnection.MonitorConfig().close_session()
 
 
 @app.route('/', methods=['GET'])
@@ -41,48 +71,401 @@ def hello_world():
 async def get_metrics():
     #log.info(request.url)
     target = request.args.get('target')
+    if not target:
+        resp = Response("target is required")
+        resp.status_code = 400
+        return resp
+
+    monitor = monitorconnection.MonitorConfig()
+
+    encoding = None
+    if monitor.get_enable_compression():
+        encoding = compression.negotiate(request.accept_encodings)
+
+    exposition_format = exposition.negotiate(request.headers.get('Accept', ''), monitor.get_exposition_formats())
+    level = monitor.get_compression_level(encoding)
+    min_size = monitor.get_compression_min_size()
+    deadline = scrape_deadline()
+
+    try:
+        if monitor.get_response_cache_ttl() > 0 or monitor.get_stale_response_ttl() > 0:
+            cache_key = target if exposition_format == exposition.TEXT else (target, exposition_format)
+            cached, stale = await cached_scrape(target, exposition_format, deadline)
+            if stale:
+                # The age of the data is added to the stale response, so it is compressed every time
+                body = exposition.append(cached.body, [('icinga2_exporter_data_age_seconds', 'gauge', DATA_AGE_HELP,
+                                                        [(f'hostname="{target}"', time.monotonic() - cached.created)])],
+                                         exposition_format)
+                encoding, target_metrics = compression.compress_body(body, encoding, level, min_size)
+            elif encoding is not None and len(cached.body) >= min_size:
+                target_metrics = cached.encode(encoding, lambda data: compression.compress(data, encoding, level))
+                # The compressed body is kept with the cached response
+                monitor.get_response_cache().resize(cache_key)
+            else:
+                encoding = None
+                target_metrics = cached.body
+        elif exposition_format == exposition.TEXT:
+            encoding, target_metrics = await compression.compress_stream(
+                await stream_scrape(target, request.url, deadline), encoding, level, min_size)
+        else:
+            # The formats grouped by metric family can not be streamed one service at a time
+            monitor_data = await scrape(target, deadline)
+            target_metrics = monitor_data.prometheus_format(exposition_format)
+            monitor_data.observe()
+            encoding, target_metrics = compression.compress_body(target_metrics, encoding, level, min_size)
+
+        resp = Response(count_response_bytes(request.path, target_metrics))
+        resp.headers['Content-Type'] = exposition.content_type(exposition_format)
+        if monitor.get_enable_compression():
+            resp.headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            resp.headers['Content-Encoding'] = encoding
+        # after_request_func(resp)
+        return resp
+    except monitorconnection.ScrapeExecption as err:
+        log.warn(f"{err.message}", {'target': target, 'url': request.url, 'remote_url': err.url, 'err': err.err})
+        if deadline_passed(deadline):
+            exportermetrics.scrape_deadline_exceeded.labels('upstream').inc()
+        resp = Response("")
+        resp.status_code = err.status
+        return resp
 
-    monitor_data = Perfdata(monitorconnection.MonitorConfig(), target)
+
+def scrape_deadline() -> Optional[float]:
+    """
+    Get the deadline of the scrape from the scrape timeout sent by Prometheus, less the configured offset to
+    leave time to send the response. At least half the scrape timeout is left for the scrape.
+    :return: the time.monotonic() the scrape must be done by, None if no scrape timeout was sent
+    """
+    try:
+        scrape_timeout = float(request.headers.get(SCRAPE_TIMEOUT_HEADER, ''))
+    except ValueError:
+        return None
+    if not scrape_timeout > 0:
+        return None
+
+    offset = monitorconnection.MonitorConfig().get_scrape_timeout_offset()
+    return time.monotonic() + max(scrape_timeout - offset, scrape_timeout / 2)
+
+
+def deadline_passed(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+async def scrape(target: str, deadline: float = None) -> Perfdata:
+    """
+    Fetch the data of the target from icinga2 and parse it into metrics
+    :param target:
+    :param deadline: optional time.monotonic() the scrape must be done by
+    :return:
+    """
+    monitor_data = Perfdata(monitorconnection.MonitorConfig(), target, deadline)
 
     # Fetch performance data from Monitor
     start_time = time.monotonic()
-    try:
-        loop = asyncio.get_event_loop()
-        fetch_perfdata_task = loop.create_task(monitor_data.get_service_metrics())
+    loop = asyncio.get_event_loop()
+    fetch_perfdata_task = loop.create_task(monitor_data.get_service_metrics())
+    fetch_metadata_task = None
 
+    try:
         if monitorconnection.MonitorConfig().get_enable_scrape_metadata():
             fetch_metadata_task = loop.create_task(monitor_data.get_host_metrics())
             await fetch_metadata_task
 
         await fetch_perfdata_task
+    finally:
+        # Do not leave a request running when the other failed
+        for task in (fetch_perfdata_task, fetch_metadata_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+    scrape_duration = time.monotonic() - start_time
+    monitor_data.add_perfdata("scrape_duration_seconds",
+                              {'hostname': target, 'server': monitorconnection.MonitorConfig().get_url()},
+                              scrape_duration, SCRAPE_DURATION_HELP)
+    log.info("scrape", {'target': target, 'url': request.url, 'scrape_time': scrape_duration})
+    return monitor_data
+
+
+async def stream_scrape(target: str, url: str, deadline: float = None) -> AsyncIterator[str]:
+    """
+    Scrape the target and stream the metrics one service at a time. The first chunk is awaited before the
+    response is returned, so a failing request to icinga2 is still answered with a 500. A failure after the
+    first chunk abort the response.
+    :param target:
+    :param url: the url of the request, used for logging
+    :param deadline: optional time.monotonic() the scrape must be done by
+    :return:
+    """
+    chunks = scrape_chunks(target, url, deadline)
+    first_chunk = await chunks.__anext__()
+
+    async def body() -> AsyncIterator[str]:
+        yield first_chunk
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except monitorconnection.ScrapeExecption as err:
+            log.warn(f"{err.message}", {'target': target, 'url': url, 'remote_url': err.url, 'err': err.err})
+            raise
+
+    return body()
+
+
+async def scrape_chunks(target: str, url: str, deadline: float = None) -> AsyncIterator[str]:
+    """
+    Fetch the data of the target from icinga2 and yield the metrics of each service as it is parsed. The
+    host metrics are fetched concurrently and rendered with the following service, the scrape duration last.
+    :param target:
+    :param url: the url of the request, used for logging
+    :param deadline: optional time.monotonic() the scrape must be done by
+    :return:
+    """
+    monitor = monitorconnection.MonitorConfig()
+    monitor_data = Perfdata(monitor, target, deadline)
+
+    start_time = time.monotonic()
+    fetch_metadata_task = None
+    if monitor.get_enable_scrape_metadata():
+        fetch_metadata_task = asyncio.get_event_loop().create_task(monitor_data.get_host_metrics())
+
+    try:
+        async for chunk in monitor_data.iter_service_metrics():
+            yield chunk
+
+        if fetch_metadata_task is not None:
+            await fetch_metadata_task
 
         scrape_duration = time.monotonic() - start_time
-        monitor_data.add_perfdata("scrape_duration_seconds",
-                                  {'hostname': target, 'server': monitorconnection.MonitorConfig().get_url()},
-                                  scrape_duration)
-        log.info("scrape", {'target': target, 'url': request.url, 'scrape_time': scrape_duration})
-        target_metrics = monitor_data.prometheus_format()
-
-        resp = Response(target_metrics)
-        resp.headers['Content-Type'] = CONTENT_TYPE_LATEST
-        # after_request_func(resp)
+        monitor_data.add_perfdata("scrape_duration_seconds", {'hostname': target, 'server': monitor.get_url()},
+                                  scrape_duration, SCRAPE_DURATION_HELP)
+        log.info("scrape", {'target': target, 'url': url, 'scrape_time': scrape_duration})
+        chunk = monitor_data.flush()
+        monitor_data.observe()
+        yield chunk
+    finally:
+        if fetch_metadata_task is not None and not fetch_metadata_task.done():
+            fetch_metadata_task.cancel()
+
+
+async def cached_scrape(target: str, exposition_format: str = exposition.TEXT,
+                        deadline: float = None) -> Tuple[CachedResponse, bool]:
+    """
+    Get the metrics of the target from the response cache. If not cached, expired or any check of the target
+    has been executed since cached, the target is scraped. Concurrent scrapes of the same target share one
+    scrape. The text format is cached by target, the other formats by target and format.
+
+    If stale responses are enabled the last good response of the target, not older than the stale response ttl,
+    is used when the scrape fails, or when it is slower than the stale response timeout or the deadline. A slow
+    scrape keeps running in the background and replaces the stale response when done. Otherwise the expired
+    response is used if the scrape fails after the deadline, if still cached. A partial scrape cut short by the
+    deadline is not cached.
+    :param target:
+    :param exposition_format:
+    :param deadline: optional time.monotonic() the scrape must be done by
+    :return: the response and True if stale
+    """
+    monitor = monitorconnection.MonitorConfig()
+    cache = monitor.get_response_cache()
+    stale_cache = monitor.get_stale_response_cache()
+    stale_ttl = monitor.get_stale_response_ttl()
+    cache_key = target if exposition_format == exposition.TEXT else (target, exposition_format)
+
+    if stale_ttl > 0:
+        stale = stale_cache.peek(cache_key)
+        if stale is not None and time.monotonic() - stale.created > stale_ttl:
+            stale_cache.remove(cache_key)
+            stale = None
+    else:
+        stale = cache.peek(cache_key)
+
+    if monitor.get_response_cache_ttl() > 0:
+        cached = cache.get(cache_key, valid=lambda entry: entry.is_fresh(monitor.get_response_cache_ttl(),
+                                                                         monitor.get_last_check_time(target)))
+        if cached is not None:
+            return cached, False
+
+    # A scrape that can be answered with the stale response is a background refresh, not cut short by the deadline
+    background = stale is not None and stale_ttl > 0
+
+    async def scrape_and_cache() -> CachedResponse:
+        monitor_data = await scrape(target, None if background else deadline)
+        entry = CachedResponse(monitor_data.prometheus_format(exposition_format), monitor_data.last_check_time)
+        monitor_data.observe()
+        if not monitor_data.deadline_exceeded:
+            if monitor.get_response_cache_ttl() > 0:
+                cache.put(cache_key, entry)
+            # Not shared with the response cache, that keep the compressed bodies with the response
+            stale_cache.put(cache_key, CachedResponse(entry.body, entry.last_check_time))
+        return entry
+
+    timeout = None
+    if background:
+        if monitor.get_stale_response_timeout() > 0:
+            timeout = monitor.get_stale_response_timeout()
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+    try:
+        # A timeout cancel the wait, the shared scrape keeps running
+        cached, _ = await asyncio.wait_for(scrapes.do(cache_key, scrape_and_cache), timeout)
+    except asyncio.TimeoutError:
+        reason = 'deadline' if deadline_passed(deadline) else 'timeout'
+        log.warn(f"Scrape slower than the stale response {reason}, using the stale response", {'target': target})
+        exportermetrics.stale_responses.labels(reason).inc()
+        return stale, True
+    except monitorconnection.ScrapeExecption as err:
+        if stale is None or not (stale_ttl > 0 or deadline_passed(deadline)):
+            raise
+        reason = 'deadline' if deadline_passed(deadline) else 'error'
+        log.warn(f"{err.message}, using the stale response",
+                 {'target': target, 'remote_url': err.url, 'err': err.err})
+        if reason == 'deadline':
+            exportermetrics.scrape_deadline_exceeded.labels('upstream').inc()
+        exportermetrics.stale_responses.labels(reason).inc()
+        # Kept as the stale response of the next scrape
+        if stale_ttl <= 0 and cache_key not in cache:
+            cache.put(cache_key, stale)
+        return stale, True
+    return cached, False
+
+
+@app.route("/metrics/batch", methods=['GET'])
+async def get_batch_metrics():
+    targets = request.args.getlist('target')
+    hostgroup = request.args.get('hostgroup')
+    filter_expression = request.args.get('filter')
+
+    if not targets and not hostgroup and not filter_expression:
+        resp = Response("One of target, hostgroup or filter is required")
+        resp.status_code = 400
         return resp
+
+    if filter_expression and not (targets or hostgroup) and \
+            not monitorconnection.MonitorConfig().get_enable_batch_filter():
+        resp = Response("Filter expressions are not enabled")
+        resp.status_code = 403
+        return resp
+
+    start_time = time.monotonic()
+    try:
+        services_json, hosts_json = await monitorconnection.MonitorConfig().async_get_batch_data(
+            targets, hostgroup, filter_expression)
     except monitorconnection.ScrapeExecption as err:
-        log.warn(f"{err.message}", {'target': target, 'url': request.url, 'remote_url': err.url, 'err': err.err})
+        log.warn(f"{err.message}", {'url': request.url, 'remote_url': err.url, 'err': err.err})
         resp = Response("")
-        resp.status_code = 500
+        resp.status_code = err.status
         return resp
 
+    log.info("batch", {'url': request.url, 'upstream_time': time.monotonic() - start_time})
+    resp = Response(count_response_bytes(request.path, render_batch(services_json, hosts_json, start_time)))
+    resp.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return resp
+
+
+async def render_batch(services_json: Dict[str, Any], hosts_json: Dict[str, Any],
+                       start_time: float) -> AsyncIterator[str]:
+    """
+    Render the metrics of the batch one host at a time. The scrape duration of each host is the time of the
+    requests to icinga2 and the time to render the host. The scrape duration of the batch is the total time.
+    :param services_json:
+    :param hosts_json:
+    :param start_time:
+    :return:
+    """
+    monitor = monitorconnection.MonitorConfig()
+    upstream_duration = time.monotonic() - start_time
+
+    services_by_host = {}
+    for service_attrs in services_json.get('results', []):
+        services_by_host.setdefault(service_attrs['attrs']['host_name'], []).append(service_attrs)
+    hosts_by_name = {host_attrs['attrs']['name']: host_attrs for host_attrs in hosts_json.get('results', [])}
+
+    batch_data = Perfdata(monitor, None)
+    # Parse the perfdata of the whole batch in one pass, the range-aware parser has no batch version
+    if not monitor.get_enable_perfdata_ranges():
+        parse_start_time = time.monotonic()
+        perfdatabatch.cache_perf_strings(monitor.get_perfdata_cache(),
+                                         perfdatabatch.perf_strings(services_json.get('results', []) +
+                                                                    hosts_json.get('results', [])))
+        batch_data.parse_seconds += time.monotonic() - parse_start_time
+
+    hostnames = list(services_by_host) + [hostname for hostname in hosts_by_name if hostname not in services_by_host]
+    for hostname in hostnames:
+        host_start_time = time.monotonic()
+        monitor_data = Perfdata(monitor, hostname)
+        for service_attrs in services_by_host.get(hostname, []):
+            monitor_data.add_service_metrics(service_attrs)
+        if hostname in hosts_by_name:
+            monitor_data.add_host_metrics(hosts_by_name[hostname])
+
+        monitor_data.add_perfdata("scrape_duration_seconds", {'hostname': hostname, 'server': monitor.get_url()},
+                                  upstream_duration + time.monotonic() - host_start_time)
+        chunk = monitor_data.prometheus_format()
+        batch_data.parse_seconds += monitor_data.parse_seconds
+        batch_data.render_seconds += monitor_data.render_seconds
+        monitor_data.count_dropped_series()
+        yield chunk
+
+    batch_data.add_perfdata("batch_scrape_duration_seconds", {'server': monitor.get_url()},
+                            time.monotonic() - start_time)
+    batch_data.add_perfdata("batch_hosts", {'server': monitor.get_url()}, len(hostnames))
+    chunk = batch_data.prometheus_format()
+    # The parse and render time of all hosts of the batch
+    batch_data.observe()
+    yield chunk
+
+
+def count_response_bytes(path: str, body):
+    """
+    Observe the size of the response body on the exporter metrics. A streamed body is observed when sent.
+    :param path:
+    :param body: the body, str, bytes or an async iterator of str or bytes
+    :return: the body encoded as bytes
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if isinstance(body, bytes):
+        exportermetrics.response_bytes.labels(path).observe(len(body))
+        return body
+
+    async def counted() -> AsyncIterator[bytes]:
+        size = 0
+        try:
+            async for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                size += len(chunk)
+                yield chunk
+        finally:
+            exportermetrics.response_bytes.labels(path).observe(size)
+
+    return counted()
+
+
+@app.route("/exporter-metrics", methods=['GET'])
+def get_exporter_metrics():
+    resp = Response(generate_latest(exportermetrics.registry))
+    resp.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return resp
+
 
 @app.route("/health", methods=['GET'])
 def get_health():
     return check_healthy()
 
 
+@app.after_request
+async def count_request(response):
+    exportermetrics.requests.labels(request.path).inc()
+    if response.status_code != 200:
+        exportermetrics.error_responses.labels(request.path, str(response.status_code)).inc()
+    return response
+
+
 # @app.after_request
 def after_request_func(response):
-    total_requests.inc()
-
     call_status = {'remote_addr': request.remote_addr, 'url': request.url, 'user_agent': request.user_agent,
                    'content_length': response.content_length, 'status': response.status_code}
     log.info('Access', call_status)
@@ -91,6 +474,6 @@ def after_request_func(response):
 
 
 def check_healthy() -> Response:
-    resp = jsonify({'status': 'ok'})
+    resp = Response(jsoncodec.dumps({'status': 'ok'}), content_type='application/json')
     resp.status_code = 200
     return resp
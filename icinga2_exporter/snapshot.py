@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import fnmatch
+import time
+from typing import Dict, Any, List
+
+
+class Snapshot:
+    """
+    Host indexed snapshot of all services and hosts fetched from icinga2 in bulk requests. Used to serve
+    the metrics of a target without any request to icinga2.
+
+    The snapshot can be kept up to date by applying the events from the icinga2 event stream.
+    """
+
+    def __init__(self, services_json: Dict[str, Any], hosts_json: Dict[str, Any] = None):
+        self.created = time.monotonic()
+        self.updated = self.created
+        self.services: Dict[str, List[Dict[str, Any]]] = {}
+        self.hosts: Dict[str, Dict[str, Any]] = {}
+        # All objects by the icinga2 object name, host!service for services
+        self.objects: Dict[str, Dict[str, Any]] = {}
+
+        for service_attrs in services_json.get('results', []):
+            self.services.setdefault(service_attrs['attrs']['host_name'], []).append(service_attrs)
+            self.objects[service_attrs['attrs']['__name']] = service_attrs
+
+        if hosts_json:
+            for host_attrs in hosts_json.get('results', []):
+                self.hosts[host_attrs['attrs']['name']] = host_attrs
+                self.objects[host_attrs['attrs']['__name']] = host_attrs
+
+    def age(self) -> float:
+        """
+        Seconds since the snapshot was fetched from icinga2 or last updated by an event
+        :return:
+        """
+        return time.monotonic() - self.updated
+
+    def apply_event(self, event: Dict[str, Any]) -> bool:
+        """
+        Update the snapshot with a CheckResult or StateChange event from the icinga2 event stream. Events for
+        objects not in the snapshot, or with a check result older than the one in the snapshot, are ignored.
+        :param event:
+        :return: true if the snapshot was updated
+        """
+        if event.get('type') not in ('CheckResult', 'StateChange') or 'check_result' not in event:
+            return False
+
+        name = event['host']
+        if event.get('service'):
+            name = f"{event['host']}!{event['service']}"
+        object_attrs = self.objects.get(name)
+        if object_attrs is None:
+            return False
+
+        attrs = object_attrs['attrs']
+        check_result = event['check_result']
+        if attrs.get('last_check_result') is not None and \
+                (check_result.get('execution_end') or 0.0) < (attrs['last_check_result'].get('execution_end') or 0.0):
+            return False
+
+        attrs['last_check_result'] = check_result
+        # The state of the object is only known from StateChange, the check result state of a host is not the
+        # host state
+        if event['type'] == 'StateChange':
+            attrs['state'] = event.get('state', attrs.get('state'))
+            attrs['state_type'] = event.get('state_type', attrs.get('state_type'))
+
+        self.updated = time.monotonic()
+        return True
+
+    def get_service_data(self, hostname: str) -> Dict[str, Any]:
+        """
+        Get the services of the hostname in the same format as returned by icinga2. The hostname can be a
+        glob pattern, like the match() filter used in the icinga2 query
+        :param hostname:
+        :return:
+        """
+        if Snapshot.is_pattern(hostname):
+            results = []
+            for host_name in fnmatch.filter(self.services.keys(), hostname):
+                results.extend(self.services[host_name])
+            return {'results': results}
+
+        return {'results': self.services.get(hostname, [])}
+
+    def get_host_data(self, hostname: str) -> Dict[str, Any]:
+        """
+        Get the host in the same format as returned by icinga2
+        :param hostname:
+        :return:
+        """
+        if hostname in self.hosts:
+            return {'results': [self.hosts[hostname]]}
+        return {'results': []}
+
+    def last_check_time(self, hostname: str) -> float:
+        """
+        Get the time of the latest check result of the services, and the host, of the hostname
+        :param hostname:
+        :return:
+        """
+        last_check_time = 0.0
+        objects = self.get_service_data(hostname)['results'] + self.get_host_data(hostname)['results']
+        for object_attrs in objects:
+            last_check_result = object_attrs['attrs'].get('last_check_result')
+            if last_check_result is not None:
+                last_check_time = max(last_check_time, last_check_result.get('execution_end') or 0.0)
+        return last_check_time
+
+    @staticmethod
+    def is_pattern(hostname: str) -> bool:
+        return '*' in hostname or '?' in hostname
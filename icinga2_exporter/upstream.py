@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import bisect
+import collections
+import random
+from typing import Deque, List, Optional, Sequence
+
+import icinga2_exporter.exportermetrics as exportermetrics
+
+# The latencies kept per endpoint for the hedge delay, and the least needed before requests are hedged
+LATENCY_WINDOW = 100
+MIN_LATENCY_SAMPLES = 20
+# The weight of the latest request in the health of an endpoint, and the least weight an unhealthy endpoint has
+HEALTH_DECAY = 0.2
+MIN_HEALTH = 0.01
+
+
+class UpstreamStatusError(Exception):
+    """
+    Icinga2 answered with a server error, the request may succeed when retried
+    """
+
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+
+class Endpoint:
+    """
+    An icinga2 api endpoint, like one of the masters of a HA zone. The health is a moving average of the outcome
+    of the requests, 1.0 when all succeed, and the latencies of the latest requests are kept for the hedge delay.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.health = 1.0
+        self.latencies: Deque[float] = collections.deque(maxlen=LATENCY_WINDOW)
+        exportermetrics.upstream_endpoint_health.labels(url).set_function(lambda: self.health)
+
+    def observe(self, latency: float):
+        self.latencies.append(latency)
+        self.health += HEALTH_DECAY * (1.0 - self.health)
+        exportermetrics.upstream_endpoint_request_seconds.labels(self.url).observe(latency)
+
+    def fail(self, error_type: str):
+        self.health -= HEALTH_DECAY * self.health
+        exportermetrics.upstream_endpoint_errors.labels(self.url, error_type).inc()
+
+    def latency_quantile(self, quantile: float) -> Optional[float]:
+        """
+        Get the quantile of the latest latencies
+        :param quantile:
+        :return: None until enough requests have completed
+        """
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+
+class Endpoints:
+    """
+    The icinga2 api endpoints, the first is the primary that the configured urls are relative to. An endpoint is
+    selected at random weighted by its health, so the load is shared by healthy endpoints and moves away from
+    failing ones, that are still tried now and then to notice when they recover.
+    """
+
+    def __init__(self, urls: Sequence[str]):
+        self.primary = urls[0]
+        self.endpoints: List[Endpoint] = [Endpoint(url) for url in urls]
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def select(self, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        """
+        Select an endpoint, not one of the excluded unless all are excluded
+        :param exclude: the endpoints already tried
+        :return:
+        """
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+        if len(candidates) == 1:
+            return candidates[0]
+
+        cumulative = []
+        total = 0.0
+        for endpoint in candidates:
+            total += max(endpoint.health, MIN_HEALTH)
+            cumulative.append(total)
+        return candidates[min(bisect.bisect(cumulative, random.random() * total), len(candidates) - 1)]
+
+    def url(self, url: str, endpoint: Endpoint) -> str:
+        """
+        Rebase a url of the primary endpoint on the endpoint
+        :param url:
+        :param endpoint:
+        :return:
+        """
+        if endpoint.url == self.primary or not url.startswith(self.primary):
+            return url
+        return endpoint.url + url[len(self.primary):]
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """
+    The delay before a retry, exponential backoff with full jitter so retries from concurrent scrapes are spread
+    :param attempt: the number of the failed attempt, starting at 0
+    :param base: the delay cap of the first retry
+    :param cap: the largest delay
+    :return:
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
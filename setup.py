@@ -35,5 +35,6 @@ setup(
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',
     install_requires=read('requirements.txt').split(),
+    extras_require={'orjson': ['orjson'], 'zstd': ['zstandard']},
     python_requires='>=3.6',
 )
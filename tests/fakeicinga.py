@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import fnmatch
+import json
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+
+class FakeIcinga2:
+    """
+    Local stand-in for the icinga2 api, serving the objects it is created with on /v1/objects/services and
+    /v1/objects/hosts and streaming the pushed events as newline delimited json on /v1/events. The latency can
+    be set to increase with the number of requests in flight, like an overloaded icinga2, and requests can be
+    answered with 503 Service Unavailable, like an icinga2 that is reloading.
+    """
+
+    def __init__(self, services: List[Dict[str, Any]] = None, hosts: List[Dict[str, Any]] = None,
+                 hostgroups: Dict[str, List[str]] = None):
+        self.services = services or []
+        # The services by host name, so large fleets can be served for the benchmarks
+        self.services_by_host: Dict[str, List[Dict[str, Any]]] = {}
+        for service_attrs in self.services:
+            self.services_by_host.setdefault(service_attrs['attrs']['host_name'], []).append(service_attrs)
+        self.hosts = hosts or []
+        self.hostgroups = hostgroups or {}
+        self.requests = []
+        # The client address of each connection a request was received on
+        self.connections = set()
+        # Seconds each request is delayed, plus latency_per_request for each other request in flight
+        self.latency = 0.0
+        self.latency_per_request = 0.0
+        self.in_flight = 0
+        # The number of following requests answered with 503
+        self.unavailable = 0
+        # Seconds before each service of a services response is sent, like a large response received slowly
+        self.trickle = 0.0
+        self.event_streams: List[asyncio.Queue] = []
+        self.runner = None
+        self.url = None
+
+    def add_service(self, service_attrs: Dict[str, Any]):
+        self.services.append(service_attrs)
+        self.services_by_host.setdefault(service_attrs['attrs']['host_name'], []).append(service_attrs)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.availability])
+        app.router.add_post('/v1/objects/services', self.get_services)
+        app.router.add_post('/v1/objects/hosts', self.get_hosts)
+        app.router.add_post('/v1/objects/hosts/{hostname}', self.get_hosts)
+        app.router.add_post('/v1/events', self.get_events)
+        return app
+
+    @web.middleware
+    async def availability(self, request: web.Request, handler) -> web.StreamResponse:
+        self.connections.add(request.transport.get_extra_info('peername'))
+        if self.unavailable:
+            self.unavailable -= 1
+            self.requests.append((request.path, None))
+            return web.Response(status=503)
+        return await handler(request)
+
+    async def start(self) -> str:
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = 'http://127.0.0.1:{}'.format(site._server.sockets[0].getsockname()[1])
+        return self.url
+
+    async def stop(self):
+        self.close_event_streams()
+        await self.runner.cleanup()
+
+    def push_event(self, event: Dict[str, Any]):
+        for queue in self.event_streams:
+            queue.put_nowait(event)
+
+    def close_event_streams(self):
+        for queue in self.event_streams:
+            queue.put_nowait(None)
+
+    async def body(self, request: web.Request) -> Dict[str, Any]:
+        text = await request.text()
+        body = json.loads(text) if text and text != 'null' else {}
+        self.requests.append((request.path, body))
+        if self.latency or self.latency_per_request:
+            self.in_flight += 1
+            try:
+                await asyncio.sleep(self.latency + self.latency_per_request * (self.in_flight - 1))
+            finally:
+                self.in_flight -= 1
+        return body
+
+    async def get_services(self, request: web.Request) -> web.Response:
+        body = await self.body(request)
+        services = self.services
+        if body.get('filter') == 'service.host_name==target':
+            services = self.services_by_host.get(body['filter_vars']['target'], [])
+        elif body.get('filter') == 'match(target,service.host_name)':
+            host_name = body['filter_vars']['target']
+            services = [service for service in services
+                        if fnmatch.fnmatchcase(service['attrs']['host_name'], host_name)]
+        elif body.get('filter') == 'service.host_name in targets':
+            targets = body['filter_vars']['targets']
+            services = [service for service in services if service['attrs']['host_name'] in targets]
+        elif body.get('filter') == 'hostgroup in host.groups':
+            members = self.hostgroups.get(body['filter_vars']['hostgroup'], [])
+            services = [service for service in services if service['attrs']['host_name'] in members]
+        if self.trickle:
+            return await self.trickle_results(request, services)
+        return web.json_response({'results': services})
+
+    async def trickle_results(self, request: web.Request, results: List[Dict[str, Any]]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await response.prepare(request)
+        await response.write(b'{"results": [')
+        for index, result in enumerate(results):
+            await asyncio.sleep(self.trickle)
+            await response.write((b', ' if index else b'') + json.dumps(result).encode())
+        await response.write(b']}')
+        return response
+
+    async def get_hosts(self, request: web.Request) -> web.Response:
+        body = await self.body(request)
+        hosts = self.hosts
+        if 'hostname' in request.match_info:
+            hosts = [host for host in hosts if host['attrs']['name'] == request.match_info['hostname']]
+        elif body.get('filter') == 'host.name in targets':
+            hosts = [host for host in hosts if host['attrs']['name'] in body['filter_vars']['targets']]
+        elif body.get('filter') == 'hostgroup in host.groups':
+            members = self.hostgroups.get(body['filter_vars']['hostgroup'], [])
+            hosts = [host for host in hosts if host['attrs']['name'] in members]
+        return web.json_response({'results': hosts})
+
+    async def get_events(self, request: web.Request) -> web.StreamResponse:
+        await self.body(request)
+        queue = asyncio.Queue()
+        self.event_streams.append(queue)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                await response.write(json.dumps(event).encode() + b'\n')
+        finally:
+            self.event_streams.remove(queue)
+        return response
+
+
+def service(host_name: str, name: str, check_command: str, performance_data: List[Any],
+            execution_end: float = 1.0, host_vars: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Create a service object as returned by icinga2
+    """
+    return {'attrs': {'__name': f"{host_name}!{name}", 'display_name': name, 'check_command': check_command,
+                      'host_name': host_name, 'vars': None,
+                      'last_check_result': {'performance_data': performance_data, 'execution_end': execution_end,
+                                            'output': 'OK'},
+                      'downtime_depth': 0.0, 'acknowledgement': 0.0, 'max_check_attempts': 3.0,
+                      'last_reachable': True, 'state': 0.0, 'state_type': 1.0},
+            'joins': {'host': {'vars': host_vars if host_vars is not None else {'env': 'prod'}}},
+            'meta': {}, 'name': f"{host_name}!{name}", 'type': 'Service'}
+
+
+def host(name: str, performance_data: List[Any] = None, host_vars: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Create a host object as returned by icinga2
+    """
+    return {'attrs': {'__name': name, 'name': name, 'address': '127.0.0.1', 'check_command': 'hostalive',
+                      'vars': host_vars if host_vars is not None else {'env': 'prod'},
+                      'last_check_result': {'performance_data': performance_data or [], 'execution_end': 1.0},
+                      'downtime_depth': 0.0, 'acknowledgement': 0.0, 'max_check_attempts': 3.0,
+                      'last_reachable': True, 'state': 0.0, 'state_type': 1.0},
+            'joins': {}, 'meta': {}, 'name': name, 'type': 'Host'}
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Minimal decoder of the delimited protobuf exposition format, shared by the tests and the benchmarks
+"""
+
+import struct
+
+
+def varint(data: bytes, position: int):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def fields(data: bytes):
+    """
+    Decode the fields of a protobuf message as (number, value) with the raw bytes of length delimited and
+    fixed64 fields
+    """
+    position = 0
+    while position < len(data):
+        key, position = varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = varint(data, position)
+        elif wire_type == 1:
+            value, position = data[position:position + 8], position + 8
+        else:
+            length, position = varint(data, position)
+            value, position = data[position:position + length], position + length
+        yield number, value
+
+
+def metric_families(data: bytes):
+    """
+    Decode length delimited io.prometheus.client.MetricFamily messages as {name: (type, [(labels, value)])}
+    """
+    families = {}
+    position = 0
+    while position < len(data):
+        length, position = varint(data, position)
+        family = dict(name=None, type=None, metrics=[])
+        for number, value in fields(data[position:position + length]):
+            if number == 1:
+                family['name'] = value.decode('utf-8')
+            elif number == 3:
+                family['type'] = value
+            elif number == 4:
+                labels = {}
+                sample = None
+                for metric_number, metric_value in fields(value):
+                    if metric_number == 1:
+                        pair = dict(fields(metric_value))
+                        labels[pair[1].decode('utf-8')] = pair[2].decode('utf-8')
+                    else:
+                        sample = struct.unpack('<d', dict(fields(metric_value))[1])[0]
+                family['metrics'].append((labels, sample))
+        families[family['name']] = (family['type'], family['metrics'])
+        position += length
+    return families
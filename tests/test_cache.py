@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import unittest
+
+from icinga2_exporter.cache import CachedResponse, LRUCache, SingleFlight
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache('test', 2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(1, cache.evictions._value.get())
+
+    def test_hits_and_misses(self):
+        cache = LRUCache('test_counters', 10)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+
+        self.assertEqual(2, cache.hits._value.get())
+        self.assertEqual(1, cache.misses._value.get())
+
+    def test_disabled(self):
+        cache = LRUCache('test_disabled', 0)
+        cache.put('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_maxbytes(self):
+        cache = LRUCache('test_maxbytes', 10, maxbytes=10)
+        cache.put('a', CachedResponse('12345', 1.0))
+        cache.put('b', CachedResponse('12345', 1.0))
+        cache.put('c', CachedResponse('123', 1.0))
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(8, cache.bytes)
+
+    def test_resize(self):
+        cache = LRUCache('test_resize', 10, maxbytes=10)
+        cache.put('a', CachedResponse('12345', 1.0))
+        cache.put('b', CachedResponse('123', 1.0))
+        cache.get('a').encode('gzip', lambda data: data[:2])
+        cache.resize('a')
+
+        self.assertEqual(10, cache.bytes)
+        cache.get('b').encode('gzip', lambda data: data[:1])
+        cache.resize('b')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(4, cache.bytes)
+
+    def test_invalid_entry_is_removed(self):
+        cache = LRUCache('test_valid', 10)
+        cache.put('a', CachedResponse('body', 1.0))
+
+        self.assertIsNone(cache.get('a', valid=lambda entry: entry.is_fresh(60, 2.0)))
+        self.assertEqual(0, len(cache))
+
+
+class CachedResponseTest(unittest.TestCase):
+
+    def test_is_fresh(self):
+        response = CachedResponse('body', 1.0)
+
+        self.assertTrue(response.is_fresh(60))
+        self.assertTrue(response.is_fresh(60, 1.0))
+        self.assertFalse(response.is_fresh(60, 2.0))
+        self.assertFalse(response.is_fresh(-1))
+
+    def test_encode_once(self):
+        response = CachedResponse('body', 1.0)
+        calls = []
+
+        def compress(data: bytes) -> bytes:
+            calls.append(data)
+            return data.upper()
+
+        self.assertEqual(b'BODY', response.encode('gzip', compress))
+        self.assertEqual(b'BODY', response.encode('gzip', compress))
+        self.assertEqual([b'body'], calls)
+        self.assertEqual(8, response.size())
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_calls_are_shared(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        results = await asyncio.gather(*[flight.do('key', call) for _ in range(5)])
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([(1, False)] + [(1, True)] * 4, results)
+        self.assertEqual((2, False), await flight.do('key', call))
+
+    async def test_exception_is_shared(self):
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.01)
+            raise ValueError('failed')
+
+        results = await asyncio.gather(*[flight.do('key', call) for _ in range(2)], return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_timeout_of_shared_call(self):
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.1)
+            return 'result'
+
+        first = asyncio.ensure_future(flight.do('key', call))
+        await asyncio.sleep(0)
+        with self.assertRaises(asyncio.TimeoutError):
+            await flight.do('key', call, timeout=0.01)
+
+        # The call in flight is not cancelled by the caller that gave up
+        self.assertEqual(('result', False), await first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import unittest
+
+import icinga2_exporter.monitorconnection as monitorconnection
+from icinga2_exporter.perfdata import Perfdata
+from fakeicinga import FakeIcinga2, host, service
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError('Condition not met within timeout')
+        await asyncio.sleep(0.01)
+
+
+class EventStreamTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.icinga2 = FakeIcinga2(services=[service('h1', 'load', 'load', ['load1=0.5;5;10;0'])],
+                                   hosts=[host('h1')])
+        url = await self.icinga2.start()
+        self.monitor = monitorconnection.MonitorConfig({'icinga2': {
+            'url': url, 'user': 'user', 'passwd': 'passwd', 'metric_prefix': 'icinga2',
+            'enable_event_stream': True, 'enable_scrape_metadata': True, 'event_stream_reconnect_interval': 0}})
+        self.monitor.start_snapshot_refresh()
+        await wait_for(lambda: self.monitor.snapshot is not None)
+
+    async def asyncTearDown(self):
+        await self.monitor.stop_snapshot_refresh()
+        await self.monitor.close_session()
+        await self.icinga2.stop()
+
+    async def render(self) -> str:
+        perfdata = Perfdata(self.monitor, 'h1')
+        await perfdata.get_service_metrics()
+        await perfdata.get_host_metrics()
+        return perfdata.prometheus_format()
+
+    def upstream_requests(self, path: str) -> int:
+        return len([request for request in self.icinga2.requests if request[0] == path])
+
+    async def test_check_result_updates_the_snapshot(self):
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 0.5\n', await self.render())
+
+        self.icinga2.push_event({'type': 'CheckResult', 'host': 'h1', 'service': 'load',
+                                 'check_result': {'performance_data': ['load1=2.5;5;10;0'], 'execution_end': 2.0}})
+        await wait_for(lambda: self.monitor.get_last_check_time('h1') == 2.0)
+
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 2.5\n', await self.render())
+        self.assertEqual(1, self.upstream_requests('/v1/objects/services'))
+
+    async def test_state_change_and_old_check_result(self):
+        self.icinga2.push_event({'type': 'StateChange', 'host': 'h1', 'service': 'load', 'state': 2.0,
+                                 'state_type': 0.0,
+                                 'check_result': {'performance_data': ['load1=12'], 'execution_end': 3.0}})
+        self.icinga2.push_event({'type': 'CheckResult', 'host': 'h1', 'service': 'load',
+                                 'check_result': {'performance_data': ['load1=1'], 'execution_end': 2.0}})
+        self.icinga2.push_event({'type': 'CheckResult', 'host': 'h2', 'service': 'load',
+                                 'check_result': {'performance_data': ['load1=1'], 'execution_end': 4.0}})
+        await wait_for(lambda: self.monitor.get_last_check_time('h1') == 3.0)
+        await asyncio.sleep(0.05)
+
+        metrics = await self.render()
+        self.assertIn('icinga2_load_metadata_state{hostname="h1", service="load", env="prod"} 2.0\n', metrics)
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 12.0\n', metrics)
+        self.assertEqual({'results': []}, await self.monitor.async_get_service_data('h2'))
+
+    async def test_reconnect_and_resync(self):
+        self.icinga2.add_service(service('h1', 'ping', 'ping', ['rta=1ms']))
+        self.icinga2.close_event_streams()
+        await wait_for(lambda: 'h1!ping' in self.monitor.snapshot.objects)
+
+        self.assertIn('icinga2_ping_rta_seconds{hostname="h1", service="ping", env="prod"} 0.001\n',
+                      await self.render())
+        self.assertEqual(2, self.upstream_requests('/v1/events'))
+
+
+
+class EventStreamResyncTest(unittest.IsolatedAsyncioTestCase):
+
+    config = {}
+
+    async def asyncSetUp(self):
+        self.icinga2 = FakeIcinga2(services=[service('h1', 'load', 'load', ['load1=0.5'])], hosts=[host('h1')])
+        url = await self.icinga2.start()
+        config = {'url': url, 'user': 'user', 'passwd': 'passwd', 'metric_prefix': 'icinga2',
+                  'enable_event_stream': True, 'event_stream_reconnect_interval': 0}
+        config.update(self.config)
+        self.monitor = monitorconnection.MonitorConfig({'icinga2': config})
+        self.monitor.start_snapshot_refresh()
+        await wait_for(lambda: self.monitor.snapshot is not None)
+
+    async def asyncTearDown(self):
+        await self.monitor.stop_snapshot_refresh()
+        await self.monitor.close_session()
+        await self.icinga2.stop()
+
+    def upstream_requests(self, path: str) -> int:
+        return len([request for request in self.icinga2.requests if request[0] == path])
+
+
+class PeriodicResyncTest(EventStreamResyncTest):
+
+    config = {'event_stream_resync_interval': 0.1}
+
+    async def test_created_services_are_added_while_connected(self):
+        self.icinga2.add_service(service('h2', 'load', 'load', ['load1=1']))
+
+        await wait_for(lambda: 'h2!load' in self.monitor.snapshot.objects)
+        self.assertEqual(1, self.upstream_requests('/v1/events'))
+
+    async def test_event_received_during_resync(self):
+        self.icinga2.latency = 0.3
+        snapshot = self.monitor.snapshot
+        services = self.upstream_requests('/v1/objects/services')
+        await wait_for(lambda: self.upstream_requests('/v1/objects/services') > services)
+
+        # Received while the resync is fetching the services, that are older than the event
+        self.icinga2.push_event({'type': 'CheckResult', 'host': 'h1', 'service': 'load',
+                                 'check_result': {'performance_data': ['load1=2.5'], 'execution_end': 2.0}})
+        await wait_for(lambda: self.monitor.snapshot is not snapshot)
+
+        self.assertEqual(2.0, self.monitor.get_last_check_time('h1'))
+        self.assertEqual(['load1=2.5'], self.monitor.snapshot.objects['h1!load']['attrs']['last_check_result']
+                         ['performance_data'])
+
+
+class IdleTimeoutTest(EventStreamResyncTest):
+
+    config = {'event_stream_idle_timeout': 0.1}
+
+    async def test_idle_stream_is_reconnected(self):
+        # The snapshot is seeded again after the reconnect
+        await wait_for(lambda: self.upstream_requests('/v1/objects/services') >= 2)
+
+        self.assertGreaterEqual(self.upstream_requests('/v1/events'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
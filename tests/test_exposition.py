@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import unittest
+
+from prometheus_client.openmetrics.parser import text_string_to_metric_families
+
+import icinga2_exporter.exposition as exposition
+from icinga2_exporter.perfdata import Perfdata
+from protobufdecode import metric_families
+from test_perfdata import fixture_monitor, read_fixture, render
+
+PROMETHEUS_ACCEPT = 'application/openmetrics-text;version=1.0.0,application/openmetrics-text;version=0.0.1;q=0.75,' \
+                    'text/plain;version=0.0.4;q=0.5,*/*;q=0.1'
+PROTOBUF_ACCEPT = 'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;' \
+                  'q=0.7,text/plain;version=0.0.4;q=0.3,*/*;q=0.1'
+
+
+class NegotiateTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        all_formats = [exposition.OPENMETRICS, exposition.PROTOBUF]
+
+        self.assertEqual(exposition.OPENMETRICS, exposition.negotiate(PROMETHEUS_ACCEPT, all_formats))
+        self.assertEqual(exposition.PROTOBUF, exposition.negotiate(PROTOBUF_ACCEPT, all_formats))
+        self.assertEqual(exposition.TEXT, exposition.negotiate(PROMETHEUS_ACCEPT, [exposition.PROTOBUF]))
+        self.assertEqual(exposition.TEXT, exposition.negotiate('', all_formats))
+        self.assertEqual(exposition.TEXT, exposition.negotiate('application/vnd.google.protobuf', all_formats))
+
+
+class ExpositionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_openmetrics(self):
+        perfdata = await render(fixture_monitor())
+        families = list(text_string_to_metric_families(perfdata.prometheus_format(exposition.OPENMETRICS)))
+
+        self.assertEqual(len(perfdata.perfdatadict), sum(len(family.samples) for family in families))
+        self.assertEqual(len(families), len({family.name for family in families}))
+        duration = [family for family in families if family.name == 'icinga2_scrape_duration_seconds'][0]
+        self.assertEqual('gauge', duration.type)
+        self.assertEqual({'hostname': 'h1', 'server': 'https://localhost:5665'}, duration.samples[0].labels)
+
+    async def test_protobuf(self):
+        perfdata = await render(fixture_monitor())
+        families = metric_families(perfdata.prometheus_format(exposition.PROTOBUF))
+
+        samples = {}
+        for line in read_fixture('expected_metrics.txt').splitlines():
+            key, value = line.rsplit(' ', 1)
+            samples.setdefault(key.split('{')[0], []).append(float(value))
+        self.assertEqual(list(samples), list(families))
+        for name, (metric_type, metrics) in families.items():
+            self.assertEqual(0 if name == 'icinga2_procs_packets' else 1, metric_type)
+            self.assertEqual(samples[name], [value for _, value in metrics])
+        self.assertIn(({'hostname': 'h1', 'address': '10.0.0.1', 'env': 'prod', 'path': 'C:\\x', 'service': 'alive'},
+                       0.0001), families['icinga2_hostalive_rta_seconds'][1])
+
+    def test_counter(self):
+        perfdata = Perfdata(fixture_monitor(), 'h1')
+        perfdata.add_perfdata_metrics('snmp', ["in=100c errors_total=5c temp=40"], {}, 'hostname="h1"')
+
+        families = {family.name: family.type for family in
+                    text_string_to_metric_families(perfdata.prometheus_format(exposition.OPENMETRICS))}
+        self.assertEqual({'icinga2_snmp_in': 'unknown', 'icinga2_snmp_errors': 'counter', 'icinga2_snmp_temp': 'gauge'},
+                         families)
+        self.assertEqual({'icinga2_snmp_in': 0, 'icinga2_snmp_errors_total': 0, 'icinga2_snmp_temp': 1},
+                         {name: metric_type for name, (metric_type, _) in
+                          metric_families(perfdata.prometheus_format(exposition.PROTOBUF)).items()})
+
+
+    async def test_append(self):
+        perfdata = await render(fixture_monitor())
+        age = [('icinga2_exporter_data_age_seconds', 'gauge', 'age', [('hostname="h1"', 12.5)])]
+
+        text = exposition.append(perfdata.prometheus_format(), age, exposition.TEXT)
+        openmetrics = exposition.append(perfdata.prometheus_format(exposition.OPENMETRICS), age, exposition.OPENMETRICS)
+        protobuf = exposition.append(perfdata.prometheus_format(exposition.PROTOBUF), age, exposition.PROTOBUF)
+
+        self.assertTrue(text.endswith('\nicinga2_exporter_data_age_seconds{hostname="h1"} 12.5\n'))
+        families = {family.name: family for family in text_string_to_metric_families(openmetrics)}
+        self.assertEqual(12.5, families['icinga2_exporter_data_age_seconds'].samples[0].value)
+        self.assertEqual(1, openmetrics.count('# EOF'))
+        self.assertEqual(({'hostname': 'h1'}, 12.5),
+                         metric_families(protobuf)['icinga2_exporter_data_age_seconds'][1][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
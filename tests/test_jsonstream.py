@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import unittest
+
+from icinga2_exporter.jsonstream import iter_results
+
+
+class ChunkedContent:
+    """
+    Stand-in for the aiohttp response stream returning the data in fixed size chunks
+    """
+
+    def __init__(self, data: bytes, size: int):
+        self.data = data
+        self.size = size
+
+    async def read(self, n: int = -1) -> bytes:
+        chunk, self.data = self.data[:self.size], self.data[self.size:]
+        return chunk
+
+
+async def decode(data: bytes, size: int) -> list:
+    return [result async for result in iter_results(ChunkedContent(data, size), size)]
+
+
+class IterResultsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_chunk_boundaries(self):
+        results = [{'attrs': {'display_name': 'disk ' + 'åäö' * i, 'perf': ['/=1MB', "']'=2"]}} for i in range(10)]
+        data = json.dumps({'results': results}, ensure_ascii=False, indent=1).encode()
+
+        for size in (1, 2, 7, 64, len(data)):
+            self.assertEqual(results, await decode(data, size), size)
+
+    async def test_empty_and_missing_results(self):
+        self.assertEqual([], await decode(b'{"results": []}', 4))
+        self.assertEqual([], await decode(b'{"error": 404, "status": "No objects found."}', 4))
+
+    async def test_truncated_response(self):
+        with self.assertRaises(json.JSONDecodeError):
+            await decode(b'{"results": [{"attrs": {}}, {"attrs": ', 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
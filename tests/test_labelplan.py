@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import unittest
+
+from icinga2_exporter.labelplan import LabelPlan, ObjectLabels
+
+
+class LabelPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = LabelPlan({'Env': 'environment'}, {'disk': {'label_name': 'Disk'}})
+
+    def test_custom_labels(self):
+        labels, suffix = self.plan.custom_labels({'ENV': 'prod', 'OS': 'Linux', 'path': 'C:\\x', 'complex': {}})
+
+        self.assertEqual({'environment': 'prod', 'os': 'Linux', 'path': 'C:\\\\x', 'complex': {}}, labels)
+        self.assertEqual(', environment="prod", os="Linux", path="C:\\\\x"', suffix)
+        self.assertEqual('disk', self.plan.perfname_labels['disk'])
+
+    def test_allowed_custom_vars(self):
+        plan = LabelPlan({'Env': 'environment'}, {}, ['ENV', 'os'])
+
+        self.assertEqual(({'environment': 'prod', 'os': 'Linux'}, ', environment="prod", os="Linux"'),
+                         plan.custom_labels({'env': 'prod', 'OS': 'Linux', 'pid': '1234'}))
+
+    def test_labels(self):
+        object_labels = ObjectLabels(self.plan)
+
+        self.assertEqual(({'hostname': 'h1', 'service': 's1', 'os': 'Linux'},
+                          'hostname="h1", service="s1", os="Linux"'),
+                         object_labels.labels({'hostname': 'h1', 'service': 's1'}, {'os': 'Linux'}))
+        self.assertEqual('hostname="h1", service="s2", os="Linux"',
+                         object_labels.labels({'hostname': 'h1', 'service': 's2'}, {'os': 'Linux'})[1])
+        self.assertEqual('hostname="h1", service="s2"',
+                         object_labels.labels({'hostname': 'h1', 'service': 's2'}, None)[1])
+
+    def test_custom_vars_replace_static_labels(self):
+        object_labels = ObjectLabels(self.plan)
+
+        self.assertEqual('hostname="h1", service="custom"',
+                         object_labels.labels({'hostname': 'h1', 'service': 's1'}, {'Service': 'custom'})[1])
+        self.assertEqual('hostname="h1"',
+                         object_labels.labels({'hostname': 'h1', 'service': 's1'}, {'service': {}})[1])
+        self.assertEqual('os="Linux"', object_labels.labels({'address': None}, {'os': 'Linux'})[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
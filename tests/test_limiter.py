@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import unittest
+
+from icinga2_exporter.limiter import AdaptiveLimiter, LimitExceeded
+
+
+class AdaptiveLimiterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def hold(self, limiter: AdaptiveLimiter, seconds: float):
+        async with limiter.slot():
+            await asyncio.sleep(seconds)
+
+    async def test_limit_increase_when_reached(self):
+        limiter = AdaptiveLimiter(2, 1, 3, 10, 1.0, 1.0)
+
+        await asyncio.gather(*[self.hold(limiter, 0.01) for _ in range(8)])
+
+        self.assertEqual(3.0, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    async def test_idle_limit_does_not_increase(self):
+        limiter = AdaptiveLimiter(2, 1, 10, 10, 1.0, 1.0)
+
+        for _ in range(5):
+            await self.hold(limiter, 0)
+
+        self.assertEqual(2.0, limiter.limit)
+
+    async def test_limit_decrease_on_slow_requests_and_timeouts(self):
+        limiter = AdaptiveLimiter(4, 2, 10, 10, 1.0, 0.01)
+
+        await self.hold(limiter, 0.02)
+        self.assertAlmostEqual(3.6, limiter.limit)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            async with limiter.slot():
+                raise asyncio.TimeoutError()
+        self.assertAlmostEqual(3.24, limiter.limit)
+
+        for _ in range(10):
+            await self.hold(limiter, 0.02)
+        self.assertEqual(2.0, limiter.limit)
+
+    async def test_latency_threshold_of_request(self):
+        limiter = AdaptiveLimiter(4, 2, 10, 10, 1.0, 0.01)
+
+        async with limiter.slot(latency_threshold=1.0):
+            await asyncio.sleep(0.02)
+
+        self.assertEqual(4.0, limiter.limit)
+
+    async def test_queue_full(self):
+        limiter = AdaptiveLimiter(1, 1, 1, 1, 1.0, 1.0)
+        holding = asyncio.ensure_future(self.hold(limiter, 0.05))
+        queued = asyncio.ensure_future(self.hold(limiter, 0))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(LimitExceeded) as err:
+            await self.hold(limiter, 0)
+        self.assertEqual('queue_full', err.exception.reason)
+
+        await asyncio.gather(holding, queued)
+        self.assertEqual(0, limiter.in_flight)
+
+    async def test_queue_timeout(self):
+        limiter = AdaptiveLimiter(1, 1, 1, 10, 0.01, 1.0)
+        holding = asyncio.ensure_future(self.hold(limiter, 0.05))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(LimitExceeded) as err:
+            await self.hold(limiter, 0)
+        self.assertEqual('queue_timeout', err.exception.reason)
+        self.assertEqual(0, len(limiter.waiters))
+
+        await holding
+        self.assertEqual(0, limiter.in_flight)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import time
+import unittest
+
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.monitorconnection as monitorconnection
+from fakeicinga import FakeIcinga2, service
+
+
+class ServiceQueryTest(unittest.TestCase):
+
+    def test_exact_hostname(self):
+        query = monitorconnection.MonitorConfig.service_query('web01.example.com')
+
+        self.assertEqual('service.host_name==target', query['filter'])
+        self.assertEqual({'target': 'web01.example.com'}, query['filter_vars'])
+        self.assertNotIn('vars', query['attrs'])
+
+    def test_pattern_hostname(self):
+        query = monitorconnection.MonitorConfig.service_query('web*.example.com')
+
+        self.assertEqual('match(target,service.host_name)', query['filter'])
+        self.assertEqual({'target': 'web*.example.com'}, query['filter_vars'])
+
+    def test_endpoint(self):
+        self.assertEqual('services', monitorconnection.MonitorConfig.endpoint('https://icinga:5665/v1/objects/services'))
+        self.assertEqual('hosts', monitorconnection.MonitorConfig.endpoint('https://icinga:5665/v1/objects/hosts/h1'))
+        self.assertEqual('events', monitorconnection.MonitorConfig.endpoint('https://icinga:5665/v1/events'))
+
+
+class ServiceDataTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.icinga2 = FakeIcinga2(services=[service('web01', 'load', 'load', ['load1=1']),
+                                             service('web02', 'load', 'load', ['load1=2']),
+                                             service('db01', 'load', 'load', ['load1=3'])])
+        url = await self.icinga2.start()
+        self.monitor = monitorconnection.MonitorConfig({'icinga2': {'url': url, 'user': 'user', 'passwd': 'passwd'}})
+
+    async def asyncTearDown(self):
+        await self.monitor.close_session()
+        await self.icinga2.stop()
+
+    async def test_get_service_data(self):
+        exact = await self.monitor.async_get_service_data('web01')
+        pattern = await self.monitor.async_get_service_data('web*')
+
+        self.assertEqual(['web01!load'], [result['attrs']['__name'] for result in exact['results']])
+        self.assertEqual(['web01!load', 'web02!load'], [result['attrs']['__name'] for result in pattern['results']])
+
+
+class CoalescedRequestTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.icinga2 = FakeIcinga2(services=[service('web01', 'load', 'load', ['load1=1'])])
+        self.icinga2.latency = 0.2
+        url = await self.icinga2.start()
+        self.monitor = monitorconnection.MonitorConfig({'icinga2': {'url': url, 'user': 'user', 'passwd': 'passwd',
+                                                                    'retries': 0}})
+
+    async def asyncTearDown(self):
+        await self.monitor.close_session()
+        await self.icinga2.stop()
+
+    @staticmethod
+    def coalesced() -> float:
+        return exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_coalesced_requests_total') or 0.0
+
+    async def test_identical_requests_are_coalesced(self):
+        coalesced = self.coalesced()
+        url = self.monitor.get_url() + '/v1/objects/services'
+        query = monitorconnection.MonitorConfig.service_query('web01')
+
+        results = await asyncio.gather(*[self.monitor.async_post(url, query) for _ in range(5)])
+
+        self.assertEqual(1, len(self.icinga2.requests))
+        for result in results:
+            self.assertEqual(['web01!load'], [service_attrs['attrs']['__name'] for service_attrs in result['results']])
+        self.assertEqual(coalesced + 4, self.coalesced())
+
+    async def test_different_requests_are_not_coalesced(self):
+        url = self.monitor.get_url() + '/v1/objects/services'
+
+        await asyncio.gather(self.monitor.async_post(url, monitorconnection.MonitorConfig.service_query('web01')),
+                             self.monitor.async_post(url, monitorconnection.MonitorConfig.service_query('web02')))
+
+        self.assertEqual(2, len(self.icinga2.requests))
+
+    async def test_joined_request_keeps_its_own_deadline(self):
+        url = self.monitor.get_url() + '/v1/objects/services'
+        query = monitorconnection.MonitorConfig.service_query('web01')
+
+        first = asyncio.ensure_future(self.monitor.async_post(url, query))
+        await asyncio.sleep(0.05)
+        start_time = time.monotonic()
+        with self.assertRaises(monitorconnection.ScrapeExecption):
+            await self.monitor.async_post(url, query, deadline=time.monotonic() + 0.05)
+
+        self.assertLess(time.monotonic() - start_time, 0.15)
+        self.assertEqual(1, len((await first)['results']))
+        self.assertEqual(1, len(self.icinga2.requests))
+
+    async def test_failure_reaches_every_caller(self):
+        url = self.monitor.get_url() + '/v1/objects/services'
+        query = monitorconnection.MonitorConfig.service_query('web01')
+
+        # The requests joining the first fail with it, though their own timeout is longer
+        results = await asyncio.gather(self.monitor.async_post(url, query, timeout=0.05),
+                                       *[self.monitor.async_post(url, query) for _ in range(4)],
+                                       return_exceptions=True)
+
+        self.assertEqual(1, len(self.icinga2.requests))
+        for result in results:
+            self.assertIsInstance(result, monitorconnection.ScrapeExecption)
+        self.assertIs(results[0], results[-1])
+
+        # The failed request is not kept, the next request is sent to icinga2
+        self.icinga2.latency = 0.0
+        result = await self.monitor.async_post(url, query)
+        self.assertEqual(2, len(self.icinga2.requests))
+        self.assertEqual(1, len(result['results']))
+
+
+if __name__ == '__main__':
+    unittest.main()
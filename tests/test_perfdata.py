@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import os
+import time
+import unittest
+
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.monitorconnection as monitorconnection
+from icinga2_exporter.perfdata import Perfdata
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def read_fixture(name: str):
+    with open(os.path.join(FIXTURES, name), 'r') as fixture:
+        if name.endswith('.json'):
+            return json.load(fixture)
+        return fixture.read()
+
+
+def fixture_monitor(**kwargs) -> monitorconnection.MonitorConfig:
+    """
+    Create a MonitorConfig that return the recorded icinga2 responses in tests/fixtures
+    :param kwargs: additional icinga2 configuration
+    :return:
+    """
+    config = {'icinga2': {'url': 'https://localhost:5665', 'user': 'user', 'passwd': 'passwd',
+                          'metric_prefix': 'icinga2'}}
+    config['icinga2'].update(kwargs)
+    monitor = monitorconnection.MonitorConfig(config)
+
+    async def async_get_service_data(hostname, *args, **kwargs):
+        return read_fixture('services.json')
+
+    async def async_get_host_data(hostname, *args, **kwargs):
+        return read_fixture('hosts.json')
+
+    monitor.async_get_service_data = async_get_service_data
+    monitor.async_get_host_data = async_get_host_data
+    return monitor
+
+
+async def render(monitor: monitorconnection.MonitorConfig) -> Perfdata:
+    perfdata = Perfdata(monitor, 'h1')
+    await perfdata.get_service_metrics()
+    await perfdata.get_host_metrics()
+    perfdata.add_perfdata('scrape_duration_seconds', {'hostname': 'h1', 'server': 'https://localhost:5665'}, 0.5)
+    return perfdata
+
+
+class PerfdataFormatTest(unittest.IsolatedAsyncioTestCase):
+    """
+    The expected output files are recorded from the release before the sample store was introduced and must
+    match byte for byte
+    """
+
+    async def test_prometheus_format(self):
+        perfdata = await render(fixture_monitor())
+
+        self.assertEqual(read_fixture('expected_metrics.txt'), perfdata.prometheus_format())
+
+    async def test_prometheus_format_thresholds_and_perfname_to_label(self):
+        perfdata = await render(fixture_monitor(enable_scrape_thresholds=True,
+                                                perfnametolabel={'disk': {'label_name': 'mount'},
+                                                                 'nscp': {'label_name': 'Drive'}}))
+
+        self.assertEqual(read_fixture('expected_metrics_thresholds.txt'), perfdata.prometheus_format())
+
+    async def test_host_custom_vars_label_name(self):
+        perfdata = await render(fixture_monitor(host_custom_vars=[{'env': {'label_name': 'environment'}}]))
+        expected = read_fixture('expected_metrics.txt').replace(', env="', ', environment="')
+
+        self.assertEqual(expected, perfdata.prometheus_format())
+
+    async def test_max_series_per_target(self):
+        dropped = exportermetrics.registry.get_sample_value('icinga2_exporter_dropped_series_total',
+                                                            {'limit': 'target'}) or 0.0
+        perfdata = await render(fixture_monitor(max_series_per_target=10))
+        perfdata.observe()
+
+        lines = perfdata.prometheus_format().splitlines()
+        self.assertEqual(read_fixture('expected_metrics.txt').splitlines()[:10], lines[:10])
+        # The exporter's own samples are not counted against the limit
+        self.assertEqual(11, len(lines))
+        self.assertTrue(lines[-1].startswith('icinga2_scrape_duration_seconds{hostname="h1"'))
+        self.assertGreater(exportermetrics.registry.get_sample_value('icinga2_exporter_dropped_series_total',
+                                                                     {'limit': 'target'}), dropped)
+
+    async def test_max_series_per_family(self):
+        perfdata = await render(fixture_monitor(max_series_per_family=1))
+        names = [line.partition('{')[0] for line in perfdata.prometheus_format().splitlines()]
+
+        self.assertEqual(len(set(names)), len(names))
+        self.assertEqual(list(dict.fromkeys(line.partition('{')[0] for line in
+                                            read_fixture('expected_metrics.txt').splitlines())), names)
+        self.assertEqual(set(names), set(perfdata.perfdatadict.families))
+
+    async def test_allowed_host_custom_vars(self):
+        perfdata = await render(fixture_monitor(allowed_host_custom_vars=['ENV']))
+
+        lines = perfdata.prometheus_format().splitlines()
+        self.assertIn('icinga2_ping4_metadata_downtime_depth{hostname="h1", service="ping4", env="prod"} 0.0', lines)
+        self.assertNotIn('site="dc1"', perfdata.prometheus_format())
+
+    async def test_prometheus_format_ranges(self):
+        perfdata = await render(fixture_monitor(enable_perfdata_ranges=True, enable_scrape_thresholds=True))
+        lines = perfdata.prometheus_format().splitlines()
+        labels = '{hostname="h1", service="bad", env="prod", site="dc1", os="Linux"}'
+
+        for line in read_fixture('expected_metrics.txt').splitlines():
+            self.assertIn(line, lines)
+        self.assertIn('icinga2_disk__boot_bytes_max{hostname="h1", service="disk2", env="prod", site="dc1", '
+                      'os="Linux"} 41943040.0', lines)
+        self.assertIn(f"icinga2_bad_w_threshold_warning_lower{labels} 1.0", lines)
+        self.assertIn(f"icinga2_bad_w_threshold_warning_upper{labels} 2.0", lines)
+        self.assertIn(f"icinga2_bad_w_threshold_critical_inside{labels} 1.0", lines)
+        self.assertNotIn(f"icinga2_bad_w_threshold_warning_inside{labels} 1.0", lines)
+
+    async def test_perfdatadict(self):
+        perfdata = await render(fixture_monitor())
+
+        expected = {}
+        for line in read_fixture('expected_metrics.txt').splitlines():
+            key, value = line.rsplit(' ', 1)
+            expected[key] = value
+        self.assertEqual(list(expected.items()), list(perfdata.perfdatadict.items()))
+        self.assertEqual('5.0', perfdata.perfdatadict['icinga2_dup_a{hostname="h1", service="dup", env="prod", '
+                                                      'site="dc1", os="Linux"}'])
+
+    async def test_iter_service_metrics(self):
+        perfdata = Perfdata(fixture_monitor(), 'h1')
+        chunks = [chunk async for chunk in perfdata.iter_service_metrics()]
+        await perfdata.get_host_metrics()
+        perfdata.add_perfdata('scrape_duration_seconds', {'hostname': 'h1', 'server': 'https://localhost:5665'}, 0.5)
+        chunks.append(perfdata.perfdatadict.flush())
+
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(read_fixture('expected_metrics.txt'), ''.join(chunks))
+        self.assertEqual(0, len(perfdata.perfdatadict))
+
+    async def test_flushed_samples_are_not_rendered_again(self):
+        perfdata = Perfdata(fixture_monitor(), 'h1')
+        perfdata.perfdatadict.add('a', 'x="1"', 1.0)
+        self.assertEqual('a{x="1"} 1.0\n', perfdata.perfdatadict.flush())
+        perfdata.perfdatadict.add('a', 'x="1"', 2.0)
+        perfdata.perfdatadict.add('b', 'x="1"', 3.0)
+
+        self.assertEqual('b{x="1"} 3.0\n', perfdata.perfdatadict.flush())
+
+    async def test_deadline_exceeded(self):
+        exceeded = exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_scrape_deadline_exceeded_total', {'stage': 'parse'}) or 0.0
+        perfdata = Perfdata(fixture_monitor(), 'h1', deadline=time.monotonic() - 1)
+
+        await perfdata.get_service_metrics()
+
+        self.assertTrue(perfdata.deadline_exceeded)
+        self.assertEqual(0, len(perfdata.perfdatadict))
+        self.assertEqual(exceeded + 1, exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_scrape_deadline_exceeded_total', {'stage': 'parse'}))
+
+    async def test_perfdata_cache(self):
+        monitor = fixture_monitor(perfdata_cache_size=1000)
+        first = await render(monitor)
+        hits = monitor.get_perfdata_cache().hits._value.get()
+        second = await render(monitor)
+
+        self.assertEqual(first.prometheus_format(), second.prometheus_format())
+        self.assertGreater(monitor.get_perfdata_cache().hits._value.get(), hits)
+
+    async def test_perfdata_caches_of_the_parsers(self):
+        perfdata = Perfdata(fixture_monitor(perfdata_cache_size=1000), 'h1')
+
+        perf = perfdata.parse_perfdata_cached('load1=1.5;5;10;0')
+        ranges = perfdata.parse_perfdata_ranges_cached('load1=1.5;5;10;0')
+
+        self.assertEqual(1.5, perf['load1']['value'])
+        self.assertEqual('load1', ranges[0][0])
+        self.assertEqual(1.5, ranges[0][1])
+        self.assertEqual(perf, perfdata.parse_perfdata_cached('load1=1.5;5;10;0'))
+
+
+class CustomVarsTest(unittest.TestCase):
+
+    def test_raw_custom_vars(self):
+        service_attrs = {'joins': {'host': {'vars': {'ENV': 'prod', 'path': 'c:\\temp'}}}}
+        host_attrs = {'attrs': {'vars': {'ENV': 'prod', 'path': 'c:\\temp'}}}
+
+        self.assertEqual({'ENV': 'prod', 'path': 'c:\\temp'}, Perfdata.get_host_custom_vars_raw(service_attrs))
+        self.assertEqual({'ENV': 'prod', 'path': 'c:\\temp'}, Perfdata.get_host_meta_custom_vars_raw(host_attrs))
+        self.assertEqual({}, Perfdata.get_host_custom_vars_raw({'joins': {'host': {'vars': None}}}))
+
+    def test_deprecated_custom_vars_labels(self):
+        service_attrs = {'joins': {'host': {'vars': {'ENV': 'prod', 'path': 'c:\\temp'}}}}
+        host_attrs = {'attrs': {'vars': {'ENV': 'prod', 'path': 'c:\\temp'}}}
+
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual({'env': 'prod', 'path': 'c:\\\\temp'}, Perfdata.get_host_custom_vars(service_attrs))
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual({'env': 'prod', 'path': 'c:\\\\temp'}, Perfdata.get_host_meta_custom_vars(host_attrs))
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual({'disk': '/boot'}, Perfdata.add_labels_by_items('DISK', '/boot'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import unittest
+
+import icinga2_exporter.perfdatabatch as perfdatabatch
+from icinga2_exporter.cache import LRUCache
+from icinga2_exporter.perfdata import Perfdata
+from test_perfdata import read_fixture
+
+PERF_STRINGS = [
+    "rta=0.052ms;3000;5000;0 pl=0%;80;100;0",
+    "'C:\\ used %'=44%;80;90;0;100 'C:\\ used'=44GB;;;0;100",
+    "procs_packets=1024c;1;2",
+    "uptime=3600s time=250us size=3B;1TB;2TB",
+    "a=1.2.3 b=2 c=-",
+    "dup=1 dup=2;3;4",
+    "'unbalanced=1 x'=2",
+    "'multi\nline'=3ms e=4",
+    "=",
+    "",
+]
+
+
+class PerfdataBatchTest(unittest.TestCase):
+
+    def test_parse_perf_strings(self):
+        perf_strings = PERF_STRINGS + [perf_string for perf_string in
+                                       perfdatabatch.perf_strings(read_fixture('services.json')['results'])
+                                       if type(perf_string) is str]
+        columns = perfdatabatch.parse_perf_strings(perf_strings)
+
+        self.assertEqual(len(perf_strings), len(columns))
+        for index, perf_string in enumerate(perf_strings):
+            self.assertEqual(Perfdata.parse_perf_string(perf_string), columns.perfdata(index), perf_string)
+
+    def test_cache_perf_strings(self):
+        cache = LRUCache('perfdata_test', 100)
+        cache.put(PERF_STRINGS[0], {})
+
+        self.assertEqual(len(PERF_STRINGS) - 1, perfdatabatch.cache_perf_strings(cache, PERF_STRINGS + [None, 1]))
+        self.assertEqual({}, cache.get(PERF_STRINGS[0]))
+        self.assertEqual(Perfdata.parse_perf_string(PERF_STRINGS[3]), cache.get(PERF_STRINGS[3]))
+        self.assertEqual(2, perfdatabatch.cache_perf_strings(LRUCache('perfdata_test_small', 2), PERF_STRINGS))
+        self.assertEqual(0, perfdatabatch.cache_perf_strings(LRUCache('perfdata_test_disabled', 0), PERF_STRINGS))
+
+
+if __name__ == '__main__':
+    unittest.main()
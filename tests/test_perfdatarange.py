@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import unittest
+
+import icinga2_exporter.perfdatarange as perfdatarange
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual((0.0, 10.0, False), perfdatarange.parse_range('10'))
+        self.assertEqual((10.0, None, False), perfdatarange.parse_range('10:'))
+        self.assertEqual((None, 5.0, False), perfdatarange.parse_range('~:5'))
+        self.assertEqual((10.0, 20.0, False), perfdatarange.parse_range('10:20'))
+        self.assertEqual((1.0, 3.0, True), perfdatarange.parse_range('@1:3'))
+        self.assertEqual((0.0, 5.0, False), perfdatarange.parse_range(':5'))
+
+    def test_parse_range_unit(self):
+        self.assertEqual((0.0, 0.8, False), perfdatarange.parse_range('80', '%'))
+        self.assertEqual((1024.0, 2048.0, False), perfdatarange.parse_range('1:2', 'KB'))
+
+    def test_parse_invalid_range(self):
+        for threshold in ['20:10', '~', '@', '1:x', 'x', '5%']:
+            self.assertIsNone(perfdatarange.parse_range(threshold), threshold)
+
+    def test_parse_perf_string(self):
+        self.assertEqual(
+            [('rta', 0.001, 'seconds', 'gauge', (0.01, 0.02, False), (None, 0.03, False), 0.0, None),
+             ("'C:\\ used'", 44.0 * 1024 ** 3, 'bytes', 'gauge', None, None, 0.0, 100.0 * 1024 ** 3),
+             ('packets', 5.0, '', 'counter', (1.0, 3.0, True), None, None, None)],
+            perfdatarange.parse_perf_string("rta=1ms;10:20;~:30;0 'C:\\ used'=44GB;;;0;100 packets=5c;@1:3 bad=x"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import gzip
+import time
+import unittest
+
+from quart import Quart
+
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.monitorconnection as monitorconnection
+from icinga2_exporter.proxy import app as icinga2
+from fakeicinga import FakeIcinga2, host, service
+from test_eventstream import wait_for
+
+
+class ProxyTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    Run the exporter app against a fake icinga2
+    """
+
+    config = {}
+
+    async def asyncSetUp(self):
+        self.icinga2 = FakeIcinga2(services=[service('h1', 'load', 'load', ['load1=1']),
+                                             service('h2', 'load', 'load', ['load1=2']),
+                                             service('h3', 'load', 'load', ['load1=3'])],
+                                   hosts=[host('h1'), host('h2'), host('h3')],
+                                   hostgroups={'web': ['h1', 'h3']})
+        url = await self.icinga2.start()
+        config = {'url': url, 'user': 'user', 'passwd': 'passwd', 'metric_prefix': 'icinga2'}
+        config.update(self.config)
+        monitorconnection.MonitorConfig({'icinga2': config})
+
+        app = Quart(__name__)
+        app.register_blueprint(icinga2, url_prefix='')
+        self.test_app = app.test_app()
+        await self.test_app.startup()
+        self.client = self.test_app.test_client()
+
+    async def asyncTearDown(self):
+        await self.test_app.shutdown()
+        await self.icinga2.stop()
+
+    async def get(self, path: str):
+        response = await self.client.get(path)
+        return response.status_code, (await response.get_data()).decode('utf-8')
+
+    async def get_gzip(self, path: str):
+        response = await self.client.get(path, headers={'Accept-Encoding': 'gzip'})
+        body = await response.get_data()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return response.headers.get('Content-Encoding'), body.decode('utf-8')
+
+
+class MetricsTest(ProxyTestCase):
+
+    config = {'enable_scrape_metadata': True}
+
+    async def test_streamed_metrics(self):
+        response = await self.client.get('/metrics?target=h1')
+        chunks = [chunk.decode('utf-8') async for chunk in response.response]
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(chunks[0].startswith('icinga2_load_metadata_downtime_depth{hostname="h1"'))
+        metrics = ''.join(chunks)
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 1.0\n', metrics)
+        self.assertIn('icinga2_host_metadata_state{hostname="h1", address="127.0.0.1", env="prod"} 0.0\n', metrics)
+        self.assertTrue(metrics.splitlines()[-1].startswith('icinga2_scrape_duration_seconds{hostname="h1"'))
+
+    async def test_missing_target(self):
+        self.assertEqual((400, 'target is required'), await self.get('/metrics'))
+        self.assertEqual(400, (await self.get('/metrics?target='))[0])
+
+    async def test_icinga2_failure(self):
+        await self.icinga2.stop()
+
+        self.assertEqual(500, (await self.get('/metrics?target=h1'))[0])
+
+
+class ConnectionPoolTest(ProxyTestCase):
+
+    async def test_connections_are_reused(self):
+        session = monitorconnection.MonitorConfig().session
+
+        for target in ('h1', 'h2', 'h1'):
+            self.assertEqual(200, (await self.get(f"/metrics?target={target}"))[0])
+
+        self.assertIs(session, monitorconnection.MonitorConfig().session)
+        self.assertEqual(3, len(self.icinga2.requests))
+        self.assertEqual(1, len(self.icinga2.connections))
+        _, exporter_metrics = await self.get('/exporter-metrics')
+        self.assertIn('icinga2_exporter_upstream_connections{state="open"} 1.0\n', exporter_metrics)
+        self.assertIn('icinga2_exporter_upstream_connections{state="in_use"} 0.0\n', exporter_metrics)
+
+    async def test_session_is_closed_when_stopped(self):
+        session = monitorconnection.MonitorConfig().session
+        await self.get('/metrics?target=h1')
+
+        await self.test_app.shutdown()
+
+        self.assertTrue(session.closed)
+        self.assertIsNone(monitorconnection.MonitorConfig().session)
+        self.assertEqual({'open': 0, 'in_use': 0, 'waiting': 0},
+                         monitorconnection.MonitorConfig().get_pool_statistics())
+        # Started again to be stopped by the tear down
+        await self.test_app.startup()
+
+
+class ResponseCacheTest(ProxyTestCase):
+
+    config = {'response_cache_ttl': 60}
+
+    async def test_concurrent_scrapes_share_one_request(self):
+        self.icinga2.latency = 0.2
+
+        responses = await asyncio.gather(*[self.get('/metrics?target=h1') for _ in range(5)])
+
+        self.assertEqual(1, len(self.icinga2.requests))
+        self.assertEqual([responses[0]] * 5, responses)
+        self.assertEqual(200, responses[0][0])
+
+        # Cached after the scrape
+        self.assertEqual(responses[0], await self.get('/metrics?target=h1'))
+        self.assertEqual(1, len(self.icinga2.requests))
+
+
+class ResponseCacheInvalidationTest(ProxyTestCase):
+
+    config = {'response_cache_ttl': 60, 'enable_event_stream': True, 'event_stream_reconnect_interval': 0}
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await wait_for(lambda: monitorconnection.MonitorConfig().snapshot is not None)
+
+    @staticmethod
+    def hits() -> float:
+        return exportermetrics.registry.get_sample_value('icinga2_exporter_cache_hits_total',
+                                                         {'cache': 'response'}) or 0.0
+
+    async def test_newer_check_result_invalidates_the_response(self):
+        _, first = await self.get('/metrics?target=h1')
+        hits = self.hits()
+        self.assertEqual(first, (await self.get('/metrics?target=h1'))[1])
+        self.assertEqual(hits + 1, self.hits())
+
+        self.icinga2.push_event({'type': 'CheckResult', 'host': 'h1', 'service': 'load',
+                                 'check_result': {'performance_data': ['load1=7'], 'execution_end': 2.0}})
+        await wait_for(lambda: monitorconnection.MonitorConfig().get_last_check_time('h1') == 2.0)
+
+        _, metrics = await self.get('/metrics?target=h1')
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 7.0\n', metrics)
+        self.assertNotIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 1.0\n', metrics)
+        self.assertEqual(hits + 1, self.hits())
+
+
+class ExporterMetricsTest(ProxyTestCase):
+
+    @staticmethod
+    def sample(name: str, **labels) -> float:
+        return exportermetrics.registry.get_sample_value(name, labels) or 0.0
+
+    async def test_stages(self):
+        upstream = self.sample('icinga2_exporter_upstream_request_seconds_count', endpoint='services')
+        decode = self.sample('icinga2_exporter_json_decode_seconds_count')
+        parse = self.sample('icinga2_exporter_perfdata_parse_seconds_count')
+        render = self.sample('icinga2_exporter_render_seconds_count')
+        response_bytes = self.sample('icinga2_exporter_response_bytes_sum', path='/metrics')
+        requests = self.sample('icinga2_exporter_requests_total', path='/metrics')
+
+        _, metrics = await self.get('/metrics?target=h1')
+
+        self.assertEqual(upstream + 1, self.sample('icinga2_exporter_upstream_request_seconds_count',
+                                                   endpoint='services'))
+        self.assertEqual(decode + 1, self.sample('icinga2_exporter_json_decode_seconds_count'))
+        self.assertEqual(parse + 1, self.sample('icinga2_exporter_perfdata_parse_seconds_count'))
+        self.assertEqual(render + 1, self.sample('icinga2_exporter_render_seconds_count'))
+        self.assertEqual(response_bytes + len(metrics), self.sample('icinga2_exporter_response_bytes_sum',
+                                                                    path='/metrics'))
+        self.assertEqual(requests + 1, self.sample('icinga2_exporter_requests_total', path='/metrics'))
+
+        status, exporter_metrics = await self.get('/exporter-metrics')
+        self.assertEqual(200, status)
+        self.assertIn('icinga2_exporter_upstream_request_seconds_bucket{endpoint="services",le="0.0005"}',
+                      exporter_metrics)
+
+    async def test_errors(self):
+        errors = self.sample('icinga2_exporter_upstream_errors_total', endpoint='services', type='connect')
+        responses = self.sample('icinga2_exporter_error_responses_total', path='/metrics', status='500')
+        await self.icinga2.stop()
+
+        self.assertEqual(500, (await self.get('/metrics?target=h1'))[0])
+        self.assertEqual(errors + 1, self.sample('icinga2_exporter_upstream_errors_total', endpoint='services',
+                                                 type='connect'))
+        self.assertEqual(responses + 1, self.sample('icinga2_exporter_error_responses_total', path='/metrics',
+                                                    status='500'))
+
+
+class ConcurrencyLimitTest(ProxyTestCase):
+
+    config = {'enable_concurrency_limit': True, 'concurrency_limit': 2, 'concurrency_queue_size': 2,
+              'concurrency_queue_timeout': 5, 'concurrency_latency_threshold': 0.1}
+
+    async def test_overload(self):
+        rejected = exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_rejected_requests_total',
+                                                             {'reason': 'queue_full'}) or 0.0
+        self.icinga2.latency = 0.15
+        self.icinga2.latency_per_request = 0.1
+
+        responses = await asyncio.gather(*[self.get(f"/metrics?target=h{index}") for index in range(6)])
+
+        self.assertEqual([200] * 4 + [503] * 2, sorted(status for status, _ in responses))
+        self.assertEqual(rejected + 2, exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_upstream_rejected_requests_total', {'reason': 'queue_full'}))
+        self.assertEqual(1.0, exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_concurrency_limit'))
+        self.assertEqual(0.0, exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_in_flight_requests'))
+
+
+class ScrapeDeadlineTest(ProxyTestCase):
+
+    config = {'scrape_timeout_offset': 0.1}
+
+    async def test_deadline_shorter_than_timeout(self):
+        exceeded = exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_scrape_deadline_exceeded_total', {'stage': 'upstream'}) or 0.0
+        self.icinga2.latency = 1.0
+
+        start_time = time.monotonic()
+        response = await self.client.get('/metrics?target=h1', headers={'X-Prometheus-Scrape-Timeout-Seconds': '0.4'})
+
+        self.assertEqual(500, response.status_code)
+        self.assertLess(time.monotonic() - start_time, 0.8)
+        self.assertEqual(exceeded + 1, exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_scrape_deadline_exceeded_total', {'stage': 'upstream'}))
+
+    async def test_deadline_longer_than_timeout(self):
+        response = await self.client.get('/metrics?target=h1', headers={'X-Prometheus-Scrape-Timeout-Seconds': '10'})
+
+        self.assertEqual(200, response.status_code)
+
+
+class StreamingDeadlineTest(ProxyTestCase):
+
+    config = {'scrape_timeout_offset': 0.1, 'enable_streaming_decode': True}
+
+    async def test_partial_response_at_deadline(self):
+        exceeded = exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_scrape_deadline_exceeded_total', {'stage': 'parse'}) or 0.0
+        for index in range(10):
+            self.icinga2.add_service(service('h1', f"disk{index}", 'disk', [f"used={index}"]))
+        self.icinga2.trickle = 0.1
+
+        response = await self.client.get('/metrics?target=h1', headers={'X-Prometheus-Scrape-Timeout-Seconds': '0.5'})
+        body = (await response.get_data()).decode('utf-8')
+
+        self.assertEqual(200, response.status_code)
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 1.0\n', body)
+        self.assertNotIn('service="disk9"', body)
+        self.assertTrue(body.splitlines()[-1].startswith('icinga2_scrape_duration_seconds{hostname="h1"'))
+        self.assertEqual(exceeded + 1, exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_scrape_deadline_exceeded_total', {'stage': 'parse'}))
+
+
+class StreamingTimeoutTest(ProxyTestCase):
+
+    config = {'timeout': 1, 'response_cache_ttl': 60, 'enable_streaming_decode': True, 'retries': 0}
+
+    async def test_timeout_before_deadline(self):
+        for index in range(10):
+            self.icinga2.add_service(service('h1', f"disk{index}", 'disk', [f"used={index}"]))
+        self.icinga2.trickle = 0.2
+
+        response = await self.client.get('/metrics?target=h1', headers={'X-Prometheus-Scrape-Timeout-Seconds': '10'})
+        self.assertEqual(500, response.status_code)
+
+        # The partial response is not cached
+        self.icinga2.trickle = 0.0
+        status, body = await self.get('/metrics?target=h1')
+        self.assertEqual(200, status)
+        self.assertIn('service="disk9"', body)
+
+
+class StaleResponseTest(ProxyTestCase):
+
+    config = {'scrape_timeout_offset': 0.1, 'response_cache_ttl': 0.05}
+
+    async def test_stale_response_after_deadline(self):
+        stale = exportermetrics.registry.get_sample_value('icinga2_exporter_stale_responses_total',
+                                                          {'reason': 'deadline'}) or 0.0
+        _, first = await self.get('/metrics?target=h1')
+        await asyncio.sleep(0.1)
+        self.icinga2.latency = 1.0
+
+        response = await self.client.get('/metrics?target=h1', headers={'X-Prometheus-Scrape-Timeout-Seconds': '0.4'})
+
+        self.assertEqual(200, response.status_code)
+        body = (await response.get_data()).decode('utf-8')
+        self.assertTrue(body.startswith(first))
+        name, age = body[len(first):].split()
+        self.assertEqual('icinga2_exporter_data_age_seconds{hostname="h1"}', name)
+        self.assertGreater(float(age), 0.3)
+        self.assertEqual(stale + 1, exportermetrics.registry.get_sample_value('icinga2_exporter_stale_responses_total',
+                                                                              {'reason': 'deadline'}))
+
+    async def test_no_stale_response_without_deadline(self):
+        await self.get('/metrics?target=h1')
+        await asyncio.sleep(0.1)
+        await self.icinga2.stop()
+
+        self.assertEqual(500, (await self.get('/metrics?target=h1'))[0])
+
+
+class StaleWhileRevalidateTest(ProxyTestCase):
+
+    config = {'stale_response_ttl': 60, 'stale_response_timeout': 0.2, 'retries': 0}
+
+    @staticmethod
+    def stale_responses(reason: str) -> float:
+        return exportermetrics.registry.get_sample_value('icinga2_exporter_stale_responses_total',
+                                                         {'reason': reason}) or 0.0
+
+    async def test_stale_response_on_error(self):
+        stale = self.stale_responses('error')
+        _, first = await self.get('/metrics?target=h1')
+        await self.icinga2.stop()
+
+        status, body = await self.get('/metrics?target=h1')
+
+        self.assertEqual(200, status)
+        self.assertTrue(body.startswith(first))
+        self.assertIn('icinga2_exporter_data_age_seconds{hostname="h1"} ', body)
+        self.assertEqual(stale + 1, self.stale_responses('error'))
+
+    async def test_stale_response_on_slow_scrape(self):
+        stale = self.stale_responses('timeout')
+        _, first = await self.get('/metrics?target=h1')
+        self.icinga2.add_service(service('h1', 'disk', 'disk', ['used=10']))
+        self.icinga2.latency = 0.4
+
+        start_time = time.monotonic()
+        status, body = await self.get('/metrics?target=h1')
+
+        self.assertEqual(200, status)
+        self.assertLess(time.monotonic() - start_time, 0.35)
+        self.assertTrue(body.startswith(first))
+        self.assertEqual(stale + 1, self.stale_responses('timeout'))
+        # The scrape keeps running in the background and replaces the stale response
+        await asyncio.sleep(0.4)
+        refreshed = monitorconnection.MonitorConfig().get_stale_response_cache().peek('h1')
+        self.assertIn('icinga2_disk_used{hostname="h1", service="disk", env="prod"} 10.0\n', refreshed.body)
+
+    async def test_stale_response_ttl(self):
+        await self.get('/metrics?target=h1')
+        monitorconnection.MonitorConfig().get_stale_response_cache().peek('h1').created -= 120
+        await self.icinga2.stop()
+
+        self.assertEqual(500, (await self.get('/metrics?target=h1'))[0])
+        self.assertNotIn('h1', monitorconnection.MonitorConfig().get_stale_response_cache())
+
+
+class CompressionTest(ProxyTestCase):
+
+    config = {'compression_min_size': 100}
+
+    async def test_gzip(self):
+        _, plain = await self.get('/metrics?target=h1')
+        encoding, metrics = await self.get_gzip('/metrics?target=h1')
+
+        self.assertEqual('gzip', encoding)
+        self.assertEqual(plain.splitlines()[:-1], metrics.splitlines()[:-1])
+
+    async def test_min_size(self):
+        monitorconnection.MonitorConfig().compression_min_size = 100000
+        encoding, metrics = await self.get_gzip('/metrics?target=h1')
+
+        self.assertIsNone(encoding)
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 1.0\n', metrics)
+
+
+class CachedCompressionTest(ProxyTestCase):
+
+    config = {'compression_min_size': 100, 'response_cache_ttl': 60}
+
+    async def test_compressed_body_is_cached(self):
+        encoding, first = await self.get_gzip('/metrics?target=h1')
+        size = monitorconnection.MonitorConfig().get_response_cache().bytes
+        _, second = await self.get_gzip('/metrics?target=h1')
+        _, plain = await self.get('/metrics?target=h1')
+
+        self.assertEqual('gzip', encoding)
+        self.assertEqual(first, second)
+        self.assertEqual(first, plain)
+        self.assertIn('gzip', monitorconnection.MonitorConfig().get_response_cache().get('h1').encoded)
+        self.assertEqual(size, monitorconnection.MonitorConfig().get_response_cache().bytes)
+        self.assertGreater(size, len(plain))
+
+
+class ExpositionTest(ProxyTestCase):
+
+    config = {'exposition_formats': ['openmetrics', 'protobuf']}
+
+    async def test_openmetrics(self):
+        response = await self.client.get('/metrics?target=h1',
+                                         headers={'Accept': 'application/openmetrics-text;version=1.0.0,'
+                                                            'text/plain;version=0.0.4;q=0.5'})
+        metrics = (await response.get_data()).decode('utf-8')
+
+        self.assertTrue(response.headers['Content-Type'].startswith('application/openmetrics-text'))
+        self.assertIn('# TYPE icinga2_load_load1 gauge\n', metrics)
+        self.assertTrue(metrics.endswith('# EOF\n'))
+
+    async def test_text_when_not_accepted(self):
+        response = await self.client.get('/metrics?target=h1', headers={'Accept': 'text/plain;version=0.0.4'})
+        metrics = (await response.get_data()).decode('utf-8')
+
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        self.assertNotIn('# TYPE', metrics)
+
+
+class BatchTest(ProxyTestCase):
+
+    async def test_targets(self):
+        status, metrics = await self.get('/metrics/batch?target=h1&target=h2')
+
+        self.assertEqual(200, status)
+        self.assertIn('icinga2_load_load1{hostname="h1", service="load", env="prod"} 1.0\n', metrics)
+        self.assertIn('icinga2_load_load1{hostname="h2", service="load", env="prod"} 2.0\n', metrics)
+        self.assertNotIn('hostname="h3"', metrics)
+        self.assertIn('icinga2_scrape_duration_seconds{hostname="h1"', metrics)
+        self.assertIn('icinga2_scrape_duration_seconds{hostname="h2"', metrics)
+        self.assertIn('icinga2_batch_hosts{server="' + self.icinga2.url + '"} 2\n', metrics)
+        self.assertEqual(1, len([request for request in self.icinga2.requests if 'services' in request[0]]))
+
+    async def test_hostgroup(self):
+        status, metrics = await self.get('/metrics/batch?hostgroup=web')
+
+        self.assertEqual(200, status)
+        self.assertIn('hostname="h1"', metrics)
+        self.assertIn('hostname="h3"', metrics)
+        self.assertNotIn('hostname="h2"', metrics)
+
+    async def test_bad_requests(self):
+        self.assertEqual(400, (await self.get('/metrics/batch'))[0])
+        self.assertEqual(403, (await self.get('/metrics/batch?filter=host.vars.env=="prod"'))[0])
+
+
+class BatchMetadataTest(ProxyTestCase):
+
+    config = {'enable_scrape_metadata': True}
+
+    async def test_hosts_are_included(self):
+        status, metrics = await self.get('/metrics/batch?target=h1')
+
+        self.assertEqual(200, status)
+        self.assertIn('icinga2_host_metadata_state{hostname="h1", address="127.0.0.1", env="prod"} 0.0\n', metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
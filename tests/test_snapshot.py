@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import unittest
+
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.monitorconnection as monitorconnection
+from icinga2_exporter.snapshot import Snapshot
+from fakeicinga import FakeIcinga2, host, service
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = Snapshot({'results': [service('web01', 'load', 'load', ['load1=1'], execution_end=2.0),
+                                              service('web01', 'disk', 'disk', ['used=1'], execution_end=3.0),
+                                              service('web02', 'load', 'load', ['load1=2']),
+                                              service('db01', 'load', 'load', ['load1=3'])]},
+                                 {'results': [host('web01'), host('db01')]})
+
+    def test_service_data(self):
+        self.assertEqual(['web01!load', 'web01!disk'],
+                         [result['attrs']['__name'] for result in self.snapshot.get_service_data('web01')['results']])
+        self.assertEqual({'results': []}, self.snapshot.get_service_data('web03'))
+
+    def test_pattern_service_data(self):
+        self.assertEqual(['web01!load', 'web01!disk', 'web02!load'],
+                         [result['attrs']['__name'] for result in self.snapshot.get_service_data('web*')['results']])
+        self.assertEqual(['web02!load'],
+                         [result['attrs']['__name'] for result in self.snapshot.get_service_data('web?2')['results']])
+
+    def test_host_data(self):
+        hosts = self.snapshot.get_host_data('web01')
+
+        self.assertEqual(['web01'], [result['attrs']['name'] for result in hosts['results']])
+        self.assertEqual({'results': []}, self.snapshot.get_host_data('web02'))
+
+    def test_last_check_time(self):
+        self.assertEqual(3.0, self.snapshot.last_check_time('web01'))
+        self.assertEqual(0.0, self.snapshot.last_check_time('web03'))
+
+    def test_age(self):
+        self.assertGreaterEqual(self.snapshot.age(), 0.0)
+        self.assertLess(self.snapshot.age(), 1.0)
+
+
+class BulkScrapeTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.icinga2 = FakeIcinga2(services=[service('web01', 'load', 'load', ['load1=1']),
+                                             service('web02', 'load', 'load', ['load1=2'])],
+                                   hosts=[host('web01'), host('web02')])
+        url = await self.icinga2.start()
+        self.monitor = monitorconnection.MonitorConfig({'icinga2': {
+            'url': url, 'user': 'user', 'passwd': 'passwd', 'enable_bulk_scrape': True,
+            'enable_scrape_metadata': True, 'bulk_refresh_interval': 0.1}})
+
+    async def asyncTearDown(self):
+        await self.monitor.stop_snapshot_refresh()
+        await self.monitor.close_session()
+        await self.icinga2.stop()
+
+    async def test_targets_are_served_from_the_snapshot(self):
+        await self.monitor.refresh_snapshot()
+
+        services = await self.monitor.async_get_service_data('web01')
+        pattern = await self.monitor.async_get_service_data('web*')
+        hosts = await self.monitor.async_get_host_data('web02')
+
+        self.assertEqual(['web01!load'], [result['attrs']['__name'] for result in services['results']])
+        self.assertEqual(['web01!load', 'web02!load'], [result['attrs']['__name'] for result in pattern['results']])
+        self.assertEqual(['web02'], [result['attrs']['name'] for result in hosts['results']])
+        # One bulk request each for the services and the hosts
+        self.assertEqual(['/v1/objects/services', '/v1/objects/hosts'], [path for path, _ in self.icinga2.requests])
+
+    async def test_refresh(self):
+        self.monitor.start_snapshot_refresh()
+        await asyncio.sleep(0.05)
+        self.icinga2.add_service(service('web03', 'load', 'load', ['load1=3']))
+        await asyncio.sleep(0.15)
+
+        services = await self.monitor.async_get_service_data('web03')
+
+        self.assertEqual(['web03!load'], [result['attrs']['__name'] for result in services['results']])
+        self.assertLess(exportermetrics.registry.get_sample_value('icinga2_exporter_snapshot_age_seconds'), 0.2)
+
+    async def test_failed_refresh_keeps_the_snapshot(self):
+        await self.monitor.refresh_snapshot()
+        snapshot = self.monitor.snapshot
+        self.monitor.retries = 0
+        self.icinga2.unavailable = 1
+
+        await self.monitor.refresh_snapshot()
+
+        self.assertIs(snapshot, self.monitor.snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2019  Opsdis AB
+
+    This file is part of icinga2-exporter.
+
+    icinga2-exporter is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    icinga2-exporter is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with icinga2-exporter-exporter.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import time
+import unittest
+from unittest import mock
+
+import icinga2_exporter.exportermetrics as exportermetrics
+import icinga2_exporter.monitorconnection as monitorconnection
+import icinga2_exporter.upstream as upstream
+from fakeicinga import FakeIcinga2, service
+
+
+class EndpointsTest(unittest.TestCase):
+
+    def test_url(self):
+        endpoints = upstream.Endpoints(['https://master1:5665', 'https://master2:5665'])
+
+        self.assertEqual('https://master1:5665/v1/objects/services',
+                         endpoints.url('https://master1:5665/v1/objects/services', endpoints.endpoints[0]))
+        self.assertEqual('https://master2:5665/v1/objects/services',
+                         endpoints.url('https://master1:5665/v1/objects/services', endpoints.endpoints[1]))
+
+    def test_select_excludes_tried(self):
+        endpoints = upstream.Endpoints(['https://master1:5665', 'https://master2:5665'])
+        master1, master2 = endpoints.endpoints
+
+        for _ in range(20):
+            self.assertIs(master2, endpoints.select([master1]))
+        # All tried, any endpoint is selected
+        self.assertIn(endpoints.select([master1, master2]), (master1, master2))
+
+    def test_select_by_health(self):
+        endpoints = upstream.Endpoints(['https://master1:5665', 'https://master2:5665'])
+        master1, master2 = endpoints.endpoints
+        for _ in range(30):
+            master1.fail('connect')
+
+        selected = [endpoints.select() for _ in range(200)]
+
+        self.assertGreater(selected.count(master2), 180)
+        master1.observe(0.01)
+        self.assertAlmostEqual(upstream.HEALTH_DECAY, master1.health, places=2)
+
+    def test_latency_quantile(self):
+        endpoint = upstream.Endpoint('https://master1:5665')
+        self.assertIsNone(endpoint.latency_quantile(0.95))
+
+        for latency in range(100):
+            endpoint.observe(latency / 100)
+
+        self.assertEqual(0.95, endpoint.latency_quantile(0.95))
+
+    def test_backoff(self):
+        delays = [upstream.backoff(attempt, 0.1, 1.0) for attempt in range(10) for _ in range(10)]
+
+        self.assertTrue(all(0 <= delay <= 1.0 for delay in delays))
+        self.assertTrue(all(upstream.backoff(0, 0.1, 1.0) <= 0.1 for _ in range(10)))
+
+
+class FailoverTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        services = [service('web01', 'load', 'load', ['load1=1'])]
+        self.master1 = FakeIcinga2(services=services)
+        self.master2 = FakeIcinga2(services=services)
+        self.urls = [await self.master1.start(), await self.master2.start()]
+
+    async def asyncTearDown(self):
+        await monitorconnection.MonitorConfig().close_session()
+        await self.master2.stop()
+        await self.master1.stop()
+
+    def monitor(self, **kwargs) -> monitorconnection.MonitorConfig:
+        config = {'url': self.urls[0], 'urls': self.urls, 'user': 'user', 'passwd': 'passwd'}
+        config.update(kwargs)
+        return monitorconnection.MonitorConfig({'icinga2': config})
+
+    async def test_failover_when_endpoint_is_down(self):
+        monitor = self.monitor()
+        await self.master1.stop()
+
+        for _ in range(10):
+            data_json = await monitor.async_get_service_data('web01')
+            self.assertEqual(['web01!load'], [result['attrs']['__name'] for result in data_json['results']])
+
+        self.assertEqual(10, len(self.master2.requests))
+        self.assertLess(monitor.endpoints.endpoints[0].health, 1.0)
+
+    async def test_retry_server_error(self):
+        monitor = self.monitor(urls=[], retry_backoff=0.01)
+        retries = exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_retries_total')
+        self.master1.unavailable = 2
+
+        data_json = await monitor.async_get_service_data('web01')
+
+        self.assertEqual(['web01!load'], [result['attrs']['__name'] for result in data_json['results']])
+        self.assertEqual(retries + 2,
+                         exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_retries_total'))
+
+    async def test_retries_used_up(self):
+        monitor = self.monitor(urls=[], retries=1, retry_backoff=0.01)
+        errors = exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_errors_total',
+                                                           {'endpoint': 'services', 'type': 'status'}) or 0
+        self.master1.unavailable = 2
+
+        self.assertEqual({}, await monitor.async_get_service_data('web01'))
+        self.assertEqual(errors + 1, exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_upstream_errors_total', {'endpoint': 'services', 'type': 'status'}))
+
+    async def test_hedge_slow_endpoint(self):
+        monitor = self.monitor(enable_hedging=True)
+        for endpoint in monitor.endpoints.endpoints:
+            endpoint.latencies.extend([0.01] * upstream.MIN_LATENCY_SAMPLES)
+        hedged = exportermetrics.registry.get_sample_value('icinga2_exporter_upstream_hedged_requests_total',
+                                                           {'winner': 'hedge'}) or 0
+        self.master1.latency = 1.0
+
+        start_time = time.monotonic()
+        with mock.patch('random.random', return_value=0.0):
+            # The first endpoint is selected for the request
+            data_json = await monitor.async_get_service_data('web01')
+
+        self.assertEqual(['web01!load'], [result['attrs']['__name'] for result in data_json['results']])
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        self.assertEqual(1, len(self.master2.requests))
+        self.assertEqual(hedged + 1, exportermetrics.registry.get_sample_value(
+            'icinga2_exporter_upstream_hedged_requests_total', {'winner': 'hedge'}))
+
+    async def test_failover_from_slow_endpoint(self):
+        monitor = self.monitor(retry_backoff=0.01)
+        self.master1.latency = 2.0
+
+        start_time = time.monotonic()
+        with mock.patch('random.random', return_value=0.0):
+            # The first endpoint is selected for the first attempt, with half the timeout
+            data_json = await monitor.async_post(monitor.url_query_service_perfdata,
+                                                 monitorconnection.MonitorConfig.service_query('web01'), timeout=1.0)
+
+        self.assertEqual(['web01!load'], [result['attrs']['__name'] for result in data_json['results']])
+        self.assertLess(time.monotonic() - start_time, 0.9)
+        self.assertEqual(1, len(self.master2.requests))
+
+    async def test_no_hedge_after_deadline(self):
+        monitor = self.monitor(enable_hedging=True, retries=0)
+        for endpoint in monitor.endpoints.endpoints:
+            endpoint.latencies.extend([0.5] * upstream.MIN_LATENCY_SAMPLES)
+        self.master1.latency = 2.0
+
+        start_time = time.monotonic()
+        with mock.patch('random.random', return_value=0.0):
+            with self.assertRaises(monitorconnection.ScrapeExecption) as err:
+                await monitor.async_post(monitor.url_query_service_perfdata,
+                                         monitorconnection.MonitorConfig.service_query('web01'), timeout=0.3)
+
+        self.assertLess(time.monotonic() - start_time, 0.6)
+        self.assertEqual(self.urls[0], err.exception.url)
+        self.assertEqual(0, len(self.master2.requests))
+
+    async def test_error_names_failed_endpoint(self):
+        monitor = self.monitor(retries=1, retry_backoff=0.01)
+        await self.master1.stop()
+        await self.master2.stop()
+
+        with mock.patch('random.random', return_value=0.0):
+            with self.assertRaises(monitorconnection.ScrapeExecption) as err:
+                await monitor.async_get_service_data('web01')
+
+        self.assertEqual('Connection error', err.exception.message)
+        self.assertEqual(self.urls[1], err.exception.url)
+
+    async def test_slow_bulk_request_keeps_concurrency_limit(self):
+        monitor = self.monitor(urls=[], timeout=1, enable_concurrency_limit=True)
+        self.master1.latency = 0.6
+
+        await monitor.async_post(monitor.url_query_service_perfdata, {}, timeout=10)
+        self.assertEqual(10.0, monitor.upstream_limiter.limit)
+
+        await monitor.async_post(monitor.url_query_hosts, {})
+        self.assertEqual(9.0, monitor.upstream_limiter.limit)
+
+    async def test_no_hedge_without_latencies(self):
+        monitor = self.monitor(enable_hedging=True)
+        self.master1.latency = 0.1
+
+        with mock.patch('random.random', return_value=0.0):
+            await monitor.async_get_service_data('web01')
+
+        self.assertEqual(0, len(self.master2.requests))
+
+
+if __name__ == '__main__':
+    unittest.main()